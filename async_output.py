@@ -0,0 +1,142 @@
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Writes the output of a simulation from a separate thread.
+
+Log messages and snapshots are put on a bounded queue and written, in order,
+by a writer thread, so the simulation can go on with the next iteration while
+the last one is written. When the queue is full the simulation waits for the
+writer. Streams are flushed whenever the writer has caught up.
+
+An error in the writer is raised in the simulation at its next use of the
+AsyncWriter.
+"""
+
+import Queue
+import sys
+import threading
+
+_STOP = object()
+
+
+# BEGIN: class QueuedStream
+class QueuedStream(object):
+  """Stream whose writes go through an AsyncWriter, e.g. for log.LOG_STREAM.
+  """
+  def __init__(self, writer, stream):
+    self._writer = writer
+    self._stream = stream
+
+  def write(self, message):
+    self._writer.write(self._stream, message)
+
+  def flush(self):
+    # The writer flushes once it has caught up.
+    pass
+# END: class QueuedStream
+
+
+# BEGIN: class AsyncWriter
+class AsyncWriter(object):
+  """Writer thread fed through a bounded queue.
+  """
+  def __init__(self, maxsize=10000):
+    self._queue = Queue.Queue(maxsize)
+    self._error = None
+    self._closed = False
+    self._thread = threading.Thread(target=self._work)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _work(self):
+    """Runs the queued writes until told to stop.
+    """
+    dirty = set()
+    while True:
+      item = self._queue.get()
+      if item is _STOP: break
+      if self._error: continue
+      try:
+        stream, function, args = item
+        function(*args)
+        if stream is not None:
+          dirty.add(stream)
+        if dirty and self._queue.empty():
+          for stream in dirty:
+            stream.flush()
+          dirty.clear()
+      except Exception:
+        self._error = sys.exc_info()
+    if not self._error:
+      try:
+        for stream in dirty:
+          stream.flush()
+      except Exception:
+        self._error = sys.exc_info()
+
+  def _check(self):
+    """Raises the error of the writer, if it had one.
+    """
+    if self._error:
+      error_type, error, traceback = self._error
+      self._error = None
+      raise error_type, error, traceback
+
+  def _put(self, item):
+    self._check()
+    if self._closed:
+      raise ValueError('AsyncWriter is closed')
+    self._queue.put(item)
+
+  def write(self, stream, message):
+    """Writes a message to a stream.
+
+    Args:
+      stream: output stream, flushed once the writer has caught up
+      message: string
+    Returns:
+      None
+    """
+    self._put((stream, stream.write, (message,)))
+
+  def call(self, function, *args):
+    """Calls a function in the writer, e.g. to write a snapshot.
+
+    The arguments must not be changed afterwards by the caller.
+
+    Args:
+      function: function to call
+      args: its arguments
+    Returns:
+      None
+    """
+    self._put((None, function, args))
+
+  def stream(self, stream):
+    """Returns a stream whose writes go through this writer.
+    """
+    return QueuedStream(self, stream)
+
+  def close(self):
+    """Waits for everything queued to be written, and stops the writer.
+
+    Returns:
+      None
+    """
+    if not self._closed:
+      self._closed = True
+      self._queue.put(_STOP)
+      self._thread.join()
+    self._check()
+# END: class AsyncWriter
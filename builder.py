@@ -18,11 +18,18 @@
 import os
 import sys
 
+import edit_distance
+import neighbour_table
+import pron_trie
 import pynini_interface
 
 from base import _BASE
 
 _VOWELS = set()
+# Default limit on the number of strings of a neighbour table.
+_MAX_TABLE_PRONS = 50000
+# Slack for rounding in the bound on the cost of a close pair.
+_COST_SLACK = 1e-9
 
 
 # TODO(rws): Remove dependency on Thrax entirely by rewriting the grammars in
@@ -40,6 +47,7 @@ def build_grammar(name):
   os.system('thraxmakedep %s/Grm/%s.grm' % (_BASE, name))
   os.system('make')
   os.system('rm -f Makefile')
+  pynini_interface.GRAMMARS.refresh()
   load_vowel_definitions()
 
 
@@ -59,6 +67,23 @@ def load_vowel_definitions():
         _VOWELS.add(segment)
 
 
+def load_segments():
+  """Lists the segments defined in phonemes.tsv.
+
+  Returns:
+    set of segments
+  """
+  segments = set()
+  with open('%s/Grm/phonemes.tsv' % _BASE) as stream:
+    for line in stream:
+      try:
+        unused_clas, segment = line.split()
+      except ValueError:
+        continue
+      segments.add(segment)
+  return segments
+
+
 def is_vowel(segment):
   """Returns true if segment is a vowel.
 
@@ -88,18 +113,124 @@ def build_soundslike_grammar():
   build_grammar('soundslike')  
 
 
+def _dp_neighbours(trie, pron1, max_distance):
+  """Finds the prons close to pron1 with dynamic programming.
+
+  Args:
+    trie: pron_trie.PronTrie of the prons
+    pron1: pronunciation
+    max_distance: largest distance to keep
+  Returns:
+    list of (pron index, length, cost)
+  """
+  result = []
+  for pron_id, pron2, value in trie.distances(pron1, max_distance, True):
+    if pron2 == pron1: continue
+    if edit_distance.weighted(value) <= max_distance:
+      length, cost = edit_distance.decode(value)
+      result.append((pron_id, length, cost))
+  return result
+
+
+def _fst_neighbours(trie, pron1, max_distance):
+  """Finds the prons close to pron1 with sounds_like.
+
+  The dynamic programming gives the same least cost as sounds_like, though
+  not always the same path among those of that cost. So the prons whose cost
+  is beyond max_distance per arc for any path, which has at most one arc per
+  segment of the two prons, are ruled out with the trie, and only the others
+  are compared with sounds_like.
+
+  Args:
+    trie: pron_trie.PronTrie of the prons
+    pron1: pronunciation
+    max_distance: largest distance to keep
+  Returns:
+    list of (pron index, length, cost)
+  """
+  result = []
+  for pron_id, pron2, value in trie.distances(pron1, max_distance, True):
+    if pron2 == pron1: continue
+    max_cost = max_distance * (len(pron1) + len(pron2))
+    if edit_distance.decode(value)[1] > max_cost + _COST_SLACK: continue
+    length, cost = pynini_interface.sounds_like(pron1, pron2,
+                                                max_cost=max_cost)
+    if length and cost / length <= max_distance:
+      result.append((pron_id, length, cost))
+  return result
+
+
+def build_neighbour_table(outfile, base_morphs, max_distance, mode='fst',
+                          ablaut=True, far=('%s/Grm/morphology.far' % _BASE),
+                          max_prons=_MAX_TABLE_PRONS):
+  """Builds the table of close prons for the strings of the base morphs.
+
+  Each pron is compared only with those a pron_trie.PronTrie cannot rule out,
+  so the time grows much less than with the square of the number of prons,
+  but the languages must still be small enough to list: see neighbour_table.
+  The table records max_distance and pynini_interface.PREPARE_RULES along
+  with the mode, so that runs with other settings refuse it.
+
+  Args:
+    outfile: output file
+    base_morphs: list of base morph rules, e.g. ['MONOSYLLABLE']
+    max_distance: largest distance to keep
+    mode: "fst" or "dp", as for the distance_mode of the runs
+    ablaut: if True, also covers the ablauted forms of the strings
+    far: far holding the base morph rules
+    max_prons: if not 0, largest number of strings of the base morphs to
+      accept; a larger table raises ValueError before the strings are listed
+  Returns:
+    None
+  """
+  if mode not in ('dp', 'fst'):
+    raise ValueError('Unknown distance mode %s' % mode)
+  rules = [pynini_interface.load_rule_from_far(base_morph, far)
+           for base_morph in base_morphs]
+  npaths = sum(pynini_interface.count_paths(rule) for rule in rules)
+  if max_prons and npaths > max_prons:
+    raise ValueError('%s have up to %d strings, more than the %d allowed' %
+                     (','.join(base_morphs), npaths, max_prons))
+  prons = set()
+  for rule in rules:
+    prons.update(pynini_interface.finite_strings(rule))
+  if ablaut:
+    prons.update(apply_ablaut(sorted(prons)))
+  prons.discard('')
+  prons = sorted(prons)
+  sys.stderr.write('Finding the neighbours of %d prons\n' % len(prons))
+  trie = pron_trie.PronTrie(edit_distance.get_edit_distance(), prons)
+  neighbours = []
+  for pron1 in prons:
+    if mode == 'dp':
+      row = _dp_neighbours(trie, pron1, max_distance)
+    else:
+      row = _fst_neighbours(trie, pron1, max_distance)
+    # Only pairs with a path are kept, so the lengths are not zero.
+    row.sort(key=lambda x: (x[2] / x[1], x[0]))
+    neighbours.append(row)
+  queries, rows, possible = trie.take_stats()
+  if queries:
+    sys.stderr.write('Computed %.1f of %.1f rows per pron\n' % (
+      float(rows) / queries, float(possible) / queries))
+  neighbour_table.write_table(outfile, mode, max_distance,
+                              pynini_interface.PREPARE_RULES, prons,
+                              neighbours)
+
+
 def generate_morphs(base_morph='MONOSYLLABLE', n=1000,
-                    far=("%s/Grm/morphology.far" % _BASE)):
+                    far=("%s/Grm/morphology.far" % _BASE), seed=None):
   """Generates a set of morphs according to the base_morph template.
 
   Args:
     base_morph: name of the base morph rule, e.g. MONOSYLLABLE
     n: number of morphs to generate
+    seed: seed for the random paths, or None to seed from the time
   Returns:
     list of morphs
   """
-  pynini_interface.load_rule_from_far(base_morph, far)
-  return pynini_interface.random_paths(base_morph, n)
+  return pynini_interface.random_paths(
+    pynini_interface.load_rule_from_far(base_morph, far), n, seed)
 
 
 def dump_morphs(morphs, outfile=None):
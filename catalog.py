@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""SQLite catalog of simulation results.
+
+Holds for each run its configuration, the counts that stats.py reports for
+each iteration, and the final pron/symbol map, so that runs can be compared
+with indexed queries rather than by reading the output directories.
+
+Runs are added by lexicon.py when given --catalog, or afterwards from their
+output directories:
+
+  catalog.py results.db /var/tmp/script_evolution_outputs
+
+which finds every run under the given directories. The configuration of a run
+imported this way is read from the directory names used by experiments.sh.
+"""
+
+import glob
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY,
+  outdir TEXT UNIQUE NOT NULL,
+  base_morph TEXT,
+  probability REAL,
+  non_primaries INTEGER,
+  ablaut INTEGER,
+  freeze_phonetics INTEGER,
+  freeze_semantics INTEGER,
+  niter INTEGER,
+  nmorphs INTEGER,
+  seed INTEGER,
+  experiment TEXT,
+  imported REAL);
+CREATE INDEX IF NOT EXISTS runs_config ON runs (
+  base_morph, probability, non_primaries, ablaut, freeze_phonetics,
+  freeze_semantics);
+CREATE TABLE IF NOT EXISTS iterations (
+  run_id INTEGER NOT NULL,
+  iteration INTEGER NOT NULL,
+  morphs INTEGER,
+  spelled INTEGER,
+  semphon INTEGER,
+  phon INTEGER,
+  sem INTEGER,
+  PRIMARY KEY (run_id, iteration));
+CREATE TABLE IF NOT EXISTS symbols (
+  run_id INTEGER NOT NULL,
+  symbol TEXT,
+  pron TEXT);
+CREATE INDEX IF NOT EXISTS symbols_run ON symbols (run_id);
+CREATE INDEX IF NOT EXISTS symbols_pron ON symbols (pron);
+CREATE INDEX IF NOT EXISTS symbols_symbol ON symbols (symbol);
+"""
+
+# Configuration columns of runs, and how they appear in the directory names
+# made by experiments.sh.
+_CONFIG = [
+  ('base_morph', r'base_morph_(\w+)', str),
+  ('probability', r'prob_([\d.]+)', float),
+  ('non_primaries', r'non_primaries_(\d+)', int),
+  ('ablaut', r'ablaut_(\d+)', int),
+  ('freeze_phonetics', r'freeze_(\d+)', int),
+  ('freeze_semantics', r'freeze_semantics_(\d+)', int),
+  ('niter', r'niter_(\d+)', int),
+]
+_CONFIG_COLUMNS = [column for column, unused_pattern, unused_type in _CONFIG]
+_COUNT_COLUMNS = ['morphs', 'spelled', 'semphon', 'phon', 'sem']
+
+
+def count_morphemes(morph_file):
+  """Counts the spellings in a morphemes_*.tsv snapshot.
+
+  Args:
+    morph_file: snapshot written by Lexicon.dump_morphemes
+  Returns:
+    (morphs, spelled, semphon, phon, sem)
+  """
+  tot = nsyms = nsemphon = nphon = nsem = 0
+  with open(morph_file) as strm:
+    for line in strm:
+      tot += 1
+      if 'NO_SYMBOL' in line:
+        continue
+      nsyms += 1
+      if ':SP>' in line:
+        nsemphon +=1
+      if ':P>' in line:
+        nphon +=1
+      if ':S>' in line:
+        nsem +=1
+  return tot, nsyms, nsemphon, nphon, nsem
+
+
+def snapshot_counts(outdir):
+  """Counts the spellings in all the snapshots of a run.
+
+  Args:
+    outdir: output directory of the run
+  Returns:
+    list of (iteration, morphs, spelled, semphon, phon, sem)
+  """
+  counts = []
+  for morph_file in sorted(glob.glob(outdir + '/morphemes_*.tsv')):
+    iteration = int(re.search(r'morphemes_(\d+)\.tsv$', morph_file).group(1))
+    counts.append((iteration,) + count_morphemes(morph_file))
+  return counts
+
+
+def metrics_counts(outdir):
+  """Reads the counts for each iteration from the metrics of a run.
+
+  Args:
+    outdir: output directory of the run
+  Returns:
+    list of (iteration, morphs, spelled, semphon, phon, sem), or None if the
+    run has no metrics.jsonl
+  """
+  try:
+    stream = open(outdir + '/metrics.jsonl')
+  except IOError:
+    return None
+  counts = []
+  with stream:
+    for line in stream:
+      if not line.strip(): continue
+      record = json.loads(line)
+      counts.append(tuple([record['iteration']] +
+                          [record[column] for column in _COUNT_COLUMNS]))
+  return counts
+
+
+def run_counts(outdir):
+  """Counts for each iteration of a run, from its metrics if it has them.
+
+  Args:
+    outdir: output directory of the run
+  Returns:
+    list of (iteration, morphs, spelled, semphon, phon, sem)
+  """
+  counts = metrics_counts(outdir)
+  if counts is None:
+    counts = snapshot_counts(outdir)
+  return counts
+
+
+def logged_symbols(outdir):
+  """Reads the final pron/symbol map from the log of a run.
+
+  Args:
+    outdir: output directory of the run
+  Returns:
+    list of (symbol, pron)
+  """
+  symbols = []
+  try:
+    with open(outdir + '/log.txt') as stream:
+      for line in stream:
+        if not line.startswith('SYMBOL:\t'): continue
+        unused_tag, symbol, pron = line.rstrip('\n').split('\t')
+        symbols.append((symbol, pron))
+  except IOError:
+    pass
+  return symbols
+
+
+def _text(string):
+  """Decodes a UTF-8 byte string for sqlite3, which refuses them.
+  """
+  if isinstance(string, str):
+    return string.decode('utf8')
+  return string
+
+
+def config_from_path(outdir):
+  """Reads the configuration of a run from its directory names.
+
+  Args:
+    outdir: output directory of the run
+  Returns:
+    dict from column of runs to value
+  """
+  config = {}
+  components = os.path.normpath(outdir).split(os.sep)
+  for column, pattern, value_type in _CONFIG:
+    for component in components:
+      match = re.match('^%s$' % pattern, component)
+      if match:
+        config[column] = value_type(match.group(1))
+  config['experiment'] = components[-1]
+  return config
+
+
+# BEGIN: class Catalog
+class Catalog(object):
+  """Connection to a catalog database.
+  """
+  def __init__(self, path):
+    # Several runs may write at once, so wait for the others' transactions.
+    self._connection = sqlite3.connect(path, timeout=600)
+    self._connection.executescript(_SCHEMA)
+
+  def close(self):
+    self._connection.close()
+
+  def import_run(self, outdir, config, counts, symbols):
+    """Adds a run, replacing any run with the same output directory.
+
+    Args:
+      outdir: output directory of the run
+      config: dict from column of runs to value
+      counts: list of (iteration, morphs, spelled, semphon, phon, sem)
+      symbols: list of (symbol, pron)
+    Returns:
+      id of the run
+    """
+    outdir = _text(os.path.abspath(outdir))
+    columns = [column for column in config
+               if column in _CONFIG_COLUMNS + ['nmorphs', 'seed', 'experiment']]
+    with self._connection:
+      cursor = self._connection.cursor()
+      cursor.execute('SELECT id FROM runs WHERE outdir = ?', (outdir,))
+      for (run_id,) in cursor.fetchall():
+        cursor.execute('DELETE FROM iterations WHERE run_id = ?', (run_id,))
+        cursor.execute('DELETE FROM symbols WHERE run_id = ?', (run_id,))
+        cursor.execute('DELETE FROM runs WHERE id = ?', (run_id,))
+      cursor.execute(
+        'INSERT INTO runs (outdir, imported%s) VALUES (?, ?%s)' % (
+          ''.join(', ' + column for column in columns),
+          ', ?' * len(columns)),
+        [outdir, time.time()] +
+        [_text(config[column]) for column in columns])
+      run_id = cursor.lastrowid
+      cursor.executemany(
+        'INSERT INTO iterations VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((run_id,) + tuple(row) for row in counts))
+      cursor.executemany('INSERT INTO symbols VALUES (?, ?, ?)',
+                         ((run_id, _text(symbol), _text(pron))
+                          for symbol, pron in symbols))
+    return run_id
+
+  def import_directory(self, outdir, config=None):
+    """Adds a run from its output directory.
+
+    Args:
+      outdir: output directory of the run
+      config: configuration of the run, or None to read it from the path
+    Returns:
+      id of the run
+    """
+    if config is None:
+      config = config_from_path(outdir)
+    return self.import_run(outdir, config, run_counts(outdir),
+                           logged_symbols(outdir))
+
+  def import_tree(self, root):
+    """Adds all the runs under a directory.
+
+    Args:
+      root: directory to search for runs
+    Returns:
+      number of runs added
+    """
+    nruns = 0
+    for directory, unused_subdirectories, files in os.walk(root):
+      if 'log.txt' not in files: continue
+      self.import_directory(directory)
+      nruns += 1
+    return nruns
+
+  def find_runs(self, **config):
+    """Finds the runs with the given configuration.
+
+    Args:
+      config: values of columns of runs, e.g. base_morph='MONOSYLLABLE'
+    Returns:
+      list of (id, outdir)
+    """
+    conditions = ['%s = ?' % column for column in sorted(config)]
+    query = 'SELECT id, outdir FROM runs'
+    if conditions:
+      query += ' WHERE ' + ' AND '.join(conditions)
+    return self._connection.execute(
+      query + ' ORDER BY outdir',
+      [config[column] for column in sorted(config)]).fetchall()
+
+  def run_id(self, outdir):
+    """Returns the id of the run in outdir, or None.
+    """
+    row = self._connection.execute('SELECT id FROM runs WHERE outdir = ?',
+                                   (os.path.abspath(outdir),)).fetchone()
+    return row[0] if row else None
+
+  def trajectory(self, run_id):
+    """Returns the counts for each iteration of a run.
+
+    Args:
+      run_id: id of the run
+    Returns:
+      list of (iteration, morphs, spelled, semphon, phon, sem)
+    """
+    return self._connection.execute(
+      'SELECT iteration, %s FROM iterations WHERE run_id = ? '
+      'ORDER BY iteration' % ', '.join(_COUNT_COLUMNS), (run_id,)).fetchall()
+
+  def mean_trajectory(self, **config):
+    """Averages the counts for each iteration over runs.
+
+    Args:
+      config: values of columns of runs selecting the runs
+    Returns:
+      list of (iteration, number of runs, mean morphs, mean spelled,
+      mean semphon, mean phon, mean sem)
+    """
+    conditions = ['runs.%s = ?' % column for column in sorted(config)]
+    query = ('SELECT iteration, COUNT(*), %s FROM iterations '
+             'JOIN runs ON runs.id = iterations.run_id' %
+             ', '.join('AVG(%s)' % column for column in _COUNT_COLUMNS))
+    if conditions:
+      query += ' WHERE ' + ' AND '.join(conditions)
+    return self._connection.execute(
+      query + ' GROUP BY iteration ORDER BY iteration',
+      [config[column] for column in sorted(config)]).fetchall()
+
+  def symbols_for_pron(self, pron, **config):
+    """Finds the final symbols for a pronunciation across runs.
+
+    Args:
+      pron: pronunciation
+      config: values of columns of runs selecting the runs
+    Returns:
+      list of (outdir, symbol)
+    """
+    conditions = ['symbols.pron = ?'] + ['runs.%s = ?' % column
+                                         for column in sorted(config)]
+    pron = _text(pron)
+    return self._connection.execute(
+      'SELECT runs.outdir, symbols.symbol FROM symbols '
+      'JOIN runs ON runs.id = symbols.run_id WHERE ' +
+      ' AND '.join(conditions) + ' ORDER BY runs.outdir',
+      [pron] + [config[column] for column in sorted(config)]).fetchall()
+# END: class Catalog
+
+
+def main(argv):
+  if len(argv) < 3:
+    sys.stderr.write('Usage: catalog.py catalog.db directory...\n')
+    sys.exit(1)
+  catalog = Catalog(argv[1])
+  for root in argv[2:]:
+    print '%s: %d runs' % (root, catalog.import_tree(root))
+  catalog.close()
+
+
+if __name__ == '__main__':
+  main(sys.argv)
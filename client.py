@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Sends a run to daemon.py and waits for it to finish.
+
+Takes the same flags as lexicon.py, plus --socket for the daemon's socket.
+
+Usage: client.py --socket=/tmp/simulation.sock [lexicon.py flags]
+"""
+
+import json
+import socket
+import sys
+
+
+def main(argv):
+  spec = {'flags': {}}
+  socket_path = None
+  for arg in argv[1:]:
+    if not arg.startswith('--') or '=' not in arg:
+      sys.stderr.write('Bad argument %s\n' % arg)
+      sys.exit(1)
+    option, value = arg[2:].split('=', 1)
+    if option == 'socket':
+      socket_path = value
+    elif option in ('seed', 'outdir'):
+      spec[option] = value
+    else:
+      spec['flags'][option] = value
+  if not socket_path:
+    sys.stderr.write('No --socket given\n')
+    sys.exit(1)
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  connection.connect(socket_path)
+  stream = connection.makefile('rw')
+  stream.write(json.dumps(spec) + '\n')
+  stream.flush()
+  connection.shutdown(socket.SHUT_WR)
+  result = json.loads(stream.readline())
+  connection.close()
+  print json.dumps(result)
+  if result['status'] != 'ok':
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
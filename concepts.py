@@ -119,3 +119,59 @@ CONCEPTS = {
   '@CUP' : '☕',}
 
 NUM_CONCEPTS = len(CONCEPTS)
+
+# Integer ids of the primitive concepts, assigned as they are first seen.
+_ATOM_IDS = {}
+_ATOMS = []
+
+
+def atom_id(atom):
+  """Returns the id of a primitive concept, assigning one if it is new.
+
+  Args:
+    atom: primitive concept, e.g. "@MAN"
+  Returns:
+    int
+  """
+  try:
+    return _ATOM_IDS[atom]
+  except KeyError:
+    _ATOM_IDS[atom] = len(_ATOMS)
+    _ATOMS.append(atom)
+    return _ATOM_IDS[atom]
+
+
+def atom_name(atom_id):
+  """Returns the primitive concept with the given id.
+  """
+  return _ATOMS[atom_id]
+
+
+def load_concepts(concepts_file):
+  """Loads an inventory of concepts to use instead of CONCEPTS.
+
+  Each line holds a concept and its graphical form separated by a tab, e.g.
+  "@MAN\t♂". Blank lines and lines starting with "#" are skipped, and an "@"
+  is added to concepts that lack one.
+
+  Args:
+    concepts_file: path of the inventory
+  Returns:
+    dict from concept to graphical form, like CONCEPTS
+  """
+  inventory = {}
+  with open(concepts_file) as stream:
+    for line in stream:
+      line = line.strip()
+      if not line or line.startswith('#'): continue
+      try:
+        concept, glyph = [field.strip() for field in line.split('\t')]
+      except ValueError:
+        raise ValueError('Bad line in %s: %s' % (concepts_file, line))
+      if not concept.startswith('@'):
+        concept = '@' + concept
+      if ',' in concept:
+        raise ValueError('Concept %s in %s contains a comma' %
+                         (concept, concepts_file))
+      inventory[intern(concept)] = glyph
+  return inventory
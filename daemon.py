@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Long-running simulation server that keeps grammars and caches warm.
+
+The grammars are built and loaded once, and the composed lattices and the
+distance matrix are kept from one run to the next. Runs are given as JSON
+lines, e.g.
+
+  {"flags": {"base_morph": "DISYLLABLE", "niter": 10}, "seed": 1,
+   "outdir": "/var/tmp/simulation/0"}
+
+where "flags" holds any of the flags of lexicon.py. For each run a JSON line
+is returned giving the outdir, the status and the time taken.
+
+With --socket the runs are read from connections to a Unix socket (see
+client.py), otherwise from stdin, with the results written to stdout. With
+--workers greater than 1, runs are handled by that many forked workers, each
+starting from the warm state of the server.
+
+Usage: daemon.py [--socket=/tmp/simulation.sock] [--workers=N]
+"""
+
+import SocketServer
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import builder
+import flags
+import lexicon
+import log
+import pynini_interface
+
+from base import _BASE
+
+_BASE_MORPHS = ['MONOSYLLABLE', 'SESQUISYLLABLE', 'DISYLLABLE', 'ABLAUT']
+# Distance matrices kept across runs, by distance mode and matrix store: the
+# distances depend only on the prons.
+_MATRICES = {}
+
+
+def warm_up():
+  """Builds and loads the grammars.
+
+  Returns:
+    None
+  """
+  builder.build_morphology_grammar()
+  builder.build_soundslike_grammar()
+  for rule in _BASE_MORPHS:
+    pynini_interface.load_rule_from_far(rule, '%s/Grm/morphology.far' % _BASE)
+  pynini_interface.load_rule_from_far('EDIT_DISTANCE',
+                                      '%s/Grm/soundslike.far' % _BASE)
+
+
+def run_spec(spec):
+  """Runs one simulation.
+
+  Args:
+    spec: dict with optional "flags", "seed" and "outdir"
+  Returns:
+    dict describing the outcome
+  """
+  argv = ['--%s=%s' % (str(option), str(value))
+          for option, value in sorted(spec.get('flags', {}).items())]
+  for option in ('seed', 'outdir'):
+    if option in spec:
+      argv.append('--%s=%s' % (option, str(spec[option])))
+  flags.reset_flags()
+  start = time.time()
+  result = {'status': 'ok'}
+  # The runs print their progress, which must not get mixed with the results.
+  stdout = sys.stdout
+  sys.stdout = sys.stderr
+  try:
+    flags.parse_flags(argv)
+    result['outdir'] = flags.FLAGS_outdir
+    key = flags.FLAGS_distance_mode, flags.FLAGS_matrix_store
+    if key not in _MATRICES:
+      _MATRICES[key] = lexicon.new_matrix()
+
+    def replace_matrix(matrix):
+      # The matrix dropped to keep to the memory budget is then freed.
+      _MATRICES[key] = matrix
+
+    lexicon.run_simulation(_MATRICES[key], build_grammars=False,
+                           matrix_replaced=replace_matrix)
+  except (Exception, SystemExit) as err:
+    result['status'] = 'error'
+    result['error'] = str(err)
+  finally:
+    sys.stdout = stdout
+    log.LOG_STREAM = sys.stderr
+  result['seconds'] = time.time() - start
+  return result
+
+
+def handle_line(line):
+  """Runs the simulation given by a JSON line.
+
+  Args:
+    line: JSON string
+  Returns:
+    JSON string describing the outcome
+  """
+  try:
+    spec = json.loads(line)
+  except ValueError as err:
+    return json.dumps({'status': 'error', 'error': str(err)})
+  return json.dumps(run_spec(spec))
+
+
+# BEGIN: class RunHandler
+class RunHandler(SocketServer.StreamRequestHandler):
+  """Runs the simulations sent over a connection, one per line.
+  """
+  def handle(self):
+    for line in iter(self.rfile.readline, ''):
+      if not line.strip(): continue
+      self.wfile.write(handle_line(line) + '\n')
+      self.wfile.flush()
+# END: class RunHandler
+
+
+# BEGIN: class ForkingServer
+class ForkingServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+  """Server that handles each connection in a child forked from the server.
+  """
+  pass
+# END: class ForkingServer
+
+
+def serve_socket(path, workers):
+  """Serves runs from a Unix socket until interrupted.
+
+  Args:
+    path: path of the socket
+    workers: maximum number of runs at a time
+  Returns:
+    None
+  """
+  if os.path.exists(path):
+    os.remove(path)
+  if workers > 1:
+    server = ForkingServer(path, RunHandler)
+    server.max_children = workers
+  else:
+    server = SocketServer.UnixStreamServer(path, RunHandler)
+  sys.stderr.write('Serving on %s\n' % path)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.remove(path)
+
+
+def serve_stdin(workers):
+  """Serves runs from stdin until end of input.
+
+  Args:
+    workers: number of runs at a time
+  Returns:
+    None
+  """
+  lines = (line for line in iter(sys.stdin.readline, '') if line.strip())
+  if workers > 1:
+    pool = multiprocessing.Pool(workers)
+    results = pool.imap(handle_line, lines)
+  else:
+    pool = None
+    results = (handle_line(line) for line in lines)
+  for result in results:
+    sys.stdout.write(result + '\n')
+    sys.stdout.flush()
+  if pool:
+    pool.close()
+    pool.join()
+
+
+def main(argv):
+  lexicon.define_flags()
+  flags.define_flag('socket',
+                    '',
+                    'Unix socket to serve on; reads stdin if empty')
+  flags.define_flag('workers',
+                    '1',
+                    'Number of runs at a time')
+  flags.parse_flags(argv[1:])
+  socket_path = flags.FLAGS_socket
+  workers = flags.FLAGS_workers
+  warm_up()
+  if socket_path:
+    serve_socket(socket_path, workers)
+  else:
+    serve_stdin(workers)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,288 @@
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Stores for the distance matrix of PhonologicalDistance.
+
+The matrix lives for the whole run and covers the telescoped prons, so with
+many morphemes a dict from pairs of strings to floats becomes very large. The
+stores here all hold the raw result of sounds_like, the path length and cost,
+and give back the cost per arc as before:
+
+  dict: dict from pairs of prons to distances, as the matrix always was
+  dense: a float32 cost and a 16-bit length for every pair of interned prons,
+    for small numbers of prons
+  sparse: only the distances at most the threshold of closest_prons, plus a
+    bitmap per pron of the prons known to be further away, which are given
+    back as infinitely far
+
+The costs are multiples of 0.5, so float32 holds them exactly and the
+distances are the same whichever store is used.
+"""
+
+import array
+import sys
+
+_INF = float('inf')
+_NAN = float('nan')
+
+
+def _weighted_cost(length, cost):
+  """Cost per arc of a sounds_like result.
+  """
+  try:
+    return cost / length
+  except ZeroDivisionError:
+    return _INF
+
+
+# BEGIN: class PronTable
+class PronTable(object):
+  """Interns prons as small integers.
+  """
+  def __init__(self):
+    self.ids = {}
+    self.prons = []
+
+  def __len__(self):
+    return len(self.prons)
+
+  def intern(self, pron):
+    """Returns the id of pron, assigning the next one if it is new.
+    """
+    try:
+      return self.ids[pron]
+    except KeyError:
+      self.ids[pron] = len(self.prons)
+      self.prons.append(pron)
+      return self.ids[pron]
+
+  def nbytes(self):
+    """Approximate memory used, in bytes.
+    """
+    return (sys.getsizeof(self.ids) + sys.getsizeof(self.prons) +
+            sum(sys.getsizeof(pron) for pron in self.prons))
+# END: class PronTable
+
+
+# BEGIN: class DictMatrix
+class DictMatrix(object):
+  """Distances in a dict keyed by pairs of prons.
+  """
+  def __init__(self):
+    self._table = {}
+
+  def __len__(self):
+    return len(self._table)
+
+  def get(self, pron1, pron2):
+    """Returns the distance between two prons, or None if not known.
+    """
+    return self._table.get((pron1, pron2))
+
+  def put(self, pron1, pron2, length, cost):
+    """Stores a sounds_like result.
+
+    Args:
+      pron1: first pronunciation
+      pron2: second pronunciation
+      length: number of arcs in the shortest path
+      cost: cost of the shortest path
+    Returns:
+      the distance
+    """
+    self._table[pron1, pron2] = _weighted_cost(length, cost)
+    return self._table[pron1, pron2]
+
+  def nbytes(self):
+    """Approximate memory used, in bytes.
+    """
+    # Each entry has a pair and a float; the prons are shared with the lexicon.
+    return (sys.getsizeof(self._table) +
+            len(self._table) * (sys.getsizeof((None, None)) +
+                                sys.getsizeof(0.0)))
+# END: class DictMatrix
+
+
+# BEGIN: class DenseMatrix
+class DenseMatrix(object):
+  """Distances in a row of float32 costs and 16-bit lengths per pron.
+
+  Rows are grown as prons are interned. Unknown costs are NaN.
+  """
+  def __init__(self):
+    self._prons = PronTable()
+    self._costs = []
+    self._lengths = []
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  def get(self, pron1, pron2):
+    """Returns the distance between two prons, or None if not known.
+    """
+    ids = self._prons.ids
+    try:
+      id1 = ids[pron1]
+      id2 = ids[pron2]
+    except KeyError:
+      return None
+    row = self._costs[id1]
+    if id2 >= len(row): return None
+    cost = row[id2]
+    if cost != cost: return None
+    return _weighted_cost(self._lengths[id1][id2], cost)
+
+  def _intern(self, pron):
+    """Interns a pron, adding its row if it is new.
+    """
+    pron_id = self._prons.intern(pron)
+    if pron_id == len(self._costs):
+      self._costs.append(array.array('f'))
+      self._lengths.append(array.array('H'))
+    return pron_id
+
+  def put(self, pron1, pron2, length, cost):
+    """Stores a sounds_like result.
+
+    Args:
+      pron1: first pronunciation
+      pron2: second pronunciation
+      length: number of arcs in the shortest path
+      cost: cost of the shortest path
+    Returns:
+      the distance
+    """
+    id1 = self._intern(pron1)
+    id2 = self._intern(pron2)
+    row = self._costs[id1]
+    if id2 >= len(row):
+      # Grows the row to all the prons so far, to keep the growth amortized.
+      extra = len(self._prons) - len(row)
+      row.extend(array.array('f', [_NAN]) * extra)
+      self._lengths[id1].extend(array.array('H', [0]) * extra)
+    if row[id2] != row[id2]:
+      self._size += 1
+    row[id2] = cost
+    self._lengths[id1][id2] = length
+    return _weighted_cost(length, row[id2])
+
+  def nbytes(self):
+    """Approximate memory used, in bytes.
+    """
+    return (self._prons.nbytes() +
+            sum(sys.getsizeof(row) for row in self._costs) +
+            sum(sys.getsizeof(row) for row in self._lengths))
+# END: class DenseMatrix
+
+
+# BEGIN: class SparseMatrix
+class SparseMatrix(object):
+  """Distances at most max_distance, and a bitmap per pron of those beyond.
+  """
+  def __init__(self, max_distance):
+    self._max_distance = max_distance
+    self._prons = PronTable()
+    self._near = []  # Per pron, dict from pron id to distance
+    self._far = []  # Per pron, bitmap of pron ids known to be too far
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  def get(self, pron1, pron2):
+    """Returns the distance between two prons, or None if not known.
+
+    Prons further apart than max_distance are given as infinitely far.
+    """
+    ids = self._prons.ids
+    try:
+      id1 = ids[pron1]
+      id2 = ids[pron2]
+    except KeyError:
+      return None
+    try:
+      return self._near[id1][id2]
+    except KeyError:
+      pass
+    far = self._far[id1]
+    byte = id2 >> 3
+    if byte < len(far) and far[byte] & (1 << (id2 & 7)):
+      return _INF
+    return None
+
+  def _intern(self, pron):
+    """Interns a pron, adding its row if it is new.
+    """
+    pron_id = self._prons.intern(pron)
+    if pron_id == len(self._near):
+      self._near.append({})
+      self._far.append(bytearray())
+    return pron_id
+
+  def put(self, pron1, pron2, length, cost):
+    """Stores a sounds_like result.
+
+    Args:
+      pron1: first pronunciation
+      pron2: second pronunciation
+      length: number of arcs in the shortest path
+      cost: cost of the shortest path
+    Returns:
+      the distance, or infinity if beyond max_distance
+    """
+    id1 = self._intern(pron1)
+    id2 = self._intern(pron2)
+    distance = _weighted_cost(length, cost)
+    self._size += 1
+    if distance <= self._max_distance:
+      self._near[id1][id2] = distance
+      return distance
+    far = self._far[id1]
+    byte = id2 >> 3
+    if byte >= len(far):
+      far.extend(bytearray((len(self._prons) >> 3) + 1 - len(far)))
+    far[byte] |= 1 << (id2 & 7)
+    return _INF
+
+  def nbytes(self):
+    """Approximate memory used, in bytes.
+    """
+    return (self._prons.nbytes() +
+            sum(sys.getsizeof(near) + len(near) * sys.getsizeof(0.0)
+                for near in self._near) +
+            sum(sys.getsizeof(far) for far in self._far))
+# END: class SparseMatrix
+
+
+_STORES = ['dict', 'dense', 'sparse']
+
+
+def new_matrix(store, max_distance):
+  """Creates an empty distance matrix.
+
+  Args:
+    store: "dict", "dense" or "sparse"
+    max_distance: largest distance that the sparse store keeps exactly
+  Returns:
+    the matrix
+  """
+  if store == 'dict':
+    return DictMatrix()
+  if store == 'dense':
+    return DenseMatrix()
+  if store == 'sparse':
+    return SparseMatrix(max_distance)
+  raise ValueError('Unknown matrix store %s; expected one of %s' %
+                   (store, ', '.join(_STORES)))
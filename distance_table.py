@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Table of the distances between prons under several similarity rules.
+
+Compares the rules of Grm/soundslike.far on the same pairs of prons in one
+pass, with pynini_interface.sounds_like_multi. Each line of the output gives
+two prons and then, for each rule, the distance used by the simulation: the
+cost of the best path per arc, or inf if there is none. The first line names
+the columns.
+
+The prons are read from --prons, one per line, or else are all the strings of
+--base_morphs. With --max_distance, pairs beyond it under every rule are left
+out, and paths costing more than it allows are not extracted, so some of the
+distances beyond it are given as inf.
+
+Usage:
+
+  distance_table.py --base_morphs=MONOSYLLABLE --output=distances.tsv
+  distance_table.py --prons=prons.txt --rules=CLOSE,EDIT_DISTANCE \\
+    --max_distance=0.6
+"""
+
+import sys
+
+import builder
+import flags
+import pynini_interface
+
+from base import _BASE
+
+
+def read_prons(path):
+  """Reads prons, one per line.
+
+  Args:
+    path: file of prons
+  Returns:
+    list of the distinct prons, in their first order
+  """
+  prons = []
+  seen = set()
+  with open(path) as stream:
+    for line in stream:
+      pron = line.strip()
+      if not pron or pron in seen: continue
+      seen.add(pron)
+      prons.append(pron)
+  return prons
+
+
+def base_morph_prons(base_morphs, ablaut,
+                     far=('%s/Grm/morphology.far' % _BASE)):
+  """Lists the strings of base morph rules, as for the neighbour table.
+
+  Args:
+    base_morphs: list of base morph rules, e.g. ['MONOSYLLABLE']
+    ablaut: if True, also includes the ablauted forms of the strings
+    far: far holding the base morph rules
+  Returns:
+    sorted list of prons
+  """
+  prons = set()
+  for base_morph in base_morphs:
+    prons.update(pynini_interface.finite_strings(
+      pynini_interface.load_rule_from_far(base_morph, far)))
+  if ablaut:
+    prons.update(builder.apply_ablaut(sorted(prons)))
+  prons.discard('')
+  return sorted(prons)
+
+
+def _format(length, cost):
+  """Formats a distance as cost per arc.
+  """
+  if not length or cost == float('inf'):
+    return 'inf'
+  return '%.4f' % (cost / length)
+
+
+def write_distance_table(stream, prons, rules, max_distance=None):
+  """Writes the distances between all pairs of prons under the rules.
+
+  Each pron is made into an acceptor once. The prons compared with pron1 are
+  grouped by length, so that with max_distance those of a group share the
+  bound on the cost.
+
+  Args:
+    stream: output stream
+    prons: list of prons
+    rules: list of rules of Grm/soundslike.far
+    max_distance: if not None, largest distance of interest
+  Returns:
+    number of pairs written
+  """
+  by_length = {}
+  for pron in prons:
+    by_length.setdefault(len(pron), []).append(pron)
+  stream.write('\t'.join(['pron1', 'pron2'] + rules) + '\n')
+  acceptors = {}
+  npairs = 0
+  for pron1 in prons:
+    rows = {}
+    for length, prons2 in sorted(by_length.items()):
+      max_cost = None
+      if max_distance is not None:
+        max_cost = max_distance * (len(pron1) + length)
+      for pron2, distances in zip(prons2, pynini_interface.sounds_like_multi(
+          pron1, prons2, rules, max_cost=max_cost, acceptors=acceptors)):
+        rows[pron2] = distances
+    for pron2 in prons:
+      if pron2 == pron1: continue
+      distances = rows[pron2]
+      if max_distance is not None and not [
+          1 for length, cost in distances
+          if length and cost / length <= max_distance]:
+        continue
+      stream.write('\t'.join([pron1, pron2] +
+                             [_format(*distance) for distance in distances]) +
+                   '\n')
+      npairs += 1
+  return npairs
+
+
+def main(argv):
+  flags.define_flag('output',
+                    '',
+                    'File to write the table to; empty for stdout')
+  flags.define_flag('prons',
+                    '',
+                    'File of prons, one per line; empty to use the strings '
+                    'of --base_morphs')
+  flags.define_flag('base_morphs',
+                    'MONOSYLLABLE',
+                    'Comma-separated base morph rules whose strings to use')
+  flags.define_flag('ablaut',
+                    '0',
+                    'Whether to also use the ablauted forms of the strings')
+  flags.define_flag('rules',
+                    'CLOSE,CLOSE_RHYME,CLOSE_V_FREE,STRICT_V_FREE,'
+                    'EDIT_DISTANCE',
+                    'Comma-separated rules of Grm/soundslike.far to compare')
+  flags.define_flag('max_distance',
+                    '0',
+                    'Largest distance to keep under some rule; 0 to keep '
+                    'all pairs')
+  flags.define_flag('build_grammars',
+                    '0',
+                    'Whether to build the grammars first')
+  flags.parse_flags(argv[1:])
+  if flags.FLAGS_build_grammars:
+    builder.build_morphology_grammar()
+    builder.build_soundslike_grammar()
+  builder.load_vowel_definitions()
+  if flags.FLAGS_prons:
+    prons = read_prons(flags.FLAGS_prons)
+  else:
+    prons = base_morph_prons(flags.FLAGS_base_morphs.split(','),
+                             flags.FLAGS_ablaut)
+  max_distance = float(flags.FLAGS_max_distance) or None
+  rules = flags.FLAGS_rules.split(',')
+  sys.stderr.write('Comparing %d prons under %d rules\n' % (len(prons),
+                                                           len(rules)))
+  if flags.FLAGS_output:
+    with open(flags.FLAGS_output, 'w') as stream:
+      npairs = write_distance_table(stream, prons, rules, max_distance)
+  else:
+    npairs = write_distance_table(sys.stdout, prons, rules, max_distance)
+  sys.stderr.write('Wrote %d pairs\n' % npairs)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
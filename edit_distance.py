@@ -0,0 +1,317 @@
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Dynamic-programming version of EDIT_DISTANCE from Grm/soundslike.grm.
+
+EDIT_DISTANCE is the closure of single-segment edits and their inverses, so
+the cheapest path through it is the cheapest alignment of the two strings
+under the costs of the edits, which can be found by the usual dynamic
+programming. The costs are read from the grammar itself.
+
+As with sounds_like, the result is the length of the path (the number of
+edits, including identities) and its cost. Among alignments of equal cost the
+shortest is chosen.
+
+Each cell of the dynamic programming holds cost * _SCALE + length in a single
+float. Since the costs are multiples of 0.5, this is exact, and taking the
+minimum compares by cost and then by length.
+"""
+
+import copy
+import re
+
+from base import _BASE
+
+_SCALE = 1024.0
+_MAX_LENGTH = 512
+_INF = float('inf')
+
+
+def encode(length, cost):
+  """Packs a path length and cost into a single value.
+
+  Args:
+    length: number of edits
+    cost: cost of the edits
+  Returns:
+    float
+  """
+  return cost * _SCALE + length
+
+
+def decode(value):
+  """Unpacks a value made by encode.
+
+  Args:
+    value: float
+  Returns:
+    (length, cost), or (0, inf) if there is no path, as for sounds_like
+  """
+  if value == _INF:
+    return 0, _INF
+  length = int(value % _MAX_LENGTH)
+  return length, (value - length) / _SCALE
+
+
+def weighted(value):
+  """Cost per edit of an encoded value.
+
+  Args:
+    value: float made by encode
+  Returns:
+    float, infinite if there is no path
+  """
+  length, cost = decode(value)
+  try:
+    return cost / length
+  except ZeroDivisionError:
+    return float('Infinity')
+
+
+def _load_classes(phonemes):
+  """Loads the phoneme classes from phonemes.tsv.
+
+  Args:
+    phonemes: path of phonemes.tsv
+  Returns:
+    dict from class label to list of segments
+  """
+  classes = {}
+  with open(phonemes) as stream:
+    for line in stream:
+      try:
+        clas, segment = line.split()
+      except ValueError:
+        continue
+      classes.setdefault(clas, []).append(segment)
+  return classes
+
+
+# BEGIN: class EditDistance
+class EditDistance(object):
+  """Weighted edit distance with the costs of EDIT_DISTANCE.
+  """
+  def __init__(self, grm=('%s/Grm/soundslike.grm' % _BASE),
+               phonemes=('%s/Grm/phonemes.tsv' % _BASE)):
+    self._sub = {}  # Maps a to b to the encoded cost of a:b
+    self._indel = {}  # Maps a segment to the encoded cost of deleting it
+    self._load(grm, _load_classes(phonemes))
+
+  def _set_sub(self, a, b, cost):
+    """Records a substitution in both directions, keeping the cheapest.
+    """
+    value = encode(1, cost)
+    for x, y in ((a, b), (b, a)):
+      table = self._sub.setdefault(x, {})
+      if value < table.get(y, _INF):
+        table[y] = value
+
+  def _load(self, grm, phoneme_classes):
+    """Reads the edits from the grammar.
+
+    Args:
+      grm: path of soundslike.grm
+      phoneme_classes: dict from class label to list of segments
+    Returns:
+      None
+    """
+    with open(grm) as stream:
+      text = stream.read()
+    classes = {}
+    for name, labels in re.findall(
+        r'^(\w+) = m\.Select\[(.*), m\.PHONEMES\];', text, re.M):
+      segments = []
+      for label in re.findall(r'"(\w+)"', labels):
+        segments += phoneme_classes.get(label, [])
+      classes[name] = segments
+    edits = re.search(r'^edits = Optimize\[(.*?)\]\s*;', text, re.M | re.S)
+    for line in edits.group(1).split('\n'):
+      line = line.split('#')[0].strip().lstrip('|').strip()
+      match = re.match(r'^"(.)"$', line)
+      if match:
+        self._set_sub(match.group(1), match.group(1), 0.0)
+        continue
+      match = re.match(r'^\("(.)" : "(.)" <([\d.]+)>\)$', line)
+      if match:
+        self._set_sub(match.group(1), match.group(2), float(match.group(3)))
+        continue
+      match = re.match(r'^\(D\[(\w+)\] <([\d.]+)>\)', line)
+      if match:
+        value = encode(1, float(match.group(2)))
+        for segment in classes[match.group(1)]:
+          if value < self._indel.get(segment, _INF):
+            self._indel[segment] = value
+
+  def segments(self):
+    """Lists the segments that the edits apply to.
+
+    Returns:
+      sorted list of segments
+    """
+    segments = set(self._indel)
+    for a, table in self._sub.items():
+      segments.add(a)
+      segments.update(table)
+    return sorted(segments)
+
+  def edit_cost(self, a, b):
+    """Cost of a single edit.
+
+    Args:
+      a: segment, or '' to insert b
+      b: segment, or '' to delete a
+    Returns:
+      cost, infinite if there is no such edit
+    """
+    if not a and not b:
+      return 0.0
+    if not a:
+      value = self._indel.get(b, _INF)
+    elif not b:
+      value = self._indel.get(a, _INF)
+    else:
+      value = self._sub.get(a, {}).get(b, _INF)
+    return decode(value)[1]
+
+  def metric_closure(self):
+    """Returns the EditDistance with the cheapest costs of sequences of edits.
+
+    Each edit a:b costs as little as any sequence of edits that turns a into
+    b, going through other segments or the empty string, and every segment is
+    kept at no cost. The costs of the edits then satisfy the triangle
+    inequality, so the distances are a metric, and are never more than those
+    of this EditDistance.
+
+    Returns:
+      a new EditDistance
+    """
+    segments = [''] + self.segments()
+    costs = {}
+    for a in segments:
+      for b in segments:
+        costs[a, b] = 0.0 if a == b else self.edit_cost(a, b)
+    for k in segments:
+      for a in segments:
+        for b in segments:
+          if costs[a, k] + costs[k, b] < costs[a, b]:
+            costs[a, b] = costs[a, k] + costs[k, b]
+    closure = copy.copy(self)
+    closure._sub = {}
+    closure._indel = {}
+    for (a, b), cost in costs.items():
+      if cost == _INF: continue
+      if a and b:
+        closure._sub.setdefault(a, {})[b] = encode(1, cost)
+      elif a:
+        closure._indel[a] = encode(1, cost)
+    return closure
+
+  def first_row(self, s1):
+    """Row for s1 against the empty string.
+
+    Args:
+      s1: first string
+    Returns:
+      list of len(s1) + 1 encoded values
+    """
+    row = [0.0]
+    for a in s1:
+      row.append(row[-1] + self._indel.get(a, _INF))
+    return row
+
+  def extend(self, row, s1, b):
+    """Extends a row by one segment of the second string.
+
+    Args:
+      row: row for s1 against some string t
+      s1: first string
+      b: segment following t
+    Returns:
+      row for s1 against t + b
+    """
+    indel = self._indel
+    sub = self._sub.get(b, {})
+    insert = indel.get(b, _INF)
+    new_row = [row[0] + insert]
+    previous = new_row[0]
+    for i, a in enumerate(s1):
+      value = row[i] + sub.get(a, _INF)
+      other = row[i + 1] + insert
+      if other < value: value = other
+      other = previous + indel.get(a, _INF)
+      if other < value: value = other
+      new_row.append(value)
+      previous = value
+    return new_row
+
+  def row(self, s1, s2):
+    """Row for s1 against s2.
+
+    Element i is the encoded distance between s1[:i] and s2.
+
+    Args:
+      s1: first string
+      s2: second string
+    Returns:
+      list of len(s1) + 1 encoded values
+    """
+    row = self.first_row(s1)
+    for b in s2:
+      row = self.extend(row, s1, b)
+    return row
+
+  def suffix_row(self, s1, s2):
+    """Row for the suffixes of s1 against s2.
+
+    Element i is the encoded distance between s1[i:] and s2. Since the edits
+    do not depend on direction, this is the row of the reversed strings.
+
+    Args:
+      s1: first string
+      s2: second string
+    Returns:
+      list of len(s1) + 1 encoded values
+    """
+    row = self.row(s1[::-1], s2[::-1])
+    row.reverse()
+    return row
+
+  def encoded_distance(self, s1, s2):
+    """Encoded distance between two strings.
+    """
+    return self.row(s1, s2)[-1]
+
+  def distance(self, s1, s2):
+    """Distance between two strings.
+
+    Args:
+      s1: first string
+      s2: second string
+    Returns:
+      (length, cost) as for sounds_like
+    """
+    return decode(self.encoded_distance(s1, s2))
+# END: class EditDistance
+
+
+_EDIT_DISTANCE = None
+
+
+def get_edit_distance():
+  """Returns the EditDistance for the grammar, loading it on first use.
+  """
+  global _EDIT_DISTANCE
+  if _EDIT_DISTANCE is None:
+    _EDIT_DISTANCE = EditDistance()
+  return _EDIT_DISTANCE
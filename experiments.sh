@@ -36,13 +36,21 @@ NITER=${NITER:-10}
 # Probably not a good idea to set this much above 2000 otherwise it will be too slow.
 NMORPHS=${NMORPHS:-1000}
 TIMER=time  # Unset this if you don't want the timer.
+# Set SIMULATION_SOCKET to the socket of a running daemon.py to have it do the
+# runs, rather than starting a fresh lexicon.py for each one.
+if [ -n "${SIMULATION_SOCKET}" ]
+then
+    RUN="client.py --socket=${SIMULATION_SOCKET}"
+else
+    RUN=lexicon.py
+fi
 # Make this "0 1 2 ..." for as many experiments as you want.
 EXPERIMENT_NUMS="0 1 2 3 4"
 for expt in ${EXPERIMENT_NUMS}
 do
     echo Experiment ${expt}
     mkdir -p ${dir}/${expt}
-    ${TIMER} lexicon.py \
+    ${TIMER} ${RUN} \
 	--base_morph=${BASE_MORPH} \
 	--probability_to_seek_spelling=${PROB} \
 	--initialize_non_primaries_with_symbol=${NON_PRIMARIES} \
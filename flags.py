@@ -68,6 +68,27 @@ def define_flag(option, default_value, documentation):
   __x()
 
 
+def reset_flags():
+  """Resets all the flags to their default values.
+
+  Returns:
+    None
+  """
+  for option, default_value, unused_documentation in _FLAGS:
+    function_template = set_dummy_function_template(option, default_value)
+    exec(function_template)
+    __x()
+
+
+def defined_flags():
+  """Lists the names of the flags defined so far.
+
+  Returns:
+    list of names, in the order defined
+  """
+  return [option for option, unused_default, unused_doc in _FLAGS]
+
+
 def usage():
   """Prints usage given the set of supplied flags.
 
@@ -91,7 +112,7 @@ def parse_flags(argv):
     opts, args = getopt.getopt(argv, '', optform)
   except getopt.GetoptError as err:
     print str(err)
-    Usage()
+    usage()
     sys.exit(1)
   for opt, arg in opts:
     opt = opt.replace('--', '')
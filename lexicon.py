@@ -23,20 +23,41 @@ Then runs the simulation.
 # TODO(rws): This seems to generate rather too many morphemes
 # associated with a particular concept (e.g. 36 for TEMPLE).
 
+import async_output
 import builder
+import catalog
 import concepts
+import distance_matrix
+import edit_distance
 import flags
+import gc
+import json
 import log
+import memory
+import metric_tree
+import neighbour_table
 import os
+import pron_trie
+import pynini_interface
 import random
 import re
+import run_cache
+import shared_matrix
 import sys
 import time
 
+from base import _BASE
 from pynini_interface import sounds_like
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 # Maximum distance that a closest pronunciation can have
 _MAX_DISTANCE = 0.6
+# Slack for rounding in the bound on the cost of a close pair.
+_COST_SLACK = 1e-9
 # Probability of reusing an existing spelling
 # TODO(rws): Make this a paremeter
 _PROBABILITY_TO_REUSE_SPELLING = 0.01
@@ -98,6 +119,38 @@ def _uniqify_symbol_list(symbols):
   return new_symbols
 
 
+def _weighted_cost(length, cost):
+  """Normalizes the cost of a sounds_like path by its length.
+
+  Args:
+    length: number of arcs in the path
+    cost: cost of the path
+  Returns:
+    cost per arc, or infinity for an empty path
+  """
+  try:
+    return cost / length
+  except ZeroDivisionError:
+    return float('Infinity')
+
+
+def _search_forms(morpheme):
+  """Lists the forms of a morpheme to find close prons for.
+
+  Args:
+    morpheme: a Morpheme
+  Returns:
+    list of pronunciations: the phonology, and with --ablaut_all_forms the
+    alternative phonology too
+  """
+  forms = [morpheme.phonology]
+  if flags.FLAGS_ablaut_all_forms:
+    for form in morpheme.alternative_phonology:
+      if form and form not in forms:
+        forms.append(form)
+  return forms
+
+
 def _clean_name(name):
   """Cleans up symbol name of bracketings for presentation.
 
@@ -125,13 +178,42 @@ class Lexicon(object):
     self._phonology_to_morphemes = {}
     self._semantics_to_morphemes = {}
     self._semantics_to_morphemes_primary = {}
+    self._atom_to_morphemes = {}  # Maps primitive concept ids to morphemes
     self._used_spellings = set()
     self._used_pron_spellings = set()
     self._used_sem_spellings = set()
     self._morphemes = []
-    self._matrix = {}  # Distance matrix to be used by PhonologicalDistance
+    # Counts of the rows of dump_morphemes, a row being a morpheme under one of
+    # its prons, kept up to date as the morphemes are added and spelled, and
+    # the number of rows of each morpheme.
+    self._counts = {'morphs': 0, 'spelled': 0, 'SP': 0, 'P': 0, 'S': 0}
+    self._rows = {}
+    # Distance matrix to be used by PhonologicalDistance
+    self._matrix = distance_matrix.DictMatrix()
+    self._shared_matrix = None  # Optional SharedDistanceTable behind _matrix
+    self._neighbour_table = None  # Optional precomputed close prons
+    self._metric_index = None  # Optional metric_tree.BKTree of useful prons
     self._phonetics_frozen = False
     self._semantics_frozen = False
+    # Symbols available from each pronunciation and concept, built on demand
+    # and dropped when a morpheme under the key is added or respelled.
+    self._pron_symbols = {}
+    self._sem_symbols = {}
+    # Concepts whose current symbols have been added to _used_sem_spellings.
+    self._registered_sem_symbols = set()
+    # The subsets of the above allowed once phonetics or semantics are frozen.
+    self._allowed_pron_symbols = {}
+    self._allowed_sem_symbols = {}
+    # Useful pronunciations in the order they became useful.
+    self._useful_order = []
+    self._useful_seen = set()
+    # Unspelled morphemes whose last search found no spelling short enough,
+    # with the number of useful prons then known and the prons and concepts
+    # whose symbols the search used, and the morphemes blocked on each of
+    # these prons and concepts. See _is_blocked.
+    self._blocked = {}
+    self._blocked_by_pron = {}
+    self._blocked_by_sem = {}
 
   def add_morpheme(self, morpheme):
     """Adds a morpheme to the lexicon.
@@ -148,16 +230,278 @@ class Lexicon(object):
       self._phonology_to_morphemes[phonology].append(morpheme)
     else:
       self._phonology_to_morphemes[phonology] = [morpheme]
+    self._add_row(morpheme)
     if semantics.name in self._semantics_to_morphemes:
       self._semantics_to_morphemes[semantics.name].append(morpheme)
     else:
       self._semantics_to_morphemes[semantics.name] = [morpheme]
     if morpheme.is_primary:
       self._semantics_to_morphemes_primary[semantics.name] = morpheme
+    for atom_id in semantics.atom_ids:
+      self._atom_to_morphemes.setdefault(atom_id, []).append(morpheme)
     if spelling:
       str_spelling = str(spelling)
       self._used_spellings.add(str_spelling)
     self._morphemes.append(morpheme)
+    morpheme.set_lexicon(self)
+    self._invalidate_pron(phonology)
+    self._invalidate_sem(semantics.name)
+
+  def add_morphemes(self, morphemes):
+    """Adds many morphemes to the lexicon at once.
+
+    Leaves the lexicon as adding each with add_morpheme would, but fills the
+    tables in one pass and drops the symbols stored for each pron and concept
+    only once.
+
+    Args:
+      morphemes: sequence of Morpheme instances
+    Returns:
+      None
+    """
+    morphemes = list(morphemes)
+    phonology_to_morphemes = self._phonology_to_morphemes
+    semantics_to_morphemes = self._semantics_to_morphemes
+    semantics_to_morphemes_primary = self._semantics_to_morphemes_primary
+    atom_to_morphemes = self._atom_to_morphemes
+    rows = self._rows
+    # The lists of each concept and of its primitives, looked up once.
+    concept_lists = {}
+    for morpheme in morphemes:
+      phonology_to_morphemes.setdefault(morpheme.phonology, []).append(morpheme)
+      semantics = morpheme.semantics
+      lists = concept_lists.get(semantics)
+      if lists is None:
+        lists = [semantics_to_morphemes.setdefault(semantics.name, [])]
+        for atom_id in semantics.atom_ids:
+          lists.append(atom_to_morphemes.setdefault(atom_id, []))
+        concept_lists[semantics] = lists
+      for morphemes_list in lists:
+        morphemes_list.append(morpheme)
+      if morpheme.is_primary:
+        semantics_to_morphemes_primary[semantics.name] = morpheme
+      rows[morpheme] = rows.get(morpheme, 0) + 1
+      spelling = morpheme.symbol
+      if spelling:
+        self._count_spelling(spelling, 1)
+        self._used_spellings.add(str(spelling))
+      morpheme.set_lexicon(self)
+    self._morphemes.extend(morphemes)
+    self._counts['morphs'] += len(morphemes)
+    # Only the prons and concepts with something stored need invalidating,
+    # which for a new lexicon is none of them.
+    stored = set(self._pron_symbols).union(self._allowed_pron_symbols,
+                                           self._blocked_by_pron)
+    if stored:
+      for pron in stored.intersection(m.phonology for m in morphemes):
+        self._invalidate_pron(pron)
+    stored = set(self._sem_symbols).union(self._registered_sem_symbols,
+                                          self._allowed_sem_symbols,
+                                          self._blocked_by_sem)
+    if stored:
+      for sem in stored.intersection(m.semantics.name for m in morphemes):
+        self._invalidate_sem(sem)
+
+  def _invalidate_pron(self, pron):
+    """Drops the symbols stored for a pronunciation.
+
+    Args:
+      pron: pronunciation
+    Returns:
+      None
+    """
+    self._pron_symbols.pop(pron, None)
+    self._allowed_pron_symbols.pop(pron, None)
+    for morpheme in list(self._blocked_by_pron.get(pron, ())):
+      self._unblock(morpheme)
+
+  def _invalidate_sem(self, sem):
+    """Drops the symbols stored for a concept.
+
+    Args:
+      sem: concept name
+    Returns:
+      None
+    """
+    self._sem_symbols.pop(sem, None)
+    self._registered_sem_symbols.discard(sem)
+    self._allowed_sem_symbols.pop(sem, None)
+    for morpheme in list(self._blocked_by_sem.get(sem, ())):
+      self._unblock(morpheme)
+
+  def _block(self, morpheme, prons, sems):
+    """Records that a search found no spelling for a morpheme.
+
+    Args:
+      morpheme: an unspelled Morpheme
+      prons: prons whose symbols the search used
+      sems: concepts whose symbols the search used
+    Returns:
+      None
+    """
+    self._blocked[morpheme] = [len(self._useful_order), prons, sems]
+    for pron in prons:
+      self._blocked_by_pron.setdefault(pron, set()).add(morpheme)
+    for sem in sems:
+      self._blocked_by_sem.setdefault(sem, set()).add(morpheme)
+
+  def _unblock(self, morpheme):
+    """Forgets that a morpheme was blocked, if it was.
+
+    Args:
+      morpheme: a Morpheme
+    Returns:
+      None
+    """
+    try:
+      unused_position, prons, sems = self._blocked.pop(morpheme)
+    except KeyError:
+      return
+    for pron in prons:
+      self._blocked_by_pron[pron].discard(morpheme)
+      if not self._blocked_by_pron[pron]:
+        del self._blocked_by_pron[pron]
+    for sem in sems:
+      self._blocked_by_sem[sem].discard(morpheme)
+      if not self._blocked_by_sem[sem]:
+        del self._blocked_by_sem[sem]
+
+  def _is_blocked(self, morpheme, distance):
+    """Whether a search for a spelling for morpheme would still find none.
+
+    The search finds no spelling as long as the symbols of the prons and
+    concepts it used stay the same, which the invalidations above watch, and
+    no pron that has become useful since, alone or telescoped, is close to
+    any of the forms searched with.
+
+    Args:
+      morpheme: an unspelled Morpheme
+      distance: the PhonologicalDistance of this iteration
+    Returns:
+      True if the search can be skipped
+    """
+    if morpheme not in self._blocked:
+      return False
+    blocked = self._blocked[morpheme]
+    new_prons = self._useful_order[blocked[0]:]
+    if new_prons:
+      for form in _search_forms(morpheme):
+        if distance.any_close(form, new_prons):
+          self._unblock(morpheme)
+          return False
+    blocked[0] = len(self._useful_order)
+    return True
+
+  def _count_spelling(self, spelling, rows):
+    """Adds rows spelled with a spelling to the counts.
+
+    Args:
+      spelling: a Symbol, or None
+      rows: number of rows, negative to take them away
+    Returns:
+      None
+    """
+    if not spelling: return
+    self._counts['spelled'] += rows
+    self._counts[spelling.type()] += rows
+
+  def _add_row(self, morpheme):
+    """Counts a new row for a morpheme.
+
+    Args:
+      morpheme: a Morpheme in this lexicon
+    Returns:
+      None
+    """
+    self._rows[morpheme] = self._rows.get(morpheme, 0) + 1
+    self._counts['morphs'] += 1
+    self._count_spelling(morpheme.symbol, 1)
+
+  def counts(self):
+    """Returns the counts that stats.py makes from a dump of the morphemes.
+
+    Returns:
+      dict with the number of rows ("morphs"), of spelled rows ("spelled"),
+      and of rows spelled semantic-phonetically ("semphon"), phonetically
+      ("phon") and semantically ("sem")
+    """
+    return {'morphs': self._counts['morphs'],
+            'spelled': self._counts['spelled'],
+            'semphon': self._counts['SP'],
+            'phon': self._counts['P'],
+            'sem': self._counts['S']}
+
+  def spelling_changed(self, morpheme, old_spelling=None):
+    """Updates the symbol tables after a morpheme gets a new spelling.
+
+    Args:
+      morpheme: a Morpheme in this lexicon
+      old_spelling: the previous spelling, if any
+    Returns:
+      None
+    """
+    rows = self._rows.get(morpheme, 0)
+    self._count_spelling(old_spelling, -rows)
+    self._count_spelling(morpheme.symbol, rows)
+    self._unblock(morpheme)
+    self._invalidate_pron(morpheme.phonology)
+    for phonology in morpheme.alternative_phonology:
+      self._invalidate_pron(phonology)
+    self._invalidate_sem(morpheme.semantics.name)
+
+  def _add_used_pron_spelling(self, spelling):
+    """Records a spelling as used phonetically.
+
+    Args:
+      spelling: a Symbol
+    Returns:
+      None
+    """
+    self._used_pron_spellings.add(str(spelling))
+    # This may allow the symbol for its pronunciation when frozen.
+    self._allowed_pron_symbols.pop(spelling.denotation, None)
+    for morpheme in list(self._blocked_by_pron.get(spelling.denotation, ())):
+      self._unblock(morpheme)
+
+  def set_matrix(self, matrix):
+    """Sets the distance matrix, e.g. to one kept from previous runs.
+
+    Args:
+      matrix: a store from distance_matrix
+    Returns:
+      None
+    """
+    self._matrix = matrix
+
+  def set_shared_matrix(self, shared_matrix):
+    """Sets a distance table shared with other processes.
+
+    Args:
+      shared_matrix: a shared_matrix.SharedDistanceTable
+    Returns:
+      None
+    """
+    self._shared_matrix = shared_matrix
+
+  def set_neighbour_table(self, table):
+    """Sets the precomputed close prons of the morphs.
+
+    Args:
+      table: a neighbour_table.NeighbourTable
+    Returns:
+      None
+    """
+    self._neighbour_table = table
+
+  def set_metric_index(self, index):
+    """Sets the metric tree to find the close useful prons with.
+
+    Args:
+      index: an empty metric_tree.BKTree
+    Returns:
+      None
+    """
+    self._metric_index = index
 
   def find_morphemes(self, key):
     """Finds morphemes by sound or meaning.
@@ -176,6 +520,64 @@ class Lexicon(object):
     except KeyError:
       return []
 
+  def find_morphemes_with_atom(self, atom):
+    """Finds the morphemes whose meaning includes a primitive concept.
+
+    Args:
+      atom: primitive concept, e.g. "@MAN"
+    Returns:
+      list of morphemes, which must not be modified
+    """
+    return self._atom_to_morphemes.get(concepts.atom_id(atom), [])
+
+  def find_overlapping_morphemes(self, concept, min_overlap=1):
+    """Finds the morphemes whose meaning shares primitives with a concept.
+
+    A morpheme sharing min_overlap of the n primitives is indexed under all
+    but at most n - min_overlap of them, so only the n - min_overlap + 1
+    shortest lists of the index need to be searched.
+
+    Args:
+      concept: a Concept
+      min_overlap: smallest number of shared primitives, at least 1
+    Returns:
+      list of (morpheme, number of shared primitives), most shared first
+    """
+    lists = sorted((self._atom_to_morphemes.get(atom_id, ())
+                    for atom_id in concept.atom_ids), key=len)
+    result = []
+    seen = set()
+    for morphemes in lists[:len(lists) - min_overlap + 1]:
+      for morpheme in morphemes:
+        if morpheme in seen: continue
+        seen.add(morpheme)
+        overlap = concept.overlap(morpheme.semantics)
+        if overlap >= min_overlap:
+          result.append((morpheme, overlap))
+    result.sort(key=lambda x: -x[1])
+    return result
+
+  def _morphemes_with_meaning(self, sem):
+    """Finds the morphemes whose meaning is exactly sem through the index.
+
+    The index lists the morphemes of each primitive in the order they were
+    added, so the morphemes are found in the same order as in
+    _semantics_to_morphemes.
+
+    Args:
+      sem: concept name
+    Returns:
+      list of morphemes
+    """
+    if ',' in sem:
+      concept = Concept(sem)
+      found = [morpheme for morpheme, unused_overlap in
+               self.find_overlapping_morphemes(concept,
+                                               len(concept.atom_ids))]
+    else:
+      found = self.find_morphemes_with_atom(sem)
+    return [morpheme for morpheme in found if morpheme.semantics.name == sem]
+
   def apply_ablaut(self):
     """Applies an ablauting operation to all of the morphs.
 
@@ -198,8 +600,11 @@ class Lexicon(object):
         if phonology in self._phonology_to_morphemes:
           if morpheme not in self._phonology_to_morphemes[phonology]:
             self._phonology_to_morphemes[phonology].append(morpheme)
+            self._add_row(morpheme)
         else:
           self._phonology_to_morphemes[phonology] = [morpheme]
+          self._add_row(morpheme)
+        self._invalidate_pron(phonology)
       i += 1
     # Finally unmark all the morphemes
     for key in self._phonology_to_morphemes:
@@ -219,10 +624,20 @@ class Lexicon(object):
       stream = open(outfile, 'w')
     for key in self._phonology_to_morphemes:
       for morpheme in self._phonology_to_morphemes[key]:
-        stream.write('%s\t%s\t%s\n' % (key, morpheme.symbol_name(), morpheme))
+        stream.write('%s\t%s\n' % (key, morpheme.describe(morpheme.symbol)))
     if outfile:
       stream.close()
 
+  def snapshot(self):
+    """Notes the current spellings, for writing out later.
+
+    Returns:
+      list of (pron, morpheme, spelling) in the order of dump_morphemes
+    """
+    return [(key, morpheme, morpheme.symbol)
+            for key in self._phonology_to_morphemes
+            for morpheme in self._phonology_to_morphemes[key]]
+
   def pronunciations(self):
     """Returns all pronunciations.
     """
@@ -260,42 +675,103 @@ class Lexicon(object):
     """
     return list(self._used_spellings)
 
-  def get_symbols_from_pron(self, pron):
-    """Finds and returns all symbols associated with this pronunciation.
+  def _phonetic_symbols(self, pron):
+    """Returns the symbols of the morphemes with this pronunciation.
 
-    Converts these to phonological components.
+    The symbols are converted to phonological components, and are stored until
+    a morpheme with the pronunciation changes.
+
+    Args:
+      pron: pronunciation, which must be in the lexicon
+    Returns:
+      list of Symbol, which must not be modified
     """
-    if pron not in self._phonology_to_morphemes: return []
+    try:
+      return self._pron_symbols[pron]
+    except KeyError:
+      pass
     result = []
     for morpheme in self._phonology_to_morphemes[pron]:
       if morpheme.symbol:
         symbol = Symbol(morpheme.symbol.name, pron)
-        if (self._phonetics_frozen and
-            str(symbol) not in self._used_pron_spellings):
-          log.log('Disallowing use of {} as phonetic'.format(str(symbol)))
-          continue
         symbol._colored_name = _phonetic_color(morpheme.symbol.colored_name)
         result.append(symbol)
-    return _uniqify_symbol_list(result)
+    symbols = self._pron_symbols[pron] = _uniqify_symbol_list(result)
+    return symbols
 
-  def get_symbols_from_sem(self, sem):
-    """Finds and returns all symbols associated with this meaning.
+  def _semantic_symbols(self, sem):
+    """Returns the symbols of the morphemes with this meaning.
+
+    The morphemes are found through the index of primitives, and the symbols
+    are stored until a morpheme with the meaning changes.
+
+    Args:
+      sem: concept name, which must be in the lexicon
+    Returns:
+      list of Symbol, which must not be modified
     """
-    if sem not in self._semantics_to_morphemes: return []
+    try:
+      return self._sem_symbols[sem]
+    except KeyError:
+      pass
     result = []
-    for morpheme in self._semantics_to_morphemes[sem]:
+    for morpheme in self._morphemes_with_meaning(sem):
       if morpheme.symbol:
         symbol = Symbol(morpheme.symbol.name, sem)
-        if (self._semantics_frozen and
-            str(symbol) not in self._used_sem_spellings):
-          log.log('Disallowing use of {} as semantic'.format(str(symbol)))
-          continue
         symbol._colored_name = _semantic_color(morpheme.symbol.colored_name)
+        result.append(symbol)
+    symbols = self._sem_symbols[sem] = _uniqify_symbol_list(result)
+    return symbols
+
+  def get_symbols_from_pron(self, pron):
+    """Finds and returns all symbols associated with this pronunciation.
+
+    Converts these to phonological components. The returned list must not be
+    modified.
+    """
+    if pron not in self._phonology_to_morphemes: return []
+    if not self._phonetics_frozen:
+      return self._phonetic_symbols(pron)
+    try:
+      return self._allowed_pron_symbols[pron]
+    except KeyError:
+      pass
+    allowed = []
+    for symbol in self._phonetic_symbols(pron):
+      if str(symbol) not in self._used_pron_spellings:
+        log.log('Disallowing use of {} as phonetic'.format(str(symbol)))
+        continue
+      allowed.append(symbol)
+    self._allowed_pron_symbols[pron] = allowed
+    return allowed
+
+  def get_symbols_from_sem(self, sem):
+    """Finds and returns all symbols associated with this meaning.
+
+    The returned list must not be modified.
+    """
+    if sem not in self._semantics_to_morphemes: return []
+    if not self._semantics_frozen:
+      symbols = self._semantic_symbols(sem)
+      if sem not in self._registered_sem_symbols:
         # TODO(rws): This needs to be reworked since we don't necessarily "use"
         # this below, so it could be returned to be recycled.
-        self._used_sem_spellings.add(str(symbol))
-        result.append(symbol)
-    return _uniqify_symbol_list(result)
+        for symbol in symbols:
+          self._used_sem_spellings.add(str(symbol))
+        self._registered_sem_symbols.add(sem)
+      return symbols
+    try:
+      return self._allowed_sem_symbols[sem]
+    except KeyError:
+      pass
+    allowed = []
+    for symbol in self._semantic_symbols(sem):
+      if str(symbol) not in self._used_sem_spellings:
+        log.log('Disallowing use of {} as semantic'.format(str(symbol)))
+        continue
+      allowed.append(symbol)
+    self._allowed_sem_symbols[sem] = allowed
+    return allowed
 
   def generate_new_spellings(self):
     """Generates new spellings with some probability for each morpheme.
@@ -308,29 +784,48 @@ class Lexicon(object):
     """
     useful_pronunciations = self.useful_pronunciations()
     log.log('# of useful pronunciations = %d' % len(useful_pronunciations))
-    distance = PhonologicalDistance(useful_pronunciations, self._matrix)
+    for pron in useful_pronunciations:
+      if pron not in self._useful_seen:
+        self._useful_seen.add(pron)
+        self._useful_order.append(pron)
+        if self._metric_index is not None:
+          self._metric_index.add(pron)
+    distance = PhonologicalDistance(useful_pronunciations, self._matrix,
+                                    self._shared_matrix,
+                                    flags.FLAGS_distance_mode,
+                                    self._neighbour_table,
+                                    self._metric_index)
     morphemes_without_symbols = []
     for morpheme in self._morphemes:
       if not morpheme.symbol:
         morphemes_without_symbols.append(morpheme)
     log.log('# of morphemes without symbols = %d' %
             len(morphemes_without_symbols))
+    skip_blocked = flags.FLAGS_skip_blocked_morphemes
     init_time = time.clock()
     for morpheme in morphemes_without_symbols:
       init_time = time.clock()
       if random.random() < flags.FLAGS_probability_to_seek_spelling:
-        ## TODO(rws): at some point we should add in the alternative phonology
-        ## for ablauted forms, otherwise those will never participate: actually
-        ## not completely true since the ablauted forms do inherit from the base
-        ## form so that an ablauted form "work" might be spelled based on the
-        ## phonology of the base form "werk"
         pron = morpheme.phonology
         if pron == '': continue  # Shouldn't happen
-        close_prons = distance.closest_prons(pron)
+        # Nothing else is drawn when no spelling is found, so skipping the
+        # search leaves the random choices as they were.
+        if skip_blocked and self._is_blocked(morpheme, distance): continue
+        # With ablaut_all_forms, the ablauted forms are also used to find
+        # close prons. Otherwise they only take part through the base form,
+        # from which they inherit: an ablauted form "work" might be spelled
+        # based on the phonology of the base form "werk".
+        forms = _search_forms(morpheme)
+        if len(forms) > 1:
+          close_prons = distance.closest_prons_multi(forms)
+        else:
+          close_prons = distance.closest_prons(pron)
         phonological_spellings = []
         spelling_to_pron = {}  # Stores pron associated w/ each new spelling
+        searched_prons = set()
         for close_pron, unused_cost in close_prons:
           prons = close_pron.split('.')
+          searched_prons.update(prons)
           if len(prons) == 1:  # A single pronunciation
             spellings = self.get_symbols_from_pron(prons[0])
             for spelling in spellings:
@@ -347,11 +842,13 @@ class Lexicon(object):
                 spelling_to_pron[spelling.name] = close_pron
         concept = morpheme.semantics
         semantic_spellings = []
-        for sem in concept.name.split(','):
+        for sem in concept.atoms:
           semantic_spellings += self.get_symbols_from_sem(sem)
+        searched_sems = set(concept.atoms)
         # Also tries the whole composite concept:
-        if ',' in concept.name:
+        if len(concept.atoms) > 1:
           semantic_spellings += self.get_symbols_from_sem(concept.name)
+          searched_sems.add(concept.name)
         new_spellings = phonological_spellings + semantic_spellings
         log_string = '\n>>>>>>>>>>>>>>>>>>>>>>>>>\n'
         log_string += 'For morpheme: %s, %s:\n' % (concept, pron)
@@ -379,6 +876,8 @@ class Lexicon(object):
         for sp in new_spellings:
           if len(sp) < 5: tmp.append(sp)
         new_spellings = tmp
+        if skip_blocked and not new_spellings:
+          self._block(morpheme, searched_prons, searched_sems)
         random.shuffle(new_spellings)
         # Whereas with this setting, commented out for now, always favoring the
         # absolute shortest, semphon is much lower for 1000, though if you
@@ -398,12 +897,36 @@ class Lexicon(object):
             log_string = 'Spelling: %s\t' % spelling
             log_string += 'Morpheme: %s\t' % str(morpheme)
             if pron:
-              self._used_pron_spellings.add(str(spelling))
+              self._add_used_pron_spelling(spelling)
               log_string += 'Source-pronunciation: %s\t' % pron
             if reuse:
               log_string += 'Reuse'
             log.log(log_string)
             break
+    if self._metric_index is not None:
+      queries, evaluations, possible = self._metric_index.take_stats()
+      if queries:
+        log.log('Metric index: %d queries, %.1f of %.1f costs avoided per '
+                'query' % (queries, float(possible - evaluations) / queries,
+                           float(possible) / queries))
+    stats = distance.trie_stats()
+    if stats and stats[0]:
+      queries, rows, possible = stats
+      log.log('Trie: %d queries, %.1f of %.1f rows computed per query' % (
+        queries, float(rows) / queries, float(possible) / queries))
+
+  def pron_to_symbol_map(self):
+    """Pairs each pron with the symbols of the morphemes it spells.
+
+    Returns:
+      list of (symbol string, pron)
+    """
+    pairs = []
+    for pron in self._phonology_to_morphemes:
+      for morpheme in self._phonology_to_morphemes[pron]:
+        if morpheme.symbol:
+          pairs.append(('{}'.format(morpheme.symbol), pron))
+    return pairs
 
   def log_pron_to_symbol_map(self):
     """Adds pron/symbol mapping for the (usually final) lexicon.
@@ -411,20 +934,76 @@ class Lexicon(object):
     Returns:
       None
     """
-    for pron in self._phonology_to_morphemes:
-      for morpheme in self._phonology_to_morphemes[pron]:
-        if morpheme.symbol:
-          log.log('SYMBOL:\t{}\t{}'.format(morpheme.symbol, pron))
+    for symbol, pron in self.pron_to_symbol_map():
+      log.log('SYMBOL:\t{}\t{}'.format(symbol, pron))
+
+  def nbytes(self):
+    """Estimates the memory held by the parts of the lexicon.
+
+    Objects shared between parts are counted under the first: the morphemes
+    hold the strings and concepts also used by the indexes.
+
+    Returns:
+      dict from component to bytes, as in memory.component_sizes
+    """
+    seen = set([id(self)])
+    return {
+      'matrix': self._matrix.nbytes(),
+      'morphemes': memory.nbytes(self._morphemes, seen),
+      'indexes': sum(memory.nbytes(index, seen) for index in (
+        self._phonology_to_morphemes, self._semantics_to_morphemes,
+        self._semantics_to_morphemes_primary, self._atom_to_morphemes,
+        self._rows)),
+      'used_spellings': sum(memory.nbytes(spellings, seen) for spellings in (
+        self._used_spellings, self._used_pron_spellings,
+        self._used_sem_spellings)),
+      'symbol_caches': sum(memory.nbytes(cache, seen) for cache in (
+        self._pron_symbols, self._sem_symbols, self._allowed_pron_symbols,
+        self._allowed_sem_symbols, self._registered_sem_symbols)),
+      'metric_index': memory.nbytes(self._metric_index, seen),
+    }
+
+  def cached_symbol_count(self):
+    """Number of symbols in the caches that drop_symbol_caches drops.
+
+    Returns:
+      int
+    """
+    return (sum(len(symbols) for symbols in self._pron_symbols.itervalues()) +
+            sum(len(symbols) for symbols in self._sem_symbols.itervalues()))
+
+  def drop_symbol_caches(self):
+    """Drops the symbols stored per pron and concept, to save memory.
+
+    The allowed symbols once frozen are kept, since working them out again
+    would log the disallowed ones again.
+
+    Returns:
+      None
+    """
+    self._pron_symbols = {}
+    self._sem_symbols = {}
 
   def freeze_phonetics(self):
     """Freezes the phonetics.
     """
     self._phonetics_frozen = True
+    self._allowed_pron_symbols = {}
+    self._clear_blocked()
 
   def freeze_semantics(self):
     """Freezes the semantics.
     """
     self._semantics_frozen = True
+    self._allowed_sem_symbols = {}
+    self._clear_blocked()
+
+  def _clear_blocked(self):
+    """Forgets the blocked morphemes, whose searches now work differently.
+    """
+    self._blocked = {}
+    self._blocked_by_pron = {}
+    self._blocked_by_sem = {}
 # END: class Lexicon
 
 
@@ -438,21 +1017,25 @@ class Morpheme(object):
     self._alternative_phonology = []  # For ablauted forms, etc
     self._semantics = semantics
     self._symbol = symbol
-    # set representation of semantics
-    self._semantics_set = set(semantics.name.split(','))
     self._is_primary = is_primary  # Is the primary exponent of this concept
+    self._lexicon = None  # Lexicon to tell about changes of spelling
     # Book-keeping placeholder to mark whether an operation has applied:
     self._marked = False  
 
   def __repr__(self):
+    return self._props(self._symbol)
+
+  def _props(self, spelling):
+    """Formats the morpheme as if spelled with spelling.
+    """
     alternative_phonology = ''
     if self._alternative_phonology:
       alternative_phonology = '(%s)' % ','.join(self._alternative_phonology)
     symbol = ''
-    if self._symbol:
-      symbol = '<%s:%s:%s>' % (str(self._symbol),
-                               self._symbol.symbols(),
-                               self._symbol.type())
+    if spelling:
+      symbol = '<%s:%s:%s>' % (str(spelling),
+                               spelling.symbols(),
+                               spelling.type())
     props = '{%s%s:%s:%s:%d}' % (self._phonology,
                                  alternative_phonology,
                                  str(self._semantics).replace('@', ''),
@@ -460,10 +1043,31 @@ class Morpheme(object):
                                  self._is_primary)
     return props
 
+  def describe(self, spelling):
+    """Formats the symbol and morpheme as in dump_morphemes.
+
+    Takes the spelling as an argument so that a morpheme can be written out
+    as it was when its spelling was noted, e.g. by Lexicon.snapshot.
+
+    Args:
+      spelling: a Symbol, or None
+    Returns:
+      string
+    """
+    if spelling:
+      symbol_name = spelling.colored_name
+    else:
+      symbol_name = '<NO_SYMBOL>'
+    return '%s\t%s' % (symbol_name, self._props(spelling))
+
   @property
   def phonology(self):
     return self._phonology
 
+  @property
+  def alternative_phonology(self):
+    return self._alternative_phonology
+
   @property
   def semantics(self):
     return self._semantics
@@ -493,14 +1097,20 @@ class Morpheme(object):
     self._marked = False
 
   def has_semantics(self, semantics):
-    return semantics in self._semantics_set
+    return semantics in self._semantics.atom_set
 
   def add_alternative_phonology(self, phonology):
     if phonology not in self._alternative_phonology:
       self._alternative_phonology.append(phonology)
 
+  def set_lexicon(self, lexicon):
+    self._lexicon = lexicon
+
   def set_spelling(self, spelling):
+    old_spelling = self._symbol
     self._symbol = spelling
+    if self._lexicon:
+      self._lexicon.spelling_changed(self, old_spelling)
 # END: class Morpheme
 
 # BEGIN: class Concept
@@ -509,8 +1119,18 @@ class Concept(object):
   """
   def __init__(self, name):
     """name is a comma-separated set of primitives.
+
+    The primitives are kept in order, as a set, and as a bitset of their ids
+    in concepts, so that they need not be worked out from the name again.
     """
     self._name = name
+    self._atoms = tuple(intern(atom) for atom in name.split(','))
+    self._atom_set = frozenset(self._atoms)
+    self._atom_ids = tuple(sorted(concepts.atom_id(atom)
+                                  for atom in self._atom_set))
+    self._bits = 0
+    for atom_id in self._atom_ids:
+      self._bits |= 1 << atom_id
 
   def __repr__(self):
     return self._name
@@ -518,6 +1138,33 @@ class Concept(object):
   @property
   def name(self):
     return self._name
+
+  @property
+  def atoms(self):
+    """The primitives in the order of the name.
+    """
+    return self._atoms
+
+  @property
+  def atom_set(self):
+    return self._atom_set
+
+  @property
+  def atom_ids(self):
+    """Sorted ids of the primitives.
+    """
+    return self._atom_ids
+
+  @property
+  def bits(self):
+    """Bitset of the ids of the primitives.
+    """
+    return self._bits
+
+  def overlap(self, other):
+    """Number of primitives shared with another concept.
+    """
+    return bin(self._bits & other.bits).count('1')
 # END: class Concept
 
 # BEGIN: class Symbol
@@ -595,9 +1242,15 @@ class Symbol(object):
 class LexiconGenerator(object):
   """Generator for lexicon with specified number of morphs and base morph type.
   """
-  def __init__(self, nmorphs = 5000, base_morph = 'MONOSYLLABLE'):
+  def __init__(self, nmorphs = 5000, base_morph = 'MONOSYLLABLE', seed = None,
+               inventory = None):
+    """inventory is a dict from concepts to graphical forms, by default
+    concepts.CONCEPTS.
+    """
     self._nmorphs = nmorphs
     self._base_morph = base_morph
+    self._seed = seed
+    self._inventory = inventory
     self._initial = True
 
   def select_morphs(self, morphs):
@@ -628,24 +1281,38 @@ class LexiconGenerator(object):
     num_concepts = random.choice([1, 2, 3])
     return ','.join(random.sample(concepts, num_concepts))
 
-  def generate(self, force = False):
-    """Generates and returns a lexicon.
+  def _generate_morphs(self, force):
+    """Builds the grammars if needed and generates the morphs.
 
     Args:
       force: if True then force building of the grammars.
     Returns:
-      a Lexicon
+      list of morphs
     """
     if self._initial or force:
       builder.build_morphology_grammar()
       builder.build_soundslike_grammar()
-    morphs = builder.generate_morphs(self._base_morph, self._nmorphs)
+    return builder.generate_morphs(self._base_morph, self._nmorphs,
+                                   seed=self._seed)
+
+  def generate(self, force = False):
+    """Generates and returns a lexicon.
+
+    Args:
+      force: if True then force building of the grammars.
+    Returns:
+      a Lexicon
+    """
+    morphs = self._generate_morphs(force)
     nth_concept = 0
     # Gets the concepts
-    concepts_ = concepts.CONCEPTS
+    concepts_ = self._inventory or concepts.CONCEPTS
+    concept_names = concepts_.keys()
+    # Morphemes with the same meaning share a Concept.
+    concept_objects = {}
     lexicon = Lexicon()
     seen_morphs = set()
-    for concept in concepts_.keys():
+    for concept in concept_names:
       selections = self.select_morphs(morphs)
       is_primary = True
       for morph in selections:
@@ -657,8 +1324,10 @@ class LexiconGenerator(object):
         my_symbol = None
         if is_primary or flags.FLAGS_initialize_non_primaries_with_symbol:
           my_symbol = Symbol(concepts_[concept], concept)
+        if concept not in concept_objects:
+          concept_objects[concept] = Concept(concept)
         lexicon.add_morpheme(Morpheme(morph,
-                                      Concept(concept),
+                                      concept_objects[concept],
                                       my_symbol,
                                       is_primary))
         is_primary = False
@@ -667,24 +1336,187 @@ class LexiconGenerator(object):
     combinations = set()
     for morph in morphs:
       if morph in seen_morphs: continue
-      concept = self.concept_combinations(concepts_.keys())
+      concept = self.concept_combinations(concept_names)
+      if concept not in concept_objects:
+        concept_objects[concept] = Concept(concept)
       lexicon.add_morpheme(Morpheme(morph,
-                                    Concept(concept),
+                                    concept_objects[concept],
                                     None,
                                     False if concept in combinations else True))
       combinations.add(concept)
     return lexicon
+
+  def generate_bulk(self, force = False):
+    """Generates and returns a lexicon, drawing the concepts with NumPy.
+
+    The concepts are drawn as by generate, from the same distributions, but
+    all at once, and the morphemes are added with Lexicon.add_morphemes. The
+    draws differ from those of generate, so the same seed gives a different
+    lexicon.
+
+    Args:
+      force: if True then force building of the grammars.
+    Returns:
+      a Lexicon
+    """
+    if numpy is None:
+      raise ImportError('Bulk generation of the lexicon needs numpy')
+    morphs = self._generate_morphs(force)
+    # The objects made here all last, so collecting garbage as they are made
+    # would only go through them again and again.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+      return self._generate_bulk(morphs)
+    finally:
+      if collecting:
+        gc.enable()
+
+  def _generate_bulk(self, morphs):
+    """Draws the concepts of the morphs for generate_bulk.
+
+    Args:
+      morphs: list of morphs
+    Returns:
+      a Lexicon
+    """
+    state = numpy.random.RandomState(self._seed)
+    concepts_ = self._inventory or concepts.CONCEPTS
+    concept_names = concepts_.keys()
+    nconcepts = len(concept_names)
+    concept_objects = {}
+    morphemes = []
+    # Each base concept gets one to three draws among the morphs, the first
+    # distinct one being its primary exponent.
+    nselections = state.randint(1, 4, size=nconcepts).tolist()
+    selections = state.randint(0, len(morphs), size=(nconcepts, 3)).tolist()
+    seen_morphs = set()
+    for concept, n, selection in zip(concept_names, nselections, selections):
+      concept_object = Concept(concept)
+      concept_objects[concept] = concept_object
+      is_primary = True
+      selected = set()
+      for j in selection[:n]:
+        morph = morphs[j]
+        if morph in selected: continue
+        selected.add(morph)
+        seen_morphs.add(morph)
+        my_symbol = None
+        if is_primary or flags.FLAGS_initialize_non_primaries_with_symbol:
+          my_symbol = Symbol(concepts_[concept], concept)
+        morphemes.append(Morpheme(morph, concept_object, my_symbol,
+                                  is_primary))
+        is_primary = False
+    # The other morphs each get a sample of one to three distinct concepts,
+    # no more than there are: the second and third are drawn among those left
+    # and moved past the ones already taken.
+    rest = [morph for morph in morphs if morph not in seen_morphs]
+    size = len(rest)
+    nsampled = state.randint(1, min(nconcepts, 3) + 1, size=size)
+    first = state.randint(0, nconcepts, size=size)
+    if nconcepts > 1:
+      second = state.randint(0, nconcepts - 1, size=size)
+      second += second >= first
+    else:
+      second = numpy.full(size, -1, dtype=first.dtype)
+    if nconcepts > 2:
+      third = state.randint(0, nconcepts - 2, size=size)
+      third += third >= numpy.minimum(first, second)
+      third += third >= numpy.maximum(first, second)
+    else:
+      third = numpy.full(size, -1, dtype=first.dtype)
+    second[nsampled < 2] = -1
+    third[nsampled < 3] = -1
+    # Samples are numbered so that the morphs sharing one share a Concept,
+    # which is primary for the first of them.
+    base = nconcepts + 1
+    codes = (first.astype(numpy.int64) * base + second + 1) * base + third + 1
+    unused_codes, first_uses, samples = numpy.unique(
+      codes, return_index=True, return_inverse=True)
+    sample_objects = []
+    drawn = numpy.column_stack((first, second, third))[first_uses].tolist()
+    for sample in drawn:
+      concept = ','.join(concept_names[k] for k in sample if k >= 0)
+      if concept not in concept_objects:
+        concept_objects[concept] = Concept(concept)
+      sample_objects.append(concept_objects[concept])
+    is_primary = numpy.zeros(size, dtype=bool)
+    is_primary[first_uses] = True
+    for morph, sample, primary in zip(rest, samples.tolist(),
+                                      is_primary.tolist()):
+      morphemes.append(Morpheme(morph, sample_objects[sample], None, primary))
+    lexicon = Lexicon()
+    lexicon.add_morphemes(morphemes)
+    return lexicon
 # END: class LexiconGenerator
 
 # BEGIN: class PhonologicalDistance
 class PhonologicalDistance(object):
   """Computes the phonological distance for a set of terms
   """
-  def __init__(self, pronunciations, matrix = {}):
+  def __init__(self, pronunciations, matrix = None, shared_matrix = None,
+               mode = 'fst', neighbour_table = None, metric_index = None):
+    """mode is 'fst' to compute distances with sounds_like, 'dp' to use
+    the equivalent dynamic programming in edit_distance, or 'trie' to do the
+    same for all the pronunciations at once with a pron_trie.PronTrie.
+
+    In 'dp' and 'trie' modes the telescopings are not materialized, but are
+    scored from the alignments of their two parts.
+
+    neighbour_table, if given, is a table of close prons built for the same
+    mode, used for the prons it covers.
+
+    metric_index, if given, is a metric_tree.BKTree holding pronunciations,
+    used to rule out the far ones.
+    """
     self._pronunciations = pronunciations
+    self._neighbour_table = neighbour_table
+    self._metric_index = metric_index
+    self._positions = None
+    self._multi_cache = {}  # Results of closest_prons_multi by set of forms
+    self._candidate_index = None
+    self._trie = None
+    if matrix is None:
+      matrix = distance_matrix.DictMatrix()
     self._matrix = matrix
     self._telescopings = {}
-    self.compute_cross_product()
+    self._trie_mode = mode == 'trie'
+    if mode in ('dp', 'trie'):
+      # Results of the dynamic programming must not mix with sounds_like ones.
+      self._shared_matrix = None
+      self._edit_distance = edit_distance.get_edit_distance()
+      self._sounds_like = self._edit_distance.distance
+      self.index_telescopings()
+    elif mode == 'fst':
+      self._shared_matrix = shared_matrix
+      self._edit_distance = None
+      # Rules out far pairs before they are composed.
+      self._cost_bound = edit_distance.get_edit_distance()
+      self._sounds_like = self._bounded_sounds_like
+      self.compute_cross_product()
+    else:
+      raise ValueError('Unknown distance mode %s' % mode)
+
+  def _bounded_sounds_like(self, pron1, pron2):
+    """sounds_like, ruling out pairs too far apart before composing them.
+
+    A path has at most one arc per segment of the two prons, so a cost above
+    _MAX_DISTANCE times their total length is beyond _MAX_DISTANCE per arc.
+    The dynamic programming of edit_distance gives the same least cost as
+    sounds_like, so pairs it puts beyond that cost are reported as having no
+    path without building any lattice. For the others sounds_like still finds
+    the whole best path.
+
+    Args:
+      pron1: first pronunciation
+      pron2: second pronunciation
+    Returns:
+      (length, cost) as for sounds_like, or no path if beyond the threshold
+    """
+    max_cost = _MAX_DISTANCE * (len(pron1) + len(pron2))
+    if self._cost_bound.distance(pron1, pron2)[1] > max_cost + _COST_SLACK:
+      return 0, float('inf')
+    return sounds_like(pron1, pron2, max_cost=max_cost)
 
   def __memoize__(self, pron1, pron2):
     """Memoizes the distance for a particular pair of prons for efficiency.
@@ -696,15 +1528,20 @@ class PhonologicalDistance(object):
       the sounds_like distance between the prons
     """
     if pron1 == pron2: return 0
-    if (pron1, pron2) in self._matrix:
-      return self._matrix[pron1, pron2]
-    length, cost = sounds_like(pron1, pron2)
-    try:
-      weighted_cost = cost / length
-    except ZeroDivisionError:
-      weighted_cost = float('Infinity')
-    self._matrix[pron1, pron2] = weighted_cost
-    return self._matrix[pron1, pron2]
+    distance = self._matrix.get(pron1, pron2)
+    if distance is not None:
+      return distance
+    if self._shared_matrix:
+      shared = self._shared_matrix.get(pron1, pron2)
+      if shared is not None:
+        return _weighted_cost(*shared)
+      length, cost = self._sounds_like(pron1, pron2)
+      # Only what the shared table cannot hold is kept locally.
+      if self._shared_matrix.put(pron1, pron2, length, cost):
+        return _weighted_cost(length, cost)
+    else:
+      length, cost = self._sounds_like(pron1, pron2)
+    return self._matrix.put(pron1, pron2, length, cost)
 
   def compute_cross_product(self):
     """Finds all pairs p1, p2, where p1 ends in a V and p2 starts with a V.
@@ -728,6 +1565,73 @@ class PhonologicalDistance(object):
             pairs.append(new_pron)
     self._pronunciations += pairs
 
+  def index_telescopings(self):
+    """Lists the pairs that compute_cross_product would find.
+
+    Each telescoping is listed once for every pair that gives it, as
+    compute_cross_product adds it, and is expanded to the last of those pairs.
+
+    Returns:
+      None
+    """
+    pronunciation_set = set(self._pronunciations)
+    by_initial = {}
+    for pron in self._pronunciations:
+      by_initial.setdefault(pron[0], []).append(pron)
+    self._telescoped = []
+    for p1 in self._pronunciations:
+      if not builder.is_vowel(p1[-1]): continue
+      for p2 in by_initial.get(p1[-1], ()):
+        new_pron = p1 + p2[1:]
+        if new_pron in pronunciation_set: continue
+        self._telescopings[new_pron] = p1 + '.' + p2
+        self._telescoped.append((new_pron, p1, p2))
+
+  def telescoped_distances(self, pron1, parts=None):
+    """Computes the distances from pron1 to all telescopings.
+
+    The alignment of pron1 with the first part p1 and the alignment of its
+    suffixes with the rest of the second part p2 are each computed once, and
+    combined for every pair by trying every split point of pron1. The result
+    is the same as aligning pron1 with p1 + p2[1:], so it is computed once for
+    each telescoping, however many pairs give it.
+
+    Args:
+      pron1: pronunciation
+      parts: if not None, only the telescopings whose expansion has a part in
+        this set
+    Returns:
+      list of (expanded telescoping, distance), in the order of
+      compute_cross_product, with an entry wherever it adds one
+    """
+    result = []
+    distances = {}
+    suffix_rows = {}
+    last_p1 = p1_row = None
+    for new_pron, p1, p2 in self._telescoped:
+      pair = self._telescopings[new_pron]
+      if parts is not None:
+        first, second = pair.split('.')
+        if first not in parts and second not in parts: continue
+      try:
+        result.append((pair, distances[new_pron]))
+        continue
+      except KeyError:
+        pass
+      if p1 != last_p1:
+        last_p1 = p1
+        p1_row = self._edit_distance.row(pron1, p1)
+      suffix = p2[1:]
+      try:
+        suffix_row = suffix_rows[suffix]
+      except KeyError:
+        suffix_row = suffix_rows[suffix] = self._edit_distance.suffix_row(
+          pron1, suffix)
+      value = min([x + y for x, y in zip(p1_row, suffix_row)])
+      distances[new_pron] = edit_distance.weighted(value)
+      result.append((pair, distances[new_pron]))
+    return result
+
   def expand(self, pron):
     """Possibly expand into a pair of telescoped elements
 
@@ -740,19 +1644,257 @@ class PhonologicalDistance(object):
       return self._telescopings[pron]
     return pron
 
+  def _index_candidates(self):
+    """Splits the prons into those in the neighbour table and the others.
+
+    Returns:
+      None
+    """
+    self._candidate_index = {}
+    self._candidates_outside_table = []
+    for i, pron in enumerate(self._pronunciations):
+      if pron in self._neighbour_table:
+        self._candidate_index[pron] = i
+      else:
+        self._candidates_outside_table.append((i, pron))
+
+  def _scored_from_table(self, pron1):
+    """_scored for a pron in the neighbour table.
+
+    The close prons in the table are those of the prons covered by the table,
+    so only the others need their distances.
+
+    Args:
+      pron1: pronunciation in the neighbour table
+    Returns:
+      list of (index, pron, distance), as for _scored
+    """
+    if self._candidate_index is None:
+      self._index_candidates()
+    result = []
+    if pron1 in self._candidate_index:
+      result.append((self._candidate_index[pron1], pron1, 0))
+    for pron2, distance in self._neighbour_table.neighbours(pron1):
+      try:
+        result.append((self._candidate_index[pron2], pron2, distance))
+      except KeyError:
+        pass
+    for i, pron2 in self._candidates_outside_table:
+      result.append((i, pron2, self.__memoize__(pron1, pron2)))
+    return result
+
+  def _scored_from_index(self, pron1):
+    """_scored, with the metric index to rule out far prons.
+
+    The prons not in the index, the telescopings, are all tried.
+
+    Args:
+      pron1: pronunciation
+    Returns:
+      list of (index, pron, distance), as for _scored
+    """
+    if self._positions is None:
+      self._positions = {}
+      for i, pron in enumerate(self._pronunciations):
+        if pron in self._metric_index:
+          self._positions[pron] = i
+    result = []
+    for pron2 in self._metric_index.candidates(pron1, _MAX_DISTANCE):
+      try:
+        result.append((self._positions[pron2], pron2,
+                       self.__memoize__(pron1, pron2)))
+      except KeyError:
+        pass
+    for i, pron2 in enumerate(self._pronunciations):
+      if pron2 not in self._positions:
+        result.append((i, pron2, self.__memoize__(pron1, pron2)))
+    return result
+
+  def _scored_from_trie(self, pron1):
+    """_scored, walking a trie of the pronunciations once.
+
+    Args:
+      pron1: pronunciation
+    Returns:
+      list of (index, pron, distance), as for _scored
+    """
+    if self._trie is None:
+      self._trie = pron_trie.PronTrie(self._edit_distance,
+                                      self._pronunciations)
+    return self._trie.distances(pron1, _MAX_DISTANCE)
+
+  def trie_stats(self):
+    """Returns the counts of PronTrie.take_stats, or None without a trie.
+    """
+    if self._trie is None:
+      return None
+    return self._trie.take_stats()
+
+  def _scored(self, pron1):
+    """Scores the candidates for closest_prons.
+
+    Candidates may be left out if they are known to be too far. The index of
+    a candidate is its place in the order in which closest_prons has always
+    tried them, that of the pronunciations and then of the telescopings, and
+    is the same whatever pron1 is.
+
+    Args:
+      pron1: pronunciation
+    Returns:
+      list of (index, unexpanded pron, distance), in no particular order
+    """
+    if self._neighbour_table and pron1 in self._neighbour_table:
+      result = self._scored_from_table(pron1)
+    elif self._trie_mode:
+      result = self._scored_from_trie(pron1)
+    elif self._metric_index is not None:
+      result = self._scored_from_index(pron1)
+    else:
+      result = [(i, pron2, self.__memoize__(pron1, pron2))
+                for i, pron2 in enumerate(self._pronunciations)]
+    if self._edit_distance:
+      i = len(self._pronunciations)
+      for pair, distance in self.telescoped_distances(pron1):
+        result.append((i, pair, distance))
+        i += 1
+    return result
+
+  def any_close(self, pron1, prons):
+    """Whether any of prons, alone or telescoped, is close to pron1.
+
+    Args:
+      pron1: pronunciation
+      prons: some of the pronunciations
+    Returns:
+      True if closest_prons(pron1) has one of prons, or a telescoping with one
+      of them as a part
+    """
+    for pron2 in prons:
+      if self.__memoize__(pron1, pron2) <= _MAX_DISTANCE:
+        return True
+    parts = set(prons)
+    if self._edit_distance:
+      for unused_pair, distance in self.telescoped_distances(pron1, parts):
+        if distance <= _MAX_DISTANCE:
+          return True
+      return False
+    for pron2, pair in self._telescopings.iteritems():
+      p1, p2 = pair.split('.')
+      if p1 not in parts and p2 not in parts: continue
+      if self.__memoize__(pron1, pron2) <= _MAX_DISTANCE:
+        return True
+    return False
+
+  def _closest(self, scored):
+    """Sorts scored candidates by distance, and then as they were tried.
+
+    Args:
+      scored: list of (index, unexpanded pron, distance)
+    Returns:
+      list of (pron, distance) as for closest_prons
+    """
+    scored.sort(key=lambda x: (x[2], x[0]))
+    return [(self.expand(pron2), distance)
+            for unused_i, pron2, distance in scored
+            if distance <= _MAX_DISTANCE]
+
   def closest_prons(self, pron1):
     """Returns an ordered list of closest prons to pron.
     """
-    result = []
-    for pron2 in self._pronunciations:
-      result.append((self.expand(pron2), self.__memoize__(pron1, pron2)))
-    result.sort(lambda x, y: cmp(x[1], y[1]))
-    return [x for x in result if x[1] <= _MAX_DISTANCE]
+    return self._closest(self._scored(pron1))
+
+  def closest_prons_multi(self, forms):
+    """closest_prons for a morpheme with several forms, e.g. ablauted ones.
+
+    Each candidate gets its least distance from any of the forms. Results are
+    kept, since morphemes often share their forms.
+
+    Args:
+      forms: list of pronunciations
+    Returns:
+      list of (pron, distance), as for closest_prons
+    """
+    key = frozenset(forms)
+    if key in self._multi_cache:
+      return self._multi_cache[key]
+    best = {}
+    for form in key:
+      for i, pron2, distance in self._scored(form):
+        if distance > _MAX_DISTANCE: continue
+        if pron2 not in best or distance < best[pron2][2]:
+          best[pron2] = (i, pron2, distance)
+    result = self._multi_cache[key] = self._closest(best.values())
+    return result
 # END: class PhonologicalDistance
 
 
-def main(argv):
-  global _PROBABILITY_TO_SEEK_SPELLING
+# BEGIN: class Convergence
+class Convergence(object):
+  """Watches the counts after each iteration for the lexicon to settle.
+
+  The lexicon has settled when, over the last window iterations, neither the
+  proportion of morphs spelled nor the shares of the spelled ones that are
+  semantic-phonetic, phonetic and semantic have moved by more than tolerance,
+  or when there have been no new spellings for patience iterations. A window
+  or patience of 0 turns that test off.
+  """
+  def __init__(self, window, tolerance, patience):
+    self._window = window
+    self._tolerance = tolerance
+    self._patience = patience
+    self._history = []
+
+  def _shares(self, counts):
+    spelled = float(counts['spelled']) or 1.0
+    return [counts['spelled'] / (float(counts['morphs']) or 1.0),
+            counts['semphon'] / spelled,
+            counts['phon'] / spelled,
+            counts['sem'] / spelled]
+
+  def restart(self):
+    """Forgets the history before the last counts, e.g. on freezing.
+
+    Returns:
+      None
+    """
+    self._history = self._history[-1:]
+
+  def update(self, counts):
+    """Adds the counts after an iteration.
+
+    Args:
+      counts: dict from Lexicon.counts
+    Returns:
+      the reason to stop, or None if the lexicon has not settled
+    """
+    self._history.append(counts)
+    window = self._window
+    if window and len(self._history) > window:
+      shares = [self._shares(c) for c in self._history[-window - 1:]]
+      change = max(max(column) - min(column) for column in zip(*shares))
+      if change <= self._tolerance:
+        return ('proportions moved by at most %.4f over the last %d '
+                'iterations' % (change, window))
+    patience = self._patience
+    if patience and len(self._history) > patience:
+      spelled = set(c['spelled'] for c in self._history[-patience - 1:])
+      if len(spelled) == 1:
+        return 'no new spellings for %d iterations' % patience
+    return None
+# END: class Convergence
+
+
+# Names of the flags defined by define_flags, which key the runs in the cache.
+_SIMULATION_FLAGS = []
+
+
+def define_flags():
+  """Defines the flags that control a simulation run.
+
+  Returns:
+    None
+  """
+  start = len(flags.defined_flags())
   flags.define_flag('ablaut',
                     '0',
                     'Apply ablaut')
@@ -783,10 +1925,266 @@ def main(argv):
   flags.define_flag('freeze_semantics_at_iter',
                     '0',
                     'Do not allow any new semantic spread after iteration N')
-  flags.parse_flags(argv[1:])
+  flags.define_flag('distance_mode',
+                    'fst',
+                    'How distances are computed: fst (sounds_like), dp '
+                    '(dynamic programming over the same edit costs) or trie '
+                    '(the same as dp, over a trie of the prons)')
+  flags.define_flag('seed',
+                    '0',
+                    'Seed for the random choices; 0 seeds from the time')
+  flags.define_flag('shared_matrix',
+                    '',
+                    'File (e.g. on /dev/shm) for a distance table shared by '
+                    'concurrent runs; empty to keep distances per run')
+  flags.define_flag('shared_matrix_slots',
+                    '4194304',
+                    'Number of 8-byte slots when creating the shared table')
+  flags.define_flag('concepts_file',
+                    '',
+                    'File of concepts and their graphical forms, one per '
+                    'line separated by a tab; empty to use concepts.CONCEPTS')
+  flags.define_flag('matrix_store',
+                    'dict',
+                    'How to store the distance matrix: "dict", "dense" '
+                    '(float32 per pair, for small lexicons) or "sparse" '
+                    '(only close pairs, for large lexicons)')
+  flags.define_flag('async_output',
+                    '0',
+                    'Whether to write the snapshots and log from a separate '
+                    'thread while the simulation goes on')
+  flags.define_flag('async_output_queue',
+                    '10000',
+                    'Number of writes that may wait for the writer thread')
+  flags.define_flag('neighbour_table',
+                    '',
+                    'Table of close prons made by neighbour_table.py for '
+                    'the same distance mode and prepare_grammars; empty to '
+                    'compute all distances')
+  flags.define_flag('prepare_grammars',
+                    '0',
+                    'Whether to optimize and arc-sort the distance grammar '
+                    'when loading it, for faster composition; equally close '
+                    'paths may then be chosen differently')
+  flags.define_flag('ablaut_all_forms',
+                    '0',
+                    'Whether to also find close prons for the ablauted forms '
+                    'of a morpheme when seeking a spelling for it')
+  flags.define_flag('skip_blocked_morphemes',
+                    '1',
+                    'Whether to skip the search for a spelling for morphemes '
+                    'whose last search found none, until something it used '
+                    'changes; the results are the same, but the log leaves '
+                    'out the repeated searches')
+  flags.define_flag('metric_index',
+                    '0',
+                    'Whether to keep the useful prons in a metric tree to '
+                    'rule out the far ones in closest_prons')
+  flags.define_flag('memory_report',
+                    '0',
+                    'Whether to write the memory used by each part of the '
+                    'simulation after each iteration to memory.jsonl')
+  flags.define_flag('memory_budget_mb',
+                    '0',
+                    'RSS in MB above which the caches are trimmed after an '
+                    'iteration; 0 for no budget')
+  flags.define_flag('converge_window',
+                    '0',
+                    'Stop once the proportions of spellings have moved by '
+                    'at most --converge_tolerance over this many '
+                    'iterations; 0 to not test this')
+  flags.define_flag('converge_tolerance',
+                    '0.005',
+                    'Largest change of a proportion over --converge_window '
+                    'iterations for the lexicon to count as settled')
+  flags.define_flag('converge_patience',
+                    '0',
+                    'Stop after this many iterations without new spellings; '
+                    '0 to not test this')
+  flags.define_flag('catalog',
+                    '',
+                    'SQLite catalog (see catalog.py) to add the run to; '
+                    'empty for none')
+  flags.define_flag('bulk_generation',
+                    '0',
+                    'Whether to draw the concepts of the initial lexicon '
+                    'all at once with numpy, for very large lexicons; the '
+                    'same seed then gives a different lexicon')
+  flags.define_flag('lexicon_file',
+                    '',
+                    'File of morphemes to start from instead of generating '
+                    'them, one per line: pron, concepts, and optionally '
+                    'glyph and primary flag, separated by tabs (see '
+                    'load_lexicon); empty to generate the lexicon')
+  flags.define_flag('lexicon_chunk_rows',
+                    '10000',
+                    'Number of lines of --lexicon_file to read at a time')
+  flags.define_flag('run_cache',
+                    '',
+                    'Directory of finished seeded runs (see run_cache.py) to '
+                    'reuse the outputs of and add to; empty for none')
+  flags.define_flag('run_cache_links',
+                    '0',
+                    'Whether to hard-link the outputs of a cached run into '
+                    'outdir rather than copy them; they must then not be '
+                    'changed in place')
+  _SIMULATION_FLAGS[:] = flags.defined_flags()[start:]
+
+
+def new_matrix():
+  """Creates an empty distance matrix of the kind given by the flags.
+
+  Returns:
+    a store from distance_matrix
+  """
+  return distance_matrix.new_matrix(flags.FLAGS_matrix_store, _MAX_DISTANCE)
+
+
+def new_convergence():
+  """Creates a Convergence as given by the flags.
+
+  Returns:
+    a Convergence, or None if the runs are not to stop early
+  """
+  if not flags.FLAGS_converge_window and not flags.FLAGS_converge_patience:
+    return None
+  return Convergence(flags.FLAGS_converge_window,
+                     float(flags.FLAGS_converge_tolerance),
+                     flags.FLAGS_converge_patience)
+
+
+def _lexicon_concept(field, concept_objects):
+  """Finds the Concept for the concepts field of a line of a lexicon file.
+
+  Args:
+    field: comma-separated concepts, with or without their "@"
+    concept_objects: dict from field and from concept name to Concept, which
+      is updated
+  Returns:
+    a Concept
+  """
+  try:
+    return concept_objects[field]
+  except KeyError:
+    pass
+  atoms = []
+  for atom in field.split(','):
+    atom = atom.strip()
+    if not atom:
+      raise ValueError('Empty concept in %s' % field)
+    if not atom.startswith('@'):
+      atom = '@' + atom
+    atoms.append(atom)
+  name = intern(','.join(atoms))
+  if name not in concept_objects:
+    concept_objects[name] = Concept(name)
+  concept_objects[field] = concept_objects[name]
+  return concept_objects[name]
+
+
+def load_lexicon(path, chunk_size=10000):
+  """Loads a lexicon from a file instead of generating it.
+
+  Each line holds a pron, its comma-separated concepts, and optionally the
+  glyph of its initial symbol and whether it is the primary exponent of its
+  concepts, 1 or 0, separated by tabs, e.g. "pat\t@MAN,@WATER\t\t1". Blank
+  lines and lines starting with "#" are skipped, and an "@" is added to
+  concepts that lack one. Without the last field, the first morpheme with
+  each set of concepts is the primary one, as in LexiconGenerator.generate.
+
+  The file is read in chunks of chunk_size lines, each added to the lexicon
+  with Lexicon.add_morphemes, so that only the morphemes stay in memory.
+  Prons and glyphs are interned, and the morphemes with the same concepts
+  share a Concept.
+
+  Args:
+    path: lexicon file
+    chunk_size: number of lines per chunk
+  Returns:
+    a Lexicon; raises ValueError for a bad line or a pron with segments not
+    in Grm/phonemes.tsv
+  """
+  segments = builder.load_segments()
+  lexicon = Lexicon()
+  concept_objects = {}
+  seen_concepts = set()
+  chunk = []
+  # As in generate_bulk, the objects made here all last.
+  collecting = gc.isenabled()
+  gc.disable()
+  try:
+    with open(path) as stream:
+      for line_number, line in enumerate(stream, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.startswith('#'): continue
+        fields = line.split('\t')
+        pron = fields[0].strip()
+        if len(fields) < 2 or len(fields) > 4 or not pron:
+          raise ValueError('Bad line %d in %s: %s' % (line_number, path, line))
+        unknown = set(pron) - segments
+        if unknown:
+          raise ValueError('Bad pron %s on line %d in %s: unknown segments %s' %
+                           (pron, line_number, path, ''.join(sorted(unknown))))
+        try:
+          semantics = _lexicon_concept(fields[1].strip(), concept_objects)
+        except ValueError as err:
+          raise ValueError('%s on line %d in %s' % (err, line_number, path))
+        symbol = None
+        if len(fields) > 2 and fields[2].strip():
+          symbol = Symbol(intern(fields[2].strip()), semantics.name)
+        if len(fields) > 3 and fields[3].strip():
+          if fields[3].strip() not in ('0', '1'):
+            raise ValueError('Bad primary flag on line %d in %s: %s' %
+                             (line_number, path, fields[3]))
+          is_primary = fields[3].strip() == '1'
+        else:
+          is_primary = semantics.name not in seen_concepts
+        seen_concepts.add(semantics.name)
+        chunk.append(Morpheme(intern(pron), semantics, symbol, is_primary))
+        if len(chunk) >= chunk_size:
+          lexicon.add_morphemes(chunk)
+          chunk = []
+    lexicon.add_morphemes(chunk)
+  finally:
+    if collecting:
+      gc.enable()
+  return lexicon
+
+
+def generate_lexicon(build_grammars=True):
+  """Generates the initial lexicon as specified by the flags.
+
+  Args:
+    build_grammars: if False, assumes the grammars are already built
+  Returns:
+    a Lexicon, ablauted if requested
+  """
+  seed = None
+  if flags.FLAGS_seed:
+    seed = flags.FLAGS_seed
+    random.seed(seed)
+  pynini_interface.PREPARE_RULES = bool(flags.FLAGS_prepare_grammars)
+  inventory = None
+  if flags.FLAGS_concepts_file:
+    inventory = concepts.load_concepts(flags.FLAGS_concepts_file)
   generator = LexiconGenerator(nmorphs=flags.FLAGS_nmorphs,
-                               base_morph=flags.FLAGS_base_morph)
-  lexicon = generator.generate()
+                               base_morph=flags.FLAGS_base_morph,
+                               seed=seed,
+                               inventory=inventory)
+  if not build_grammars:
+    generator._initial = False
+  if flags.FLAGS_lexicon_file:
+    if build_grammars:
+      builder.build_morphology_grammar()
+      builder.build_soundslike_grammar()
+    lexicon = load_lexicon(flags.FLAGS_lexicon_file,
+                           flags.FLAGS_lexicon_chunk_rows)
+    print 'Loaded {} morphemes from {}'.format(lexicon.counts()['morphs'],
+                                               flags.FLAGS_lexicon_file)
+  elif flags.FLAGS_bulk_generation:
+    lexicon = generator.generate_bulk()
+  else:
+    lexicon = generator.generate()
   print '{} {}'.format('Probability to seek spelling is',
                         flags.FLAGS_probability_to_seek_spelling)
   print 'Base morph is', flags.FLAGS_base_morph
@@ -798,26 +2196,326 @@ def main(argv):
   print 'nmorphs =', flags.FLAGS_nmorphs
   if flags.FLAGS_ablaut:
     lexicon.apply_ablaut()
-  outdir = flags.FLAGS_outdir
+  lexicon.set_matrix(new_matrix())
+  if flags.FLAGS_neighbour_table:
+    table = neighbour_table.load(flags.FLAGS_neighbour_table)
+    # The trie mode finds the same distances as the dp one.
+    mode = flags.FLAGS_distance_mode
+    if mode == 'trie':
+      mode = 'dp'
+    if table.mode != mode:
+      raise ValueError('%s was built for distance mode %s' %
+                       (flags.FLAGS_neighbour_table, table.mode))
+    if table.max_distance != _MAX_DISTANCE:
+      raise ValueError('%s was built for max_distance %g' %
+                       (flags.FLAGS_neighbour_table, table.max_distance))
+    if table.prepare != pynini_interface.PREPARE_RULES:
+      raise ValueError('%s was built with prepare_grammars=%d' %
+                       (flags.FLAGS_neighbour_table, table.prepare))
+    lexicon.set_neighbour_table(table)
+  if flags.FLAGS_metric_index:
+    closure = edit_distance.get_edit_distance().metric_closure()
+    if metric_tree.is_metric(closure):
+      lexicon.set_metric_index(metric_tree.BKTree(closure))
+    else:
+      print 'Edit costs are not a metric: not using the metric index'
+  if flags.FLAGS_shared_matrix:
+    # Tables built from an older grammar, in another distance mode or with
+    # the other prepare_grammars setting are refused.
+    stamp = int(os.path.getmtime('%s/Grm/soundslike.far' % _BASE))
+    mode = flags.FLAGS_distance_mode
+    if mode == 'trie':
+      mode = 'dp'
+    lexicon.set_shared_matrix(
+      shared_matrix.SharedDistanceTable(flags.FLAGS_shared_matrix,
+                                        flags.FLAGS_shared_matrix_slots,
+                                        stamp,
+                                        mode,
+                                        pynini_interface.PREPARE_RULES))
+  return lexicon
+
+
+def make_outdir(outdir):
+  """Creates the output directory if it does not already exist.
+
+  Args:
+    outdir: output directory
+  Returns:
+    None
+  """
   try:
     os.makedirs(outdir)
   except OSError:
     pass
-  lexicon.dump_morphemes(outdir + '/morphemes_0000.tsv')
-  with open(outdir + '/log.txt', 'w') as stream:
-    log.LOG_STREAM = stream
-    for i in range(1, flags.FLAGS_niter):
-      if flags.FLAGS_freeze_phonetics_at_iter == i:
-        lexicon.freeze_phonetics()
-      if flags.FLAGS_freeze_semantics_at_iter == i:
-        lexicon.freeze_semantics()
-      print 'Iteration %d' % i
-      log.log('Iteration %d' % i)
-      lexicon.generate_new_spellings()
-      lexicon.dump_morphemes(outdir + '/morphemes_%04d.tsv' % i)
-    lexicon.log_pron_to_symbol_map()
-  
+
+
+def run_iteration(lexicon, i):
+  """Runs one iteration of spelling generation.
+
+  Args:
+    lexicon: a Lexicon
+    i: iteration number
+  Returns:
+    None
+  """
+  print 'Iteration %d' % i
+  log.log('Iteration %d' % i)
+  lexicon.generate_new_spellings()
+
+
+def add_to_catalog(symbols, path):
+  """Adds the finished run to a catalog.
+
+  Args:
+    symbols: list of (symbol, pron) of the final lexicon
+    path: catalog database
+  Returns:
+    None
+  """
+  config = {'base_morph': flags.FLAGS_base_morph,
+            'probability': flags.FLAGS_probability_to_seek_spelling,
+            'non_primaries': flags.FLAGS_initialize_non_primaries_with_symbol,
+            'ablaut': flags.FLAGS_ablaut,
+            'freeze_phonetics': flags.FLAGS_freeze_phonetics_at_iter,
+            'freeze_semantics': flags.FLAGS_freeze_semantics_at_iter,
+            'niter': flags.FLAGS_niter,
+            'nmorphs': flags.FLAGS_nmorphs,
+            'seed': flags.FLAGS_seed,
+            'experiment': os.path.basename(
+              os.path.normpath(flags.FLAGS_outdir))}
+  outdir = flags.FLAGS_outdir
+  run_catalog = catalog.Catalog(path)
+  try:
+    run_catalog.import_run(outdir, config, catalog.run_counts(outdir),
+                           symbols)
+  finally:
+    run_catalog.close()
+
+
+def metrics_record(lexicon, i, stopped=None):
+  """Formats the counts after an iteration as a line of metrics.jsonl.
+
+  Args:
+    lexicon: a Lexicon
+    i: iteration number, 0 for the initial lexicon
+    stopped: if the run stops after this iteration, the reason
+  Returns:
+    JSON string ending in a newline
+  """
+  record = lexicon.counts()
+  record['iteration'] = i
+  record['time'] = time.time()
+  if stopped:
+    record['stopped'] = stopped
+  return json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n'
+
+
+def write_snapshot(rows, outfile):
+  """Writes out a snapshot of the morphemes as dump_morphemes would have.
+
+  Args:
+    rows: list from Lexicon.snapshot
+    outfile: output file
+  Returns:
+    None
+  """
+  with open(outfile, 'w') as stream:
+    for key, morpheme, spelling in rows:
+      stream.write('%s\t%s\n' % (key, morpheme.describe(spelling)))
+
+
+def dump_snapshot(lexicon, outfile, writer=None):
+  """Writes out the morphemes, in the background if given a writer.
+
+  Args:
+    lexicon: a Lexicon
+    outfile: output file
+    writer: an async_output.AsyncWriter, or None
+  Returns:
+    None
+  """
+  if writer:
+    writer.call(write_snapshot, lexicon.snapshot(), outfile)
+  else:
+    lexicon.dump_morphemes(outfile)
+
+
+def write_metrics(lexicon, i, stream, writer=None, stopped=None):
+  """Appends the counts after an iteration to metrics.jsonl.
+
+  Args:
+    lexicon: a Lexicon
+    i: iteration number
+    stream: metrics.jsonl
+    writer: an async_output.AsyncWriter, or None
+    stopped: if the run stops after this iteration, the reason
+  Returns:
+    None
+  """
+  record = metrics_record(lexicon, i, stopped)
+  if writer:
+    writer.write(stream, record)
+  else:
+    stream.write(record)
+    stream.flush()
+
+
+def check_memory(lexicon, i, stream, writer=None, matrix_replaced=None):
+  """Keeps to the memory budget and reports the memory used, as flagged.
+
+  Args:
+    lexicon: a Lexicon
+    i: iteration number
+    stream: memory.jsonl, or None if not reporting
+    writer: an async_output.AsyncWriter, or None
+    matrix_replaced: if not None, called with the new matrix when the budget
+      makes the lexicon drop its distance matrix
+  Returns:
+    None
+  """
+  # The sizes are taken before any trimming, to show what filled the memory.
+  record = memory.report(lexicon, i) if stream else None
+  if flags.FLAGS_memory_budget_mb:
+    def replacement():
+      matrix = new_matrix()
+      if matrix_replaced:
+        matrix_replaced(matrix)
+      return matrix
+
+    trimmed = memory.trim_caches(lexicon, flags.FLAGS_memory_budget_mb * 1024,
+                                 replacement)
+    if trimmed:
+      log.log('Over the memory budget: trimmed {}'.format(', '.join(trimmed)))
+      if record:
+        record['trimmed'] = trimmed
+  if stream:
+    record = json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n'
+    if writer:
+      writer.write(stream, record)
+    else:
+      stream.write(record)
+      stream.flush()
+
+
+def run_simulation(matrix=None, build_grammars=True, matrix_replaced=None):
+  """Runs a simulation as specified by the flags.
+
+  Args:
+    matrix: if not None, distance matrix to use and extend, e.g. one kept
+      from previous runs
+    build_grammars: if False, assumes the grammars are already built
+    matrix_replaced: if not None, called with the new matrix when the memory
+      budget makes the run drop its distance matrix, so that a caller keeping
+      matrix can drop it too and keep the new one instead
+  Returns:
+    None
+  """
+  outdir = flags.FLAGS_outdir
+  cache_key = None
+  if flags.FLAGS_run_cache and flags.FLAGS_seed:
+    # The key covers the grammars, so they are built first.
+    if build_grammars:
+      builder.build_morphology_grammar()
+      builder.build_soundslike_grammar()
+      build_grammars = False
+    description = run_cache.describe_run(_SIMULATION_FLAGS)
+    cache_key = run_cache.run_key(description)
+    make_outdir(outdir)
+    if run_cache.fetch(flags.FLAGS_run_cache, cache_key, outdir,
+                       flags.FLAGS_run_cache_links):
+      print 'Found run {} in {}'.format(cache_key, flags.FLAGS_run_cache)
+      print 'outdir =', outdir
+      if flags.FLAGS_catalog:
+        add_to_catalog(catalog.logged_symbols(outdir), flags.FLAGS_catalog)
+      return
+  elif flags.FLAGS_run_cache:
+    print 'Not caching a run without --seed'
+  lexicon = generate_lexicon(build_grammars)
+  if matrix is not None:
+    lexicon.set_matrix(matrix)
+    # Only the lexicon holds on to it, so that trimming it can free it.
+    matrix = None
+  make_outdir(outdir)
+  writer = None
+  if flags.FLAGS_async_output:
+    writer = async_output.AsyncWriter(flags.FLAGS_async_output_queue)
+  # The files written by this run, as against any left in outdir by others.
+  outputs = ['log.txt', 'metrics.jsonl', 'morphemes_0000.tsv']
+  memory_stream = None
+  if flags.FLAGS_memory_report:
+    memory.start()
+    memory_stream = open(outdir + '/memory.jsonl', 'w')
+    outputs.append('memory.jsonl')
+  with open(outdir + '/log.txt', 'w') as stream, \
+       open(outdir + '/metrics.jsonl', 'w') as metrics:
+    completed = False
+    try:
+      dump_snapshot(lexicon, outdir + '/morphemes_0000.tsv', writer)
+      write_metrics(lexicon, 0, metrics, writer)
+      if writer:
+        log.LOG_STREAM = writer.stream(stream)
+      else:
+        log.LOG_STREAM = stream
+      check_memory(lexicon, 0, memory_stream, writer, matrix_replaced)
+      convergence = new_convergence()
+      if convergence:
+        convergence.update(lexicon.counts())
+      # Runs are not stopped before they have frozen as asked.
+      last_freeze = max(flags.FLAGS_freeze_phonetics_at_iter,
+                        flags.FLAGS_freeze_semantics_at_iter)
+      for i in range(1, flags.FLAGS_niter):
+        if flags.FLAGS_freeze_phonetics_at_iter == i:
+          lexicon.freeze_phonetics()
+        if flags.FLAGS_freeze_semantics_at_iter == i:
+          lexicon.freeze_semantics()
+        if convergence and i in (flags.FLAGS_freeze_phonetics_at_iter,
+                                 flags.FLAGS_freeze_semantics_at_iter):
+          convergence.restart()
+        run_iteration(lexicon, i)
+        snapshot = 'morphemes_%04d.tsv' % i
+        dump_snapshot(lexicon, outdir + '/' + snapshot, writer)
+        outputs.append(snapshot)
+        stopped = None
+        if convergence:
+          stopped = convergence.update(lexicon.counts())
+          if i < last_freeze:
+            stopped = None
+        write_metrics(lexicon, i, metrics, writer, stopped)
+        check_memory(lexicon, i, memory_stream, writer, matrix_replaced)
+        if stopped:
+          log.log('Stopping after iteration {}: {}'.format(i, stopped))
+          print 'Stopping after iteration {}: {}'.format(i, stopped)
+          break
+      lexicon.log_pron_to_symbol_map()
+      completed = True
+    finally:
+      # Everything queued is written before the files are closed, also when
+      # the run fails.
+      try:
+        if writer:
+          log.LOG_STREAM = stream
+          try:
+            writer.close()
+          except Exception as err:
+            if completed: raise
+            # The error of the run is the one raised; the writer's may well
+            # follow from it.
+            sys.stderr.write('Error in the output writer: {}\n'.format(err))
+      finally:
+        if memory_stream:
+          memory_stream.close()
+  if cache_key:
+    run_cache.store(flags.FLAGS_run_cache, cache_key, description, outdir,
+                    outputs)
+  if flags.FLAGS_catalog:
+    add_to_catalog(lexicon.pron_to_symbol_map(), flags.FLAGS_catalog)
+
+
+def main(argv):
+  define_flags()
+  flags.parse_flags(argv[1:])
+  run_simulation()
+
 
 if __name__ == '__main__':
   main(sys.argv)
-  
@@ -0,0 +1,223 @@
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Accounts for the memory used by the parts of a simulation.
+
+With --memory_report, each iteration adds a line to memory.jsonl in the output
+directory giving the RSS, the peak RSS, and estimates of the bytes held by:
+
+  matrix: the distance matrix of the lexicon
+  compositions: the compositions cached by sounds_like
+  grammars: the rules loaded from the fars
+  morphemes: the morphemes with their concepts, symbols and prons
+  indexes: the tables of the lexicon from prons and concepts to morphemes
+  used_spellings: the sets of spellings used so far
+  symbol_caches: the symbols stored per pron and concept
+  metric_index: the metric tree of the useful prons, if any
+
+If tracemalloc can be imported, the memory traced by Python and the lines that
+allocated most of it are given as well.
+
+With --memory_budget_mb, the caches are trimmed when the RSS is over the budget
+after an iteration: first the compositions and symbol caches, then, if that is
+not enough, the distance matrix. They are rebuilt as needed, so the results are
+unchanged, but the run gets slower. Freed memory is kept by the process for
+reuse, so the RSS seldom goes down after a trim; the caches are only trimmed
+again once the RSS has grown beyond what it was after the last trim, rather
+than after every iteration spent over the budget. Whether the first caches are
+enough is judged from their numbers of entries alone, since walking them as for
+the report would allocate the most just when memory is short.
+
+The estimates are of the structures themselves: strings and objects shared
+between components are counted once, under the first one, and the FSTs are
+sized from their numbers of states and arcs.
+"""
+
+import resource
+import sys
+import time
+
+import pynini_interface
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+# Approximate sizes of a state and an arc of a vector FST in OpenFst.
+_STATE_BYTES = 48
+_ARC_BYTES = 16
+# Rough sizes for trim_caches: a state of a cached composition with its arcs,
+# and a stored symbol with its entry.
+_COMPOSITION_STATE_BYTES = _STATE_BYTES + 4 * _ARC_BYTES
+_SYMBOL_BYTES = 512
+# RSS in KB after the last trim_caches that trimmed, or None.
+_TRIMMED_RSS_KB = None
+_TOP_ALLOCATIONS = 5
+
+
+def start():
+  """Starts tracing allocations, if tracemalloc is there.
+
+  Returns:
+    None
+  """
+  if tracemalloc and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+def rss_kb():
+  """Current resident set size of the process.
+
+  Returns:
+    RSS in KB, or None where /proc is not available
+  """
+  try:
+    with open('/proc/self/statm') as stream:
+      pages = int(stream.read().split()[1])
+  except (IOError, IndexError, ValueError):
+    return None
+  return pages * (resource.getpagesize() / 1024)
+
+
+def peak_rss_kb():
+  """Peak resident set size of the process.
+
+  Returns:
+    peak RSS in KB, as on Linux
+  """
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    peak /= 1024
+  return peak
+
+
+def nbytes(obj, seen):
+  """Estimates the memory held by an object and what it refers to.
+
+  Args:
+    obj: object
+    seen: set of the ids of the objects already counted, which is updated
+  Returns:
+    bytes
+  """
+  total = 0
+  stack = [obj]
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen: continue
+    seen.add(id(obj))
+    total += sys.getsizeof(obj)
+    if isinstance(obj, (str, unicode, int, long, float, bool)) or obj is None:
+      continue
+    if isinstance(obj, dict):
+      stack.extend(obj.iterkeys())
+      stack.extend(obj.itervalues())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+      stack.extend(obj)
+    elif hasattr(obj, '__dict__'):
+      stack.append(obj.__dict__)
+  return total
+
+
+def fst_nbytes(fst):
+  """Estimates the memory held by an FST.
+
+  Args:
+    fst: pynini fst
+  Returns:
+    bytes
+  """
+  narcs = 0
+  for state in fst.states():
+    narcs += fst.num_arcs(state)
+  return fst.num_states() * _STATE_BYTES + narcs * _ARC_BYTES
+
+
+def component_sizes(lexicon):
+  """Estimates the memory held by each part of a simulation.
+
+  Args:
+    lexicon: a Lexicon
+  Returns:
+    dict from component to bytes
+  """
+  sizes = lexicon.nbytes()
+  sizes['compositions'] = sum(
+    fst_nbytes(fst) for fst in pynini_interface._CACHED_COMPOSITIONS.values())
+  sizes['grammars'] = sum(
+    fst_nbytes(fst) for unused_key, fst in pynini_interface.GRAMMARS.loaded())
+  return sizes
+
+
+def report(lexicon, i):
+  """Describes the memory used after an iteration, for memory.jsonl.
+
+  Args:
+    lexicon: a Lexicon
+    i: iteration number, 0 for the initial lexicon
+  Returns:
+    dict
+  """
+  record = {'iteration': i,
+            'time': time.time(),
+            'rss_kb': rss_kb(),
+            'peak_rss_kb': peak_rss_kb(),
+            'bytes': component_sizes(lexicon)}
+  if tracemalloc and tracemalloc.is_tracing():
+    current, peak = tracemalloc.get_traced_memory()
+    record['traced_bytes'] = current
+    record['traced_peak_bytes'] = peak
+    statistics = tracemalloc.take_snapshot().statistics('lineno')
+    record['top_allocations'] = [
+      [str(stat.traceback), stat.size]
+      for stat in statistics[:_TOP_ALLOCATIONS]]
+  return record
+
+
+def trim_caches(lexicon, budget_kb, new_matrix):
+  """Trims the caches if the RSS is over budget and grew since the last trim.
+
+  The RSS may not go down at once, since freed memory is kept for reuse, but
+  it then stops growing until the caches have filled up again, so the RSS
+  after a trim is recorded and the caches are left alone until it is passed.
+
+  Args:
+    lexicon: a Lexicon
+    budget_kb: budget for the RSS in KB
+    new_matrix: function returning an empty distance matrix, which replaces
+      that of the lexicon if dropping the other caches is not enough
+  Returns:
+    list of the caches trimmed
+  """
+  global _TRIMMED_RSS_KB
+  rss = rss_kb()
+  if rss is None or rss <= budget_kb:
+    return []
+  if _TRIMMED_RSS_KB is not None and rss <= _TRIMMED_RSS_KB:
+    return []
+  over = (rss - budget_kb) * 1024
+  cache_bytes = (
+    sum(fst.num_states()
+        for fst in pynini_interface._CACHED_COMPOSITIONS.itervalues()) *
+    _COMPOSITION_STATE_BYTES +
+    lexicon.cached_symbol_count() * _SYMBOL_BYTES)
+  pynini_interface._CACHED_COMPOSITIONS.clear()
+  lexicon.drop_symbol_caches()
+  trimmed = ['compositions', 'symbol_caches']
+  if cache_bytes < over:
+    lexicon.set_matrix(new_matrix())
+    trimmed.append('matrix')
+  _TRIMMED_RSS_KB = rss_kb()
+  return trimmed
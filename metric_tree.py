@@ -0,0 +1,156 @@
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Metric tree over the useful pronunciations, for the range queries of
+closest_prons.
+
+The distance of closest_prons, the cost of the path per arc, is not a metric.
+Nor quite is the cost itself: some edits of EDIT_DISTANCE cost more than a
+deletion and an insertion, and some segments cannot be deleted or kept. The
+tree therefore uses the costs of EditDistance.metric_closure, which are never
+more than the real ones and are a metric, as is_metric checks.
+
+A path between prons of lengths m and n has at most m + n arcs, so the prons
+within a distance R of a pron of length m are among those within a cost of
+R * (m + n), and so also within that cost under the closure. The tree is a
+BK-tree: each node keeps its children by their cost from it, so the triangle
+inequality rules out every child whose cost from the node differs from that
+of the query by more than R * (m + n) for the longest pron n below the child.
+What is left is checked with the real distance.
+
+Prons are added as they become useful, so the tree grows with the lexicon.
+"""
+
+# Slack for rounding in the bounds; candidates are checked exactly afterwards.
+_SLACK = 1e-9
+
+
+def is_metric(distance):
+  """Checks that the costs of an edit_distance.EditDistance are a metric.
+
+  Args:
+    distance: an EditDistance
+  Returns:
+    True if every segment is kept at no cost, the edits cost the same both
+    ways, and they satisfy the triangle inequality
+  """
+  segments = [''] + distance.segments()
+  costs = {}
+  for a in segments:
+    for b in segments:
+      costs[a, b] = distance.edit_cost(a, b)
+  for a in segments:
+    if costs[a, a] != 0:
+      return False
+    for b in segments:
+      if costs[a, b] != costs[b, a]:
+        return False
+      for c in segments:
+        if costs[a, c] > costs[a, b] + costs[b, c]:
+          return False
+  return True
+
+
+# BEGIN: class BKTree
+class BKTree(object):
+  """BK-tree of prons under the cost of an EditDistance, which must be a
+  metric.
+
+  Each node is a list of its pron, the length of the longest pron below it,
+  and a dict from cost to child.
+  """
+  def __init__(self, distance):
+    self._distance = distance
+    self._root = None
+    self._prons = set()
+    self._queries = 0
+    self._evaluations = 0
+    self._possible = 0
+
+  def __len__(self):
+    return len(self._prons)
+
+  def __contains__(self, pron):
+    return pron in self._prons
+
+  def _cost(self, pron1, pron2):
+    return self._distance.distance(pron1, pron2)[1]
+
+  def add(self, pron):
+    """Adds a pron, if not already there.
+
+    Args:
+      pron: pronunciation
+    Returns:
+      None
+    """
+    if pron in self._prons: return
+    self._prons.add(pron)
+    node = [pron, len(pron), {}]
+    if self._root is None:
+      self._root = node
+      return
+    current = self._root
+    while True:
+      current[1] = max(current[1], len(pron))
+      cost = self._cost(pron, current[0])
+      child = current[2].get(cost)
+      if child is None:
+        current[2][cost] = node
+        return
+      current = child
+
+  def candidates(self, pron, max_distance):
+    """Finds the prons that may be within max_distance of pron.
+
+    Args:
+      pron: pronunciation
+      max_distance: largest cost per arc of interest
+    Returns:
+      list of prons, including all those within max_distance
+    """
+    self._queries += 1
+    self._possible += len(self._prons)
+    result = []
+    if self._root is None:
+      return result
+    max_distance *= 1 + _SLACK
+    length = len(pron)
+    stack = [self._root]
+    while stack:
+      node_pron, unused_max_length, children = stack.pop()
+      cost = self._cost(pron, node_pron)
+      self._evaluations += 1
+      # A pron is at distance 0 from itself, whatever its cost.
+      if (node_pron == pron or
+          cost <= max_distance * (length + len(node_pron))):
+        result.append(node_pron)
+      for child_cost, child in children.iteritems():
+        # Where both have no path, nothing rules the child out.
+        if cost == child_cost: difference = 0
+        else: difference = abs(cost - child_cost)
+        if difference <= max_distance * (length + child[1]):
+          stack.append(child)
+    return result
+
+  def take_stats(self):
+    """Returns the counts since the last call, and resets them.
+
+    Returns:
+      (number of queries, costs computed, costs a scan would have computed)
+    """
+    stats = self._queries, self._evaluations, self._possible
+    self._queries = self._evaluations = self._possible = 0
+    return stats
+# END: class BKTree
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Precomputed lists of the close prons of every morph of the base morphs.
+
+The base morph languages are finite and the distances fixed, so the prons
+within _MAX_DISTANCE of any morph are always the same. A table built once
+lists them for every string of the languages, and closest_prons then only has
+to pick out the ones currently useful.
+
+The table is a binary file holding the prons and, for each pron, its
+neighbours sorted by distance, each as a pron index, a float32 cost and an
+8-bit path length. It records the distance mode it was built with, since the
+two modes may choose different paths of equal cost, and likewise whether the
+grammar was prepared, as well as the largest distance it keeps. Runs refuse a
+table that does not match them in all three.
+
+To build it, after the grammars:
+
+  neighbour_table.py --output=Grm/neighbours.bin --distance_mode=dp
+
+and then run with --neighbour_table=Grm/neighbours.bin.
+
+Building lists every string of the languages and compares each with those a
+pron_trie.PronTrie cannot rule out, so only the smallest language is worth
+covering. MONOSYLLABLE has on the order of 10^4 strings, which the default
+--max_prons allows. SESQUISYLLABLE has on the order of 10^5 and DISYLLABLE of
+10^8: the first would take days, and the second cannot even be listed in
+memory, so both are refused unless --max_prons is raised. Runs with those base
+morphs still gain from a MONOSYLLABLE table, for the prons it covers.
+"""
+
+import array
+import os
+import struct
+import sys
+
+import builder
+import flags
+import pynini_interface
+
+from base import _BASE
+
+_MAGIC = 'WENBRS02'
+_HEADER = struct.Struct('<8s8sdIII')
+
+
+def _weighted_cost(length, cost):
+  """Cost per arc of a sounds_like result.
+  """
+  try:
+    return cost / length
+  except ZeroDivisionError:
+    return float('Infinity')
+
+
+def _native(values):
+  """Converts an array between little-endian and the machine's order.
+  """
+  if sys.byteorder == 'big':
+    values.byteswap()
+  return values
+
+
+def write_table(outfile, mode, max_distance, prepare, prons, neighbours):
+  """Writes a neighbour table.
+
+  Args:
+    outfile: output file
+    mode: distance mode the distances were computed with
+    max_distance: largest distance kept
+    prepare: whether the distance grammar was prepared
+    prons: list of prons
+    neighbours: list with, for each pron, a list of (pron index, length,
+      cost) sorted by distance
+  Returns:
+    None
+  """
+  offsets = array.array('I', [0])
+  ids = array.array('I')
+  costs = array.array('f')
+  lengths = array.array('B')
+  for row in neighbours:
+    for pron_id, length, cost in row:
+      if length > 0xFF:
+        raise ValueError('Path of length %d is too long for the table' % length)
+      ids.append(pron_id)
+      costs.append(cost)
+      lengths.append(length)
+    offsets.append(len(ids))
+  names = '\n'.join(prons)
+  tmp = '%s.%d.tmp' % (outfile, os.getpid())
+  with open(tmp, 'wb') as stream:
+    stream.write(_HEADER.pack(_MAGIC, mode, max_distance, int(bool(prepare)),
+                              len(prons), len(ids)))
+    stream.write(struct.pack('<I', len(names)))
+    stream.write(names)
+    for values in (offsets, ids, costs, lengths):
+      stream.write(_native(values).tostring())
+  os.rename(tmp, outfile)
+
+
+# BEGIN: class NeighbourTable
+class NeighbourTable(object):
+  """Neighbour table read from a file.
+  """
+  def __init__(self, path):
+    with open(path, 'rb') as stream:
+      header = stream.read(_HEADER.size)
+      if len(header) != _HEADER.size:
+        raise ValueError('%s is not a neighbour table' % path)
+      (magic, mode, self._max_distance, prepare,
+       nprons, nentries) = _HEADER.unpack(header)
+      if magic != _MAGIC:
+        raise ValueError('%s is not a neighbour table' % path)
+      self._mode = mode.rstrip('\0')
+      self._prepare = bool(prepare)
+      size, = struct.unpack('<I', stream.read(4))
+      self._prons = stream.read(size).split('\n') if nprons else []
+      self._ids = dict((pron, i) for i, pron in enumerate(self._prons))
+      self._offsets = self._read(stream, 'I', nprons + 1)
+      self._neighbour_ids = self._read(stream, 'I', nentries)
+      self._costs = self._read(stream, 'f', nentries)
+      self._lengths = self._read(stream, 'B', nentries)
+
+  def _read(self, stream, typecode, n):
+    values = array.array(typecode)
+    values.fromstring(stream.read(n * values.itemsize))
+    if len(values) != n:
+      raise ValueError('Truncated neighbour table')
+    return _native(values)
+
+  @property
+  def mode(self):
+    return self._mode
+
+  @property
+  def max_distance(self):
+    return self._max_distance
+
+  @property
+  def prepare(self):
+    return self._prepare
+
+  def __len__(self):
+    return len(self._prons)
+
+  def __contains__(self, pron):
+    return pron in self._ids
+
+  def neighbours(self, pron):
+    """Lists the prons close to pron, other than pron itself.
+
+    Args:
+      pron: a pron in the table
+    Returns:
+      list of (pron, distance), closest first
+    """
+    pron_id = self._ids[pron]
+    prons = self._prons
+    ids = self._neighbour_ids
+    costs = self._costs
+    lengths = self._lengths
+    return [(prons[ids[i]], _weighted_cost(lengths[i], costs[i]))
+            for i in xrange(self._offsets[pron_id],
+                            self._offsets[pron_id + 1])]
+# END: class NeighbourTable
+
+
+_TABLES = {}
+
+
+def load(path):
+  """Loads a neighbour table, keeping it while the file is unchanged.
+
+  Args:
+    path: file written by write_table
+  Returns:
+    a NeighbourTable
+  """
+  key = os.path.abspath(path), os.path.getmtime(path)
+  if key not in _TABLES:
+    _TABLES[key] = NeighbourTable(path)
+  return _TABLES[key]
+
+
+def main(argv):
+  flags.define_flag('output',
+                    '%s/Grm/neighbours.bin' % _BASE,
+                    'File to write the table to')
+  flags.define_flag('base_morphs',
+                    'MONOSYLLABLE',
+                    'Comma-separated base morph rules to cover')
+  flags.define_flag('max_prons',
+                    '50000',
+                    'Largest number of strings of the base morphs to cover; '
+                    '0 for no limit')
+  flags.define_flag('ablaut',
+                    '1',
+                    'Whether to also cover the ablauted forms')
+  flags.define_flag('distance_mode',
+                    'fst',
+                    'Distance mode of the runs that will use the table')
+  flags.define_flag('max_distance',
+                    '0.6',
+                    'Largest distance to keep; that of lexicon.py')
+  flags.define_flag('prepare_grammars',
+                    '0',
+                    'Whether the runs that will use the table prepare the '
+                    'distance grammar; that of lexicon.py')
+  flags.define_flag('build_grammars',
+                    '0',
+                    'Whether to build the grammars first')
+  flags.parse_flags(argv[1:])
+  pynini_interface.PREPARE_RULES = bool(flags.FLAGS_prepare_grammars)
+  if flags.FLAGS_build_grammars:
+    builder.build_morphology_grammar()
+    builder.build_soundslike_grammar()
+  builder.load_vowel_definitions()
+  builder.build_neighbour_table(flags.FLAGS_output,
+                                flags.FLAGS_base_morphs.split(','),
+                                float(flags.FLAGS_max_distance),
+                                flags.FLAGS_distance_mode,
+                                flags.FLAGS_ablaut,
+                                max_prons=flags.FLAGS_max_prons)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
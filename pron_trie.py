@@ -0,0 +1,122 @@
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Trie of pronunciations, for the distances from one pron to all of them.
+
+The dynamic programming of edit_distance fills one row per segment of the
+second string, each depending only on the row before it and the segment. The
+prons sharing a prefix therefore share the rows of that prefix, and walking
+the trie of the prons computes each row once, by EditDistance.extend along the
+edge to the node.
+
+A subtree is cut off once every alignment through its node is too costly.
+Costs are never negative, so the cost of aligning pron1 with any pron below a
+node is at least the least cost in the row of the node. A path between prons
+of lengths m and n has at most m + n arcs, so if that least cost exceeds
+max_distance * (m + n) for the longest pron n below the node, none of them is
+within max_distance. The path to pron1 itself is never cut, since a pron is at
+distance 0 from itself whatever its cost.
+
+The distances found are those of EditDistance.distance, as used by the 'dp'
+distance mode.
+"""
+
+import edit_distance
+
+# Slack for rounding in the bounds; distances are computed exactly anyway.
+_SLACK = 1e-9
+
+
+# BEGIN: class PronTrie
+class PronTrie(object):
+  """Trie of a list of prons under the costs of an EditDistance.
+
+  Each node is a list of a dict from segment to child, the (index, pron) of
+  the prons ending there, and the length of the longest pron below it.
+  """
+  def __init__(self, distance, prons):
+    self._distance = distance
+    self._root = [{}, [], 0]
+    # Rows that computing each distance separately would take.
+    self._rows_per_query = 0
+    self._queries = 0
+    self._rows = 0
+    for i, pron in enumerate(prons):
+      self._add(i, pron)
+
+  def _add(self, i, pron):
+    """Adds a pron under its index.
+    """
+    self._rows_per_query += len(pron)
+    node = self._root
+    node[2] = max(node[2], len(pron))
+    for segment in pron:
+      try:
+        node = node[0][segment]
+      except KeyError:
+        node[0][segment] = child = [{}, [], 0]
+        node = child
+      node[2] = max(node[2], len(pron))
+    node[1].append((i, pron))
+
+  def distances(self, pron1, max_distance, encoded=False):
+    """Finds the distances from pron1 to the prons that may be close.
+
+    Args:
+      pron1: pronunciation
+      max_distance: largest cost per arc of interest
+      encoded: if True, gives the distances as edit_distance.encode does,
+        rather than per arc
+    Returns:
+      list of (index, pron, distance), including all prons within
+      max_distance, in no particular order
+    """
+    self._queries += 1
+    extend = self._distance.extend
+    decode = edit_distance.decode
+    weighted = edit_distance.weighted
+    bound = max_distance * (1 + _SLACK)
+    length = len(pron1)
+    result = []
+    stack = [(self._root, self._distance.first_row(pron1), 0, True)]
+    while stack:
+      node, row, depth, on_path = stack.pop()
+      for i, pron2 in node[1]:
+        if on_path and depth == length:
+          result.append((i, pron2, 0))
+        else:
+          value = row[-1]
+          result.append((i, pron2, value if encoded else weighted(value)))
+      for segment, child in node[0].iteritems():
+        child_row = extend(row, pron1, segment)
+        self._rows += 1
+        child_on_path = (on_path and depth < length and
+                         pron1[depth] == segment)
+        if (not child_on_path and
+            decode(min(child_row))[1] > bound * (length + child[2])):
+          continue
+        stack.append((child, child_row, depth + 1, child_on_path))
+    return result
+
+  def take_stats(self):
+    """Returns the counts since the last call, and resets them.
+
+    Returns:
+      (number of queries, rows computed, rows computing each distance
+      separately would have taken)
+    """
+    stats = self._queries, self._rows, self._queries * self._rows_per_query
+    self._queries = self._rows = 0
+    return stats
+# END: class PronTrie
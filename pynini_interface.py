@@ -12,15 +12,147 @@
 ##
 ## Author: Richard Sproat (rws@xoba.com)
 
+import os
+import random
+import threading
 import time
-import sys
 
 from pynini import *
 
 from base import _BASE
 
-_LOADED_FARS = {}
-_LOADED_FSTS = {}
+
+class GrammarError(Exception):
+  """A far or a rule in it could not be loaded.
+  """
+  pass
+
+
+# BEGIN: class GrammarRegistry
+class GrammarRegistry(object):
+  """Rules loaded from fars, shared by all threads.
+
+  Rules are keyed by the absolute path of their far, their name and the
+  modification time of the far, so rules of the same name in different fars
+  are kept apart, and a far that is rebuilt is read again. The key of a rule
+  is worked out once, since sounds_like asks for it for every pair, and the
+  far is only looked at again on a forced load or after refresh, which
+  builder.build_grammar calls. Only the rules asked for are read from the far.
+
+  A rule may also be loaded prepared for composition on the right: optimized
+  and sorted on its input labels. This is kept separately from the rule as
+  read, since the paths chosen among those of equal cost may differ.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._fsts = {}
+    self._keys = {}  # Maps (far, rule, prepare) as given to the key
+
+  def key(self, rule, far, prepare=False, refresh=False):
+    """Returns the key of a rule in the far.
+
+    Args:
+      rule: Rule name
+      far: Far name
+      prepare: whether the rule is wanted prepared for composition
+      refresh: if True, looks at the far as it now is, rather than as it was
+        when the key was first asked for
+    Returns:
+      key for load
+    """
+    try:
+      if not refresh:
+        return self._keys[far, rule, prepare]
+    except KeyError:
+      pass
+    path = os.path.abspath(far)
+    try:
+      mtime = os.path.getmtime(path)
+    except OSError:
+      raise GrammarError('Failed loading far from %s' % far)
+    key = self._keys[far, rule, prepare] = path, rule, mtime, bool(prepare)
+    return key
+
+  def refresh(self):
+    """Forgets the keys worked out so far, e.g. after the fars are rebuilt.
+
+    Returns:
+      None
+    """
+    self._keys = {}
+
+  def load(self, key, force=False):
+    """Loads the rule with the given key, if not already loaded.
+
+    Args:
+      key: as returned by key
+      force: If True, forces reload
+    Returns:
+      loaded fst
+    """
+    with self._lock:
+      if force or key not in self._fsts:
+        path, rule, unused_mtime, prepare = key
+        try:
+          fst = Far(path)[rule]
+        except pywrapfst.FstIOError:
+          raise GrammarError('Failed loading far from %s' % path)
+        except KeyError:
+          raise GrammarError('No rule "%s" in %s' % (rule, path))
+        if prepare:
+          fst.optimize()
+          fst.arcsort(sort_type='ilabel')
+        # Drops the rule as read from an earlier version of the far.
+        for old in [k for k in self._fsts
+                    if k[:2] == key[:2] and k[2] != key[2]]:
+          del self._fsts[old]
+        self._fsts[key] = fst
+      return self._fsts[key]
+
+  def get(self, rule, far, force=False, prepare=False):
+    """Loads a rule from a far, if not already loaded.
+
+    Args:
+      rule: Rule name
+      far: Far name
+      force: If True, forces reload
+      prepare: whether to optimize and arc-sort the rule
+    Returns:
+      loaded fst
+    """
+    return self.load(self.key(rule, far, prepare, refresh=force), force)
+
+  def find(self, rule):
+    """Finds a loaded rule by name alone.
+
+    Args:
+      rule: Rule name
+    Returns:
+      loaded fst, if exactly one far has been read for a rule of that name
+    """
+    with self._lock:
+      fsts = [fst for key, fst in self._fsts.items()
+              if key[1] == rule and not key[3]]
+    if not fsts:
+      raise GrammarError('Missing transducer %s' % rule)
+    if len(fsts) > 1:
+      raise GrammarError('Transducer %s is loaded from several fars' % rule)
+    return fsts[0]
+
+  def loaded(self):
+    """Lists the loaded rules.
+
+    Returns:
+      list of (key, fst)
+    """
+    with self._lock:
+      return self._fsts.items()
+# END: class GrammarRegistry
+
+
+GRAMMARS = GrammarRegistry()
+# Whether sounds_like uses its rule prepared for composition.
+PREPARE_RULES = False
 
 
 def load_rule_from_far(rule, far, force=False):
@@ -31,22 +163,9 @@ def load_rule_from_far(rule, far, force=False):
     far: Far name
     force: If True, forces reload
   Returns:
-    loaded fst or fail if no such fst or far
+    loaded fst; raises GrammarError if no such fst or far
   """
-  try:
-    if force or far not in _LOADED_FARS:
-      _LOADED_FARS[far] = Far(far)
-    # TODO(rws): If there is the same rule name in different fars, then this
-    # will just get the first one we encounter.
-    if force or rule not in _LOADED_FSTS:
-      _LOADED_FSTS[rule] = _LOADED_FARS[far][rule]
-    return _LOADED_FSTS[rule]
-  except pywrapfst.FstIOError:
-    sys.stderr.write('Failed loading far from %s\n' % far)
-    sys.exit(1)
-  except KeyError:
-    sys.stderr.write('No rule "%s" in %s\n' % (rule, far))
-    sys.exit(1)
+  return GRAMMARS.get(rule, far, force)
 
 
 def to_fst(s, syms='byte'):
@@ -73,25 +192,30 @@ def to_string(t):
   return t.stringify()
 
 
-def random_paths(t, n=1):
+def random_paths(t, n=1, seed=None):
   """Computes a set of random paths from an fst
 
   Args:
-    t: fst
-    n: number of paths 
+    t: fst, or the name of a loaded rule
+    n: number of paths
+    seed: if not None, seeds the paths deterministically, otherwise uses the
+      time. The seed of each path is drawn from a generator of its own seeded
+      with it, so that nearby seeds give unrelated lists of paths.
   Returns:
     list of random path strings
   """
   if type(t) == type('string'):
-    try:
-      t = _LOADED_FSTS[t]
-    except KeyError:
-      sys.stderr.write('Missing transducer %s\n' % t)
-      return []
+    t = GRAMMARS.find(t)
+  if seed is not None:
+    rng = random.Random(seed)
   i = 0
   paths = []
   while i < n:
-    output = randgen(t, seed=int(time.time() * 1000000), select='uniform')
+    if seed is None:
+      path_seed = int(time.time() * 1000000)
+    else:
+      path_seed = rng.randint(0, 2 ** 31 - 1)
+    output = randgen(t, seed=path_seed, select='uniform')
     output.rmepsilon()
     output.topsort()
     paths.append(output.stringify())
@@ -99,33 +223,187 @@ def random_paths(t, n=1):
   return paths
 
 
+def finite_strings(t):
+  """Lists the output strings of an acyclic fst.
+
+  Args:
+    t: fst, which must be acyclic, over bytes, or the name of a loaded rule
+  Returns:
+    sorted list of the distinct strings
+  """
+  if type(t) == type('string'):
+    t = GRAMMARS.find(t)
+  strings = set()
+  start = t.start()
+  if start < 0:
+    return []
+  # Depth-first over the paths, with the string so far.
+  stack = [(start, '')]
+  while stack:
+    state, prefix = stack.pop()
+    if weight_value(t.final(state)) != float('inf'):
+      strings.add(prefix)
+    for arc in t.arcs(state):
+      if arc.olabel:
+        stack.append((arc.nextstate, prefix + chr(arc.olabel)))
+      else:
+        stack.append((arc.nextstate, prefix))
+  return sorted(strings)
+
+
+def count_paths(t):
+  """Counts the successful paths of an acyclic fst, without listing them.
+
+  This bounds the number of strings finite_strings would list, and equals it
+  unless several paths give the same string.
+
+  Args:
+    t: fst, which must be acyclic, or the name of a loaded rule
+  Returns:
+    number of paths
+  """
+  if type(t) == type('string'):
+    t = GRAMMARS.find(t)
+  start = t.start()
+  if start < 0:
+    return 0
+  # Paths from each state, filled in once those of its successors are known.
+  counts = {}
+  stack = [start]
+  while stack:
+    state = stack[-1]
+    if state in counts:
+      stack.pop()
+      continue
+    pending = [arc.nextstate for arc in t.arcs(state)
+               if arc.nextstate not in counts]
+    if pending:
+      stack.extend(pending)
+      continue
+    stack.pop()
+    count = 1 if weight_value(t.final(state)) != float('inf') else 0
+    for arc in t.arcs(state):
+      count += counts[arc.nextstate]
+    counts[state] = count
+  return counts[start]
+
+
 _CACHED_COMPOSITIONS = {}
 
 
-def sounds_like(s1, s2, rule='EDIT_DISTANCE',
-                far=('%s/Grm/soundslike.far' % _BASE)):
-  """Computes the distance between two phonetic strings given a grammar.
+def weight_value(weight):
+  """Reads a tropical weight as a float.
 
   Args:
-    s1: phonetic string 1
-    s2: phonetic string 2
-    grm: phonetic similarity grammar
+    weight: pynini weight
   Returns:
-    number of arcs in shortest path, shortest distance
+    float
   """
-  grmfst = load_rule_from_far(rule, far)
-  if (s1, rule) in _CACHED_COMPOSITIONS:
-    fst1 = _CACHED_COMPOSITIONS[s1, rule]
-  else:
-    fst1 = s1 * grmfst
-    _CACHED_COMPOSITIONS[s1, rule] = fst1
-  result = shortestpath(fst1 * s2)
+  return float(weight)
+
+
+def _left_composition(s1, key, fst1=None):
+  """Composes s1 with a rule, keeping the result for later pairs.
+
+  Args:
+    s1: phonetic string
+    key: key of the rule in GRAMMARS
+    fst1: if not None, an acceptor of s1 already built
+  Returns:
+    s1 composed with the rule
+  """
+  if (s1, key) in _CACHED_COMPOSITIONS:
+    return _CACHED_COMPOSITIONS[s1, key]
+  # The rule is only looked up, under the registry's lock, on a miss.
+  if fst1 is None:
+    fst1 = s1
+  _CACHED_COMPOSITIONS[s1, key] = fst1 * GRAMMARS.load(key)
+  return _CACHED_COMPOSITIONS[s1, key]
+
+
+def _best_path(lattice, max_cost=None):
+  """Finds the length and cost of the shortest path of a lattice.
+
+  Args:
+    lattice: s1 composed with a rule and then with s2
+    max_cost: if not None, the highest cost of interest
+  Returns:
+    number of arcs in shortest path, shortest distance, as for sounds_like
+  """
+  result = shortestpath(lattice)
+  if result.num_states() == 0:
+    return 0, float('inf')
   result.rmepsilon()
   result.topsort()
   if result.num_states() > 1:
     dist = shortestdistance(result)
-    dist = (float(str(dist[-1])) +
-            float(str(result.final(result.num_states() - 1))))
+    dist = (weight_value(dist[-1]) +
+            weight_value(result.final(result.num_states() - 1)))
+    if max_cost is not None and dist > max_cost:
+      return 0, float('inf')
     return result.num_states() - 1, dist
   else:
     return 0, float('inf')
+
+
+def sounds_like(s1, s2, rule='EDIT_DISTANCE',
+                far=('%s/Grm/soundslike.far' % _BASE), max_cost=None):
+  """Computes the distance between two phonetic strings given a grammar.
+
+  With max_cost, pairs whose best path costs more are reported as having no
+  path. This saves nothing on the search itself: the lattice is composed and
+  its best path found in full before the cost is checked. Callers that want
+  to skip far pairs must rule them out before calling, as
+  builder._fst_neighbours does.
+
+  Args:
+    s1: phonetic string 1
+    s2: phonetic string 2
+    rule: phonetic similarity rule
+    far: far holding the rule
+    max_cost: if not None, the highest cost of interest
+  Returns:
+    number of arcs in shortest path, shortest distance
+  """
+  fst1 = _left_composition(s1, GRAMMARS.key(rule, far, PREPARE_RULES))
+  return _best_path(fst1 * s2, max_cost)
+
+
+def sounds_like_multi(s1, s2s, rules,
+                      far=('%s/Grm/soundslike.far' % _BASE), max_cost=None,
+                      acceptors=None):
+  """Computes the distances from one phonetic string under several grammars.
+
+  The same as sounds_like for each pair of a string of s2s and a rule, but
+  s1 and each string of s2s are made into acceptors once for all the rules,
+  and s1 is composed with each rule once for all of s2s.
+
+  Args:
+    s1: phonetic string 1
+    s2s: list of phonetic strings
+    rules: list of phonetic similarity rules
+    far: far holding the rules
+    max_cost: if not None, the highest cost of interest
+    acceptors: if not None, dict from string to its acceptor, used and
+      added to, so that a caller comparing many strings builds each once
+  Returns:
+    list with, for each string of s2s, a list with, for each rule, the number
+    of arcs in the shortest path and the shortest distance
+  """
+  if acceptors is None:
+    acceptors = {}
+  compositions = []
+  for rule in rules:
+    key = GRAMMARS.key(rule, far, PREPARE_RULES)
+    if s1 not in acceptors and (s1, key) not in _CACHED_COMPOSITIONS:
+      acceptors[s1] = to_fst(s1)
+    compositions.append(_left_composition(s1, key, acceptors.get(s1)))
+  result = []
+  for s2 in s2s:
+    try:
+      fst2 = acceptors[s2]
+    except KeyError:
+      fst2 = acceptors[s2] = to_fst(s2)
+    result.append([_best_path(composition * fst2, max_cost)
+                   for composition in compositions])
+  return result
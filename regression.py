@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Performance regression harness.
+
+Runs a fixed set of seeded configurations (each base morph, with and without
+ablaut and with and without freezing, at several sizes) and records for each
+the wall time, the peak RSS and the trajectory of the proportions reported by
+stats.py. These are compared with the baselines in --baselines: a run fails if
+it is slower or bigger than its baseline by more than the tolerances, or if
+any proportion of its trajectory moves by more than --trajectory_tolerance.
+Every invocation is added to the history in --history.
+
+Usage:
+
+  regression.py --update_baselines=1   # on the reference version
+  regression.py                        # on the candidate version
+
+Any other flags are passed to the runs, e.g. --distance_mode=dp.
+"""
+
+import json
+import os
+import sys
+import time
+
+import builder
+import catalog
+import flags
+import lexicon
+
+from base import _BASE
+
+_OWN_FLAGS = ['base_morphs', 'sizes', 'seeds', 'freeze_at', 'baselines',
+              'history', 'update_baselines', 'time_tolerance', 'rss_tolerance',
+              'trajectory_tolerance']
+
+
+def _list(value):
+  """Parses a comma-separated flag value.
+  """
+  return [v.strip() for v in str(value).split(',') if v.strip()]
+
+
+def configurations():
+  """Lists the configurations given by the flags.
+
+  Returns:
+    list of (name, list of flags for lexicon.py)
+  """
+  configs = []
+  for base_morph in _list(flags.FLAGS_base_morphs):
+    for size in _list(flags.FLAGS_sizes):
+      for ablaut in (0, 1):
+        for freeze in (0, flags.FLAGS_freeze_at):
+          for seed in _list(flags.FLAGS_seeds):
+            name = '%s-n_%s-ablaut_%d-freeze_%d-seed_%s' % (
+              base_morph, size, ablaut, freeze, seed)
+            configs.append((name, ['--base_morph=%s' % base_morph,
+                                   '--nmorphs=%s' % size,
+                                   '--ablaut=%d' % ablaut,
+                                   '--freeze_phonetics_at_iter=%d' % freeze,
+                                   '--freeze_semantics_at_iter=%d' % freeze,
+                                   '--seed=%s' % seed]))
+  return configs
+
+
+def run(args):
+  """Runs a simulation in a child process and measures it.
+
+  Args:
+    args: list of flags for lexicon.py
+  Returns:
+    dict with "status", "seconds" and "max_rss_kb"
+  """
+  start = time.time()
+  sys.stdout.flush()
+  pid = os.fork()
+  if pid == 0:
+    status = 0
+    try:
+      flags.reset_flags()
+      flags.parse_flags(args)
+      lexicon.run_simulation(build_grammars=False)
+    except BaseException as err:
+      sys.stderr.write('%s\n' % err)
+      status = 1
+    sys.stdout.flush()
+    os._exit(status)
+  unused_pid, status, usage = os.wait4(pid, 0)
+  return {'status': 'error' if status else 'ok',
+          'seconds': time.time() - start,
+          'max_rss_kb': usage.ru_maxrss}
+
+
+def trajectory(outdir):
+  """Reads the proportions reported by stats.py for each iteration of a run.
+
+  Args:
+    outdir: output directory of the run
+  Returns:
+    list of [spelled, semphon, phon, sem] as proportions of the morphs
+  """
+  result = []
+  for row in catalog.run_counts(outdir):
+    morphs = float(row[1]) or 1.0
+    result.append([round(count / morphs, 6) for count in row[2:]])
+  return result
+
+
+def compare(result, baseline):
+  """Compares a run with its baseline.
+
+  Args:
+    result: dict describing the run
+    baseline: dict describing the baseline run
+  Returns:
+    list of strings describing the failures
+  """
+  failures = []
+  if result['status'] != 'ok':
+    return ['run failed']
+  for key, tolerance in (('seconds', flags.FLAGS_time_tolerance),
+                         ('max_rss_kb', flags.FLAGS_rss_tolerance)):
+    if result[key] > baseline[key] * (1 + tolerance):
+      failures.append('%s %.1f exceeds baseline %.1f by more than %d%%' % (
+        key, result[key], baseline[key], tolerance * 100))
+  old = baseline['trajectory']
+  new = result['trajectory']
+  if len(old) != len(new):
+    failures.append('%d iterations instead of %d' % (len(new), len(old)))
+  names = ['spelled', 'semphon', 'phon', 'sem']
+  for i, (old_row, new_row) in enumerate(zip(old, new)):
+    for name, x, y in zip(names, old_row, new_row):
+      if abs(x - y) > flags.FLAGS_trajectory_tolerance:
+        failures.append('iteration %d: %s is %.3f instead of %.3f' % (
+          i, name, y, x))
+  return failures
+
+
+def _load(path, default):
+  try:
+    with open(path) as stream:
+      return json.load(stream)
+  except IOError:
+    return default
+
+
+def _save(path, data):
+  tmp = '%s.%d.tmp' % (path, os.getpid())
+  with open(tmp, 'w') as stream:
+    json.dump(data, stream, indent=1, sort_keys=True)
+  os.rename(tmp, path)
+
+
+def main(argv):
+  lexicon.define_flags()
+  flags.define_flag('base_morphs',
+                    'MONOSYLLABLE,SESQUISYLLABLE,DISYLLABLE',
+                    'Comma-separated base morphs to run')
+  flags.define_flag('sizes',
+                    '250,1000',
+                    'Comma-separated numbers of morphs to run')
+  flags.define_flag('seeds',
+                    '1',
+                    'Comma-separated seeds to run each configuration with')
+  flags.define_flag('freeze_at',
+                    '3',
+                    'Iteration to freeze at in the frozen configurations')
+  flags.define_flag('baselines',
+                    '%s/regression_baselines.json' % _BASE,
+                    'JSON file of the baseline runs')
+  flags.define_flag('history',
+                    '%s/regression_history.json' % _BASE,
+                    'JSON file to add the results to')
+  flags.define_flag('update_baselines',
+                    '0',
+                    'Whether to make these runs the baselines')
+  flags.define_flag('time_tolerance',
+                    '0.25',
+                    'Allowed increase in wall time, as a fraction')
+  flags.define_flag('rss_tolerance',
+                    '0.25',
+                    'Allowed increase in peak RSS, as a fraction')
+  flags.define_flag('trajectory_tolerance',
+                    '0.0',
+                    'Allowed change in any proportion of the trajectory')
+  flags.parse_flags(argv[1:])
+  common = [arg for arg in argv[1:]
+            if arg.split('=', 1)[0].lstrip('-') not in _OWN_FLAGS + ['outdir']]
+  outdir = flags.FLAGS_outdir
+  builder.build_morphology_grammar()
+  builder.build_soundslike_grammar()
+  baselines = _load(flags.FLAGS_baselines, {})
+  results = {}
+  failures = {}
+  update = flags.FLAGS_update_baselines
+  for name, args in configurations():
+    run_outdir = '%s/%s' % (outdir, name)
+    result = run(common + args + ['--outdir=%s' % run_outdir])
+    result['trajectory'] = trajectory(run_outdir)
+    results[name] = result
+    if update: continue
+    if name not in baselines:
+      print '%-50s no baseline' % name
+      continue
+    problems = compare(result, baselines[name])
+    if problems:
+      failures[name] = problems
+    print '%-50s %6.1fs (baseline %6.1fs) %s' % (
+      name, result['seconds'], baselines[name]['seconds'],
+      'FAIL' if problems else 'ok')
+    for problem in problems:
+      print '  ', problem
+  record = {'time': time.time(),
+            'args': common,
+            'update_baselines': update,
+            'results': results,
+            'failures': failures}
+  _save(flags.FLAGS_history, _load(flags.FLAGS_history, []) + [record])
+  if update:
+    baselines.update(results)
+    _save(flags.FLAGS_baselines, baselines)
+    print 'Updated %d baselines in %s' % (len(results), flags.FLAGS_baselines)
+  if failures:
+    print '%d of %d configurations failed' % (len(failures), len(results))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,186 @@
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Cache of finished runs, keyed by everything that determines their outputs.
+
+A seeded run is fully determined by its flags, the seed among them, by the
+grammars and phoneme table in Grm, by the files its flags name, and by the
+code. The key of a run is a SHA-1 over all of these, the files by their
+contents. Flags that only say where or how the outputs are written, or that do
+not change the results, are left out of the key; see _UNKEYED_FLAGS.
+
+Each finished run is kept under <cache>/<first two digits of key>/<key>/, with
+its output files and key.json describing what went into the key. A later run
+with the same key copies or hard-links these files into its own output
+directory instead of running again. Runs seeded from the time are never
+cached.
+
+Entries are written to a temporary directory and renamed into place, so runs
+sharing a cache never see a partial entry.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import flags
+
+from base import _BASE
+
+# Flags that do not change the outputs of a run.
+_UNKEYED_FLAGS = ['outdir', 'run_cache', 'run_cache_links', 'catalog',
+                  'async_output', 'async_output_queue', 'shared_matrix',
+                  'shared_matrix_slots']
+# Flags naming files that the run reads, which are keyed by their contents.
+_FILE_FLAGS = ['concepts_file', 'neighbour_table', 'lexicon_file']
+_KEY_FILE = 'key.json'
+
+
+def file_digest(path):
+  """Hashes the contents of a file.
+
+  Args:
+    path: path of the file
+  Returns:
+    hex SHA-1 of the contents
+  """
+  digest = hashlib.sha1()
+  with open(path, 'rb') as stream:
+    while True:
+      block = stream.read(1 << 20)
+      if not block: break
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def _directory_digests(directory, suffixes):
+  """Hashes the files of a directory with the given suffixes.
+
+  Args:
+    directory: directory
+    suffixes: tuple of suffixes, e.g. ('.py',)
+  Returns:
+    dict from file name to hex SHA-1
+  """
+  digests = {}
+  for name in sorted(os.listdir(directory)):
+    if name.endswith(suffixes):
+      digests[name] = file_digest(os.path.join(directory, name))
+  return digests
+
+
+def describe_run(names):
+  """Lists what determines the outputs of the run given by the flags.
+
+  Args:
+    names: names of the flags of a simulation
+  Returns:
+    dict with the values of the flags, and the digests of the grammars and
+    the code
+  """
+  options = {}
+  for name in names:
+    if name in _UNKEYED_FLAGS: continue
+    value = getattr(flags, 'FLAGS_%s' % name)
+    if name in _FILE_FLAGS and value:
+      value = 'sha1:%s' % file_digest(value)
+    options[name] = value
+  return {'flags': options,
+          'grammars': _directory_digests('%s/Grm' % _BASE, ('.far', '.tsv')),
+          'code': _directory_digests(_BASE, ('.py',))}
+
+
+def run_key(description):
+  """Computes the key of a run.
+
+  Args:
+    description: dict from describe_run
+  Returns:
+    hex SHA-1
+  """
+  return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+
+def _entry(cache, key):
+  return os.path.join(cache, key[:2], key)
+
+
+def fetch(cache, key, outdir, link=False):
+  """Puts the outputs of a cached run into an output directory.
+
+  Args:
+    cache: cache directory
+    key: key of the run
+    outdir: output directory, which must exist
+    link: if True, hard-links the files where possible rather than copying
+  Returns:
+    True if the run was in the cache
+  """
+  entry = _entry(cache, key)
+  if not os.path.isdir(entry):
+    return False
+  for name in sorted(os.listdir(entry)):
+    if name == _KEY_FILE: continue
+    source = os.path.join(entry, name)
+    target = os.path.join(outdir, name)
+    # Files left from earlier runs are replaced, not written through.
+    if os.path.lexists(target):
+      os.remove(target)
+    if link:
+      try:
+        os.link(source, target)
+        continue
+      except OSError:
+        pass
+    shutil.copy2(source, target)
+  return True
+
+
+def store(cache, key, description, outdir, names):
+  """Adds the outputs of a finished run to the cache.
+
+  Only the files the run wrote are stored, since outdir may also hold files
+  left by earlier runs, e.g. later snapshots of a longer one.
+
+  Args:
+    cache: cache directory
+    key: key of the run
+    description: dict from describe_run
+    outdir: output directory of the run
+    names: names of the files in outdir written by the run
+  Returns:
+    None
+  """
+  entry = _entry(cache, key)
+  if os.path.isdir(entry):
+    return
+  parent = os.path.dirname(entry)
+  try:
+    os.makedirs(parent)
+  except OSError:
+    pass
+  tmp = '%s.%d.tmp' % (entry, os.getpid())
+  shutil.rmtree(tmp, ignore_errors=True)
+  os.mkdir(tmp)
+  # The cache keeps copies of its own, so later changes to outdir leave it be.
+  for name in sorted(names):
+    shutil.copy2(os.path.join(outdir, name), os.path.join(tmp, name))
+  with open(os.path.join(tmp, _KEY_FILE), 'w') as stream:
+    json.dump(description, stream, indent=1, sort_keys=True)
+  try:
+    os.rename(tmp, entry)
+  except OSError:
+    # Another run stored the same key first.
+    shutil.rmtree(tmp, ignore_errors=True)
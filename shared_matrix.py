@@ -0,0 +1,204 @@
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Distance table shared between simulation processes through a mapped file.
+
+Several runs going on side by side mostly compare the same pairs of
+pronunciations. Placing the file on a memory filesystem such as /dev/shm lets
+all of them fill and read a single table.
+
+The table is an open-addressing hash table of 64-bit slots. Each slot packs a
+fingerprint of the pair of pronunciations together with the raw sounds_like
+result, the path length and the cost in units of 0.5, which is exact for the
+weights in Grm/soundslike.grm. The slots are read and written through a ctypes
+array of 64-bit integers over the mapping, so each is a single aligned 8-byte
+load or store, and readers never need a lock: they see either an empty slot or
+a whole entry, never the fingerprint of one entry with the result of another.
+Two writers racing for the same slot can at worst lose one of the entries,
+which is then simply computed again. The slots are in the byte order of the
+machine, so the table is only for processes on one host.
+
+The header records the grammar version together with the distance mode and
+whether the grammar was prepared, since each of these can change the results
+stored, and a table whose header does not match the run is refused.
+"""
+
+import ctypes
+import errno
+import hashlib
+import mmap
+import os
+import struct
+
+_MAGIC = 'WEDIST02'
+_HEADER = struct.Struct('<8sQQ8sQ')
+_SLOT_SIZE = ctypes.sizeof(ctypes.c_uint64)
+_MAX_PROBES = 16
+_INFINITE_COST = 0xFFFF
+_MAX_LENGTH = 0xFF
+_FINGERPRINT_BIT = 1 << 39
+
+
+def _hash(pron1, pron2):
+  """Hashes a pair of pronunciations.
+
+  Args:
+    pron1: first pronunciation
+    pron2: second pronunciation
+  Returns:
+    tuple of the slot hash and a non-zero 40-bit fingerprint
+  """
+  slot_hash, fingerprint = struct.unpack(
+    '<QQ', hashlib.md5(pron1 + '\t' + pron2).digest())
+  return slot_hash, (fingerprint & (_FINGERPRINT_BIT - 1)) | _FINGERPRINT_BIT
+
+
+# BEGIN: class SharedDistanceTable
+class SharedDistanceTable(object):
+  """Table of sounds_like results in a file mapped by all processes.
+  """
+  def __init__(self, path, nslots=1 << 22, stamp=0, mode='fst',
+               prepare=False):
+    """Opens the table at path, creating it if needed.
+
+    Args:
+      path: file for the table, preferably on /dev/shm
+      nslots: number of slots if the table is created
+      stamp: grammar version; a table made with another version is refused
+      mode: distance mode; a table made in another mode is refused
+      prepare: whether the grammar is prepared; a table made with the other
+        setting is refused
+    """
+    self._path = path
+    prepare = int(bool(prepare))
+    if not os.path.exists(path):
+      self._create(path, nslots, stamp, mode, prepare)
+    self._file = open(path, 'r+b')
+    header = self._file.read(_HEADER.size)
+    if len(header) != _HEADER.size:
+      raise ValueError('%s is not a shared distance table' % path)
+    (magic, self._nslots, table_stamp,
+     table_mode, table_prepare) = _HEADER.unpack(header)
+    if magic != _MAGIC:
+      raise ValueError('%s is not a shared distance table' % path)
+    if table_stamp != stamp:
+      raise ValueError('%s was built from a different grammar' % path)
+    table_mode = table_mode.rstrip('\0')
+    if table_mode != mode:
+      raise ValueError('%s was built for distance mode %s' %
+                       (path, table_mode))
+    if table_prepare != prepare:
+      raise ValueError('%s was built with prepare_grammars=%d' %
+                       (path, table_prepare))
+    self._map = mmap.mmap(self._file.fileno(),
+                          _HEADER.size + self._nslots * _SLOT_SIZE)
+    # The header is a multiple of 8 bytes and the mapping is page-aligned, so
+    # every slot is aligned.
+    self._words = (ctypes.c_uint64 * self._nslots).from_buffer(self._map,
+                                                               _HEADER.size)
+
+  def _create(self, path, nslots, stamp, mode, prepare):
+    """Creates the table under a temporary name and links it into place.
+
+    Linking fails if another process created the table first, in which case
+    that table is used.
+
+    Args:
+      path: file for the table
+      nslots: number of slots
+      stamp: grammar version
+      mode: distance mode
+      prepare: 1 if the grammar is prepared, else 0
+    Returns:
+      None
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as stream:
+      stream.write(_HEADER.pack(_MAGIC, nslots, stamp, mode, prepare))
+      stream.truncate(_HEADER.size + nslots * _SLOT_SIZE)
+    try:
+      os.link(tmp, path)
+    except OSError as err:
+      if err.errno != errno.EEXIST: raise
+    finally:
+      os.remove(tmp)
+
+  def _slots(self, slot_hash):
+    """Generates the indices of the slots to probe for a hash.
+    """
+    slot = slot_hash % self._nslots
+    for unused_i in range(_MAX_PROBES):
+      yield slot
+      slot += 1
+      if slot == self._nslots:
+        slot = 0
+
+  def get(self, pron1, pron2):
+    """Looks up the sounds_like result for a pair.
+
+    Args:
+      pron1: first pronunciation
+      pron2: second pronunciation
+    Returns:
+      (length, cost) as returned by sounds_like, or None if not in the table
+    """
+    slot_hash, fingerprint = _hash(pron1, pron2)
+    words = self._words
+    for slot in self._slots(slot_hash):
+      word = words[slot]
+      if not word: return None
+      if word >> 24 == fingerprint:
+        cost = (word >> 8) & 0xFFFF
+        if cost == _INFINITE_COST:
+          return word & 0xFF, float('inf')
+        return word & 0xFF, cost / 2.0
+    return None
+
+  def put(self, pron1, pron2, length, cost):
+    """Stores the sounds_like result for a pair.
+
+    Args:
+      pron1: first pronunciation
+      pron2: second pronunciation
+      length: number of arcs in the shortest path
+      cost: cost of the shortest path
+    Returns:
+      True if stored; False if the result cannot be represented exactly or
+      there is no free slot nearby
+    """
+    if cost == float('inf'):
+      half_cost = _INFINITE_COST
+    else:
+      half_cost = cost * 2
+      if half_cost != int(half_cost) or half_cost >= _INFINITE_COST:
+        return False
+      half_cost = int(half_cost)
+    if length > _MAX_LENGTH:
+      return False
+    slot_hash, fingerprint = _hash(pron1, pron2)
+    word = (fingerprint << 24) | (half_cost << 8) | length
+    words = self._words
+    for slot in self._slots(slot_hash):
+      old = words[slot]
+      if not old or old >> 24 == fingerprint:
+        words[slot] = word
+        return True
+    return False
+
+  def close(self):
+    # The array holds on to the mapping, so it goes first.
+    del self._words
+    self._map.close()
+    self._file.close()
+# END: class SharedDistanceTable
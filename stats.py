@@ -18,12 +18,18 @@
 Creates an R script to produce plots in plot.R
 
 Usage: stats.py simulation_output_directory
+       stats.py catalog.db simulation_output_directory
+
+where the second form reads the counts from a catalog made by catalog.py. The
+first reads them from the metrics.jsonl that runs write, if there is one, and
+otherwise from the snapshots of the morphemes.
 """
 
 
-import glob
 import sys
 
+import catalog
+
 _PLOT = """pdf("plot.pdf")
 plot(nsyms, xlab="Epoch", ylab=("Prop"), ylim=c(0, 1),
      type="l", col=1)
@@ -46,7 +52,14 @@ legend(1, 0.9,
 """
 
 
-def main(argv):
+def print_stats(counts):
+  """Prints the statistics and writes plot.R.
+
+  Args:
+    counts: list of (iteration, morphs, spelled, semphon, phon, sem)
+  Returns:
+    None
+  """
   print '%10s\t%10s\t%10s\t%10s\t%10s' % ('# morphs',
                                           'prop spell',
                                           'semphon',
@@ -56,24 +69,8 @@ def main(argv):
   nsemphon_list = []
   nphon_list = []
   nsem_list = []
-  for morph_file in glob.glob(argv[1] + '/morphemes_*.tsv'):
-    nsyms = 0
-    nsemphon = 0
-    nphon = 0
-    nsem = 0
-    tot = 0.0
-    with open(morph_file) as strm:
-      for line in strm:
-        tot += 1
-        if 'NO_SYMBOL' in line:
-          continue
-        nsyms += 1
-        if ':SP>' in line:
-          nsemphon +=1
-        if ':P>' in line:
-          nphon +=1
-        if ':S>' in line:
-          nsem +=1
+  for unused_iteration, tot, nsyms, nsemphon, nphon, nsem in counts:
+    tot = float(tot)
     semphon_str = '%d\t%2.2f' % (nsemphon, nsemphon / float(nsyms))
     phon_str = '%d\t%2.2f' % (nphon, nphon / float(nsyms))
     sem_str = '%d\t%2.2f' % (nsem, nsem / float(nsyms))
@@ -91,5 +88,19 @@ def main(argv):
     plot.write(_PLOT)
 
 
+def main(argv):
+  if len(argv) > 2:
+    run_catalog = catalog.Catalog(argv[1])
+    run_id = run_catalog.run_id(argv[2])
+    if run_id is None:
+      sys.stderr.write('%s is not in %s\n' % (argv[2], argv[1]))
+      sys.exit(1)
+    counts = run_catalog.trajectory(run_id)
+    run_catalog.close()
+  else:
+    counts = catalog.run_counts(argv[1])
+  print_stats(counts)
+
+
 if __name__ == '__main__':
   main(sys.argv)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Runs a sweep over freeze points and numbers of iterations.
+
+All settings in the sweep share a single lexicon, and share the iterations up
+to the point where their freeze settings first differ. At that point the
+process forks, and each child continues with the settings that still agree,
+writing to its own output directory. A sweep over ten freeze points thus costs
+about one run plus the iterations after each branch point.
+
+Each setting is written to
+
+  outdir/freeze_P/freeze_semantics_S/niter_N
+
+with the same files as a run of lexicon.py.
+
+Usage: sweep.py --freeze_phonetics_values=0,2,4 [lexicon.py flags]
+"""
+
+import flags
+import lexicon
+import log
+import os
+import shutil
+import sys
+
+
+# BEGIN: class Branch
+class Branch(object):
+  """One setting of the sweep, with its own output directory and log.
+  """
+  def __init__(self, freeze_phonetics, freeze_semantics, niter, outdir):
+    self._freeze_phonetics = freeze_phonetics
+    self._freeze_semantics = freeze_semantics
+    self._niter = niter
+    self._outdir = outdir
+    self._stream = None
+    self._metrics = None
+
+  def __repr__(self):
+    return self._outdir
+
+  def key(self, i):
+    """What this branch does before iteration i.
+
+    Branches with the same key at every iteration up to i have the same
+    history.
+
+    Args:
+      i: iteration number
+    Returns:
+      tuple of whether phonetics and semantics are frozen at i
+    """
+    return self._freeze_phonetics == i, self._freeze_semantics == i
+
+  @property
+  def niter(self):
+    return self._niter
+
+  @property
+  def last_freeze(self):
+    return max(self._freeze_phonetics, self._freeze_semantics)
+
+  @property
+  def outdir(self):
+    return self._outdir
+
+  @property
+  def stream(self):
+    return self._stream
+
+  @property
+  def metrics(self):
+    return self._metrics
+
+  def open(self):
+    lexicon.make_outdir(self._outdir)
+    self._stream = open(self._outdir + '/log.txt', 'w')
+    self._metrics = open(self._outdir + '/metrics.jsonl', 'w')
+
+  def close(self):
+    if self._stream:
+      self._stream.close()
+      self._stream = None
+    if self._metrics:
+      self._metrics.close()
+      self._metrics = None
+# END: class Branch
+
+
+# BEGIN: class TeeStream
+class TeeStream(object):
+  """Writes the same output to several streams.
+  """
+  def __init__(self, streams):
+    self._streams = streams
+
+  def write(self, message):
+    for stream in self._streams:
+      stream.write(message)
+
+  def flush(self):
+    for stream in self._streams:
+      stream.flush()
+# END: class TeeStream
+
+
+def _int_list(value):
+  """Parses a comma-separated list of ints from a flag value.
+
+  Args:
+    value: flag value, either an int or a comma-separated string
+  Returns:
+    list of ints
+  """
+  return [int(v) for v in str(value).split(',') if v.strip()]
+
+
+def _partition(branches, i):
+  """Partitions branches by what they do before iteration i.
+
+  Args:
+    branches: list of Branch
+    i: iteration number
+  Returns:
+    list of lists of Branch, in order of first appearance
+  """
+  groups = []
+  index = {}
+  for branch in branches:
+    key = branch.key(i)
+    if key not in index:
+      index[key] = len(groups)
+      groups.append([])
+    groups[index[key]].append(branch)
+  return groups
+
+
+def _snapshot(lex, branches, i, stopping=(), stopped=None):
+  """Dumps the morphemes once, and links the dump into the other branches.
+
+  Also adds the counts to the metrics of each branch.
+
+  Args:
+    lex: a Lexicon
+    branches: list of Branch
+    i: iteration number
+    stopping: branches that stop after this iteration
+    stopped: the reason they stop
+  Returns:
+    None
+  """
+  name = '/morphemes_%04d.tsv' % i
+  first = branches[0].outdir + name
+  lex.dump_morphemes(first)
+  for branch in branches[1:]:
+    try:
+      os.link(first, branch.outdir + name)
+    except OSError:
+      shutil.copyfile(first, branch.outdir + name)
+  record = lexicon.metrics_record(lex, i)
+  for branch in branches:
+    if branch in stopping:
+      branch.metrics.write(lexicon.metrics_record(lex, i, stopped))
+    else:
+      branch.metrics.write(record)
+    branch.metrics.flush()
+
+
+def _finish(lex, branch):
+  """Writes the final symbol map for a branch and closes its log.
+
+  Args:
+    lex: a Lexicon
+    branch: a Branch
+  Returns:
+    None
+  """
+  log.LOG_STREAM = branch.stream
+  lex.log_pron_to_symbol_map()
+  branch.close()
+  print 'Finished', branch
+
+
+def _run(lex, branches):
+  """Runs the iterations for branches that share a history.
+
+  Forks whenever the branches disagree about the next iteration. Every process
+  returns from here once its own branches and all of its children are done.
+
+  Args:
+    lex: a Lexicon
+    branches: list of Branch, all with logs open
+  Returns:
+    None
+  """
+  children = []
+  convergence = lexicon.new_convergence()
+  if convergence:
+    convergence.update(lex.counts())
+  i = 1
+  while branches:
+    for branch in [b for b in branches if b.niter <= i]:
+      _finish(lex, branch)
+    branches = [b for b in branches if b.niter > i]
+    if not branches: break
+    groups = _partition(branches, i)
+    mine = groups[0]
+    sys.stdout.flush()
+    for group in groups[1:]:
+      pid = os.fork()
+      if pid == 0:
+        children = []
+        mine = group
+        break
+      children.append(pid)
+    # The streams of the other groups now belong to other processes.
+    for branch in branches:
+      if branch not in mine:
+        branch.close()
+    branches = mine
+    freeze_phonetics, freeze_semantics = branches[0].key(i)
+    if freeze_phonetics:
+      lex.freeze_phonetics()
+    if freeze_semantics:
+      lex.freeze_semantics()
+    if convergence and (freeze_phonetics or freeze_semantics):
+      convergence.restart()
+    log.LOG_STREAM = TeeStream([b.stream for b in branches])
+    lexicon.run_iteration(lex, i)
+    stopped = convergence and convergence.update(lex.counts())
+    # Branches that have yet to freeze go on.
+    stopping = []
+    if stopped:
+      stopping = [b for b in branches if b.last_freeze <= i]
+    _snapshot(lex, branches, i, stopping, stopped)
+    for branch in stopping:
+      log.LOG_STREAM = branch.stream
+      log.log('Stopping after iteration {}: {}'.format(i, stopped))
+      _finish(lex, branch)
+    branches = [b for b in branches if b not in stopping]
+    i += 1
+  status = 0
+  for pid in children:
+    unused_pid, child_status = os.waitpid(pid, 0)
+    if child_status:
+      status = 1
+  if status:
+    raise RuntimeError('A branch of the sweep failed')
+
+
+def main(argv):
+  lexicon.define_flags()
+  flags.define_flag('freeze_phonetics_values',
+                    '',
+                    'Comma-separated freeze_phonetics_at_iter values to sweep')
+  flags.define_flag('freeze_semantics_values',
+                    '',
+                    'Comma-separated freeze_semantics_at_iter values to sweep')
+  flags.define_flag('niter_values',
+                    '',
+                    'Comma-separated niter values to sweep')
+  flags.parse_flags(argv[1:])
+  freeze_phonetics_values = (_int_list(flags.FLAGS_freeze_phonetics_values) or
+                             [flags.FLAGS_freeze_phonetics_at_iter])
+  freeze_semantics_values = (_int_list(flags.FLAGS_freeze_semantics_values) or
+                             [flags.FLAGS_freeze_semantics_at_iter])
+  niter_values = _int_list(flags.FLAGS_niter_values) or [flags.FLAGS_niter]
+  branches = []
+  for freeze_phonetics in freeze_phonetics_values:
+    for freeze_semantics in freeze_semantics_values:
+      for niter in niter_values:
+        outdir = '%s/freeze_%d/freeze_semantics_%d/niter_%d' % (
+          flags.FLAGS_outdir, freeze_phonetics, freeze_semantics, niter)
+        branches.append(Branch(freeze_phonetics, freeze_semantics, niter,
+                               outdir))
+  lex = lexicon.generate_lexicon()
+  for branch in branches:
+    branch.open()
+  _snapshot(lex, branches, 0)
+  parent = os.getpid()
+  try:
+    _run(lex, branches)
+  except Exception as err:
+    if os.getpid() == parent: raise
+    sys.stderr.write('%s\n' % err)
+    os._exit(1)
+  if os.getpid() != parent:
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
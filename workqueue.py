@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##      http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+##
+## Author: Richard Sproat (rws@xoba.com)
+
+"""Work queue for running parameter sweeps on several machines.
+
+The queue is a directory on a filesystem shared by the machines, holding one
+JSON file per job in each of the subdirectories pending, running, done and
+failed. A worker claims a job by renaming it from pending to running, which
+only one worker can do, and keeps an owner file next to it fresh while it runs
+the job. A job whose owner file has gone stale is put back in pending, and a
+job that fails is retried up to --max_attempts times.
+
+A job leaves running the same way: whichever worker settles it, its owner
+recording the outcome or another worker requeuing it as stale, first renames
+the job file to a name of its own, so only one of them does. An owner whose
+job was requeued while it ran drops its outcome.
+
+Usage:
+
+  workqueue.py submit --queue=DIR --outdir=DIR --experiments=5 \\
+    --grid='base_morph=MONOSYLLABLE,DISYLLABLE;ablaut=0,1' [lexicon.py flags]
+  workqueue.py work --queue=DIR
+  workqueue.py status --queue=DIR
+
+Each job runs lexicon.py with the flags given at submission, one setting from
+the grid, and an outdir of the form outdir/base_morph_DISYLLABLE/ablaut_1/3.
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import flags
+import lexicon
+
+_STATES = ['pending', 'running', 'done', 'failed']
+# Suffix of a running job file taken by a worker to settle the job.
+_TAKEN = '.taken'
+
+
+def _write_json(path, data):
+  """Writes JSON to a file atomically.
+
+  Args:
+    path: output file
+    data: JSON-serializable data
+  Returns:
+    None
+  """
+  tmp = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+  with open(tmp, 'w') as stream:
+    json.dump(data, stream, indent=2, sort_keys=True)
+  os.rename(tmp, path)
+
+
+def _read_json(path):
+  """Reads JSON from a file.
+
+  Args:
+    path: input file
+  Returns:
+    the data, or None if the file has gone
+  """
+  try:
+    with open(path) as stream:
+      return json.load(stream)
+  except IOError as err:
+    if err.errno == errno.ENOENT: return None
+    raise
+
+
+def _rename(source, target):
+  """Renames a file, unless another worker got there first.
+
+  Args:
+    source: file to rename
+    target: new name
+  Returns:
+    True if renamed
+  """
+  try:
+    os.rename(source, target)
+    return True
+  except OSError as err:
+    if err.errno == errno.ENOENT: return False
+    raise
+
+
+def parse_grid(grid):
+  """Parses a grid of flag settings.
+
+  Args:
+    grid: string of the form "flag1=v1,v2;flag2=v3"
+  Returns:
+    list of lists of (flag, value), one list per setting
+  """
+  settings = [[]]
+  for axis in grid.split(';'):
+    if not axis.strip(): continue
+    option, values = axis.split('=', 1)
+    option = option.strip()
+    settings = [setting + [(option, value.strip())]
+                for setting in settings
+                for value in values.split(',')]
+  return settings
+
+
+# BEGIN: class WorkQueue
+class WorkQueue(object):
+  """Job files in a shared directory.
+  """
+  def __init__(self, directory, max_attempts=3):
+    self._directory = directory
+    self._max_attempts = max_attempts
+    for state in _STATES:
+      try:
+        os.makedirs(self.path(state))
+      except OSError:
+        pass
+
+  def path(self, state, job_id=None, suffix='.json'):
+    """Path of the queue subdirectory for a state, or of a job file in it.
+    """
+    if job_id is None:
+      return '%s/%s' % (self._directory, state)
+    return '%s/%s/%s%s' % (self._directory, state, job_id, suffix)
+
+  def jobs(self, state):
+    """Returns the sorted ids of the jobs in a state.
+    """
+    return sorted(name[:-5] for name in os.listdir(self.path(state))
+                  if name.endswith('.json'))
+
+  def submit(self, job_id, args):
+    """Adds a job, unless it is already in the queue.
+
+    Args:
+      job_id: name of the job
+      args: list of flags for lexicon.py
+    Returns:
+      True if added
+    """
+    for state in _STATES:
+      if os.path.exists(self.path(state, job_id)):
+        return False
+    _write_json(self.path('pending', job_id),
+                {'id': job_id, 'args': args, 'attempts': 0})
+    return True
+
+  def claim(self):
+    """Claims a pending job.
+
+    Returns:
+      the job, or None if there are no pending jobs left
+    """
+    for job_id in self.jobs('pending'):
+      running = self.path('running', job_id)
+      if not _rename(self.path('pending', job_id), running):
+        continue
+      # The rename keeps the time the job was submitted, which would make it
+      # look stale until the owner file is written.
+      try:
+        os.utime(running, None)
+      except OSError:
+        continue
+      _write_json(self.path('running', job_id, '.owner'),
+                  {'host': socket.gethostname(),
+                   'pid': os.getpid(),
+                   'claimed': time.time()})
+      job = _read_json(running)
+      if job: return job
+    return None
+
+  def _owned(self, job_id):
+    """Whether the owner file of a running job names this process.
+    """
+    owner = _read_json(self.path('running', job_id, '.owner')) or {}
+    return (owner.get('host') == socket.gethostname() and
+            owner.get('pid') == os.getpid())
+
+  def heartbeat(self, job_id):
+    """Marks a claimed job as still alive.
+    """
+    if not self._owned(job_id): return
+    try:
+      os.utime(self.path('running', job_id, '.owner'), None)
+    except OSError:
+      pass
+
+  def finish(self, job, status):
+    """Records the outcome of a claimed job.
+
+    A failed job goes back to pending unless it has used up its attempts.
+    Nothing is recorded if the job was requeued while it ran.
+
+    Args:
+      job: the job
+      status: dict describing the outcome, with "status" being "ok" or "error"
+    Returns:
+      None
+    """
+    job_id = job['id']
+    job = dict(job)
+    job.update(status)
+    taken = self._owned(job_id) and self._take(job_id)
+    if not taken:
+      sys.stderr.write('Job %s was requeued while it ran; dropping its '
+                       'outcome\n' % job_id)
+      return
+    if status['status'] == 'ok':
+      self._settle(job_id, taken, 'done', job)
+    else:
+      self._retry(job_id, taken, job)
+
+  def _take(self, job_id, source=None):
+    """Renames a running job file to a name of this worker's own.
+
+    Only one worker can rename the file, so only one settles the job.
+
+    Args:
+      job_id: the job
+      source: file to rename, by default the job file in running
+    Returns:
+      the new name, or None if another worker took the job first
+    """
+    taken = self.path('running', job_id, '.%s.%d%s' % (
+      socket.gethostname(), os.getpid(), _TAKEN))
+    if not _rename(source or self.path('running', job_id), taken):
+      return None
+    # Dates the file from now, for finding it if this worker dies with it.
+    os.utime(taken, None)
+    return taken
+
+  def _settle(self, job_id, taken, state, job):
+    """Files a taken job under a state, removing its running files.
+
+    The owner file goes first, so that a worker claiming the job again once
+    it is back in pending keeps its own.
+
+    Args:
+      job_id: the job
+      taken: the job file, as returned by _take
+      state: "pending", "done" or "failed"
+      job: the job as recorded
+    Returns:
+      None
+    """
+    try:
+      os.remove(self.path('running', job_id, '.owner'))
+    except OSError:
+      pass
+    _write_json(self.path(state, job_id), job)
+    os.remove(taken)
+
+  def _retry(self, job_id, taken, job):
+    """Puts a taken job back in pending, or fails it after too many attempts.
+    """
+    job['attempts'] += 1
+    if job['attempts'] < self._max_attempts:
+      self._settle(job_id, taken, 'pending', job)
+    else:
+      self._settle(job_id, taken, 'failed', job)
+
+  def age(self, job_id):
+    """Seconds since the owner of a running job was last heard from.
+    """
+    for suffix in ('.owner', '.json'):
+      try:
+        return time.time() - os.path.getmtime(
+          self.path('running', job_id, suffix))
+      except OSError:
+        pass
+    return 0
+
+  def requeue_stale(self, stale_seconds):
+    """Retries the running jobs whose owners have gone quiet.
+
+    Jobs left taken by a worker that died before settling them are retried
+    too.
+
+    Args:
+      stale_seconds: how long an owner may be quiet
+    Returns:
+      number of jobs put back or failed
+    """
+    requeued = 0
+    for job_id in self.jobs('running'):
+      if self.age(job_id) < stale_seconds: continue
+      taken = self._take(job_id)
+      if not taken: continue
+      # Another worker may have requeued the job and a third claimed it again
+      # since its age was read, in which case it is put back.
+      owner = self.path('running', job_id, '.owner')
+      try:
+        fresh = time.time() - os.path.getmtime(owner) < stale_seconds
+      except OSError:
+        fresh = False
+      if fresh:
+        _rename(taken, self.path('running', job_id))
+        continue
+      requeued += self._retry_taken(job_id, taken)
+    for name in os.listdir(self.path('running')):
+      if not name.endswith(_TAKEN): continue
+      source = '%s/%s' % (self.path('running'), name)
+      try:
+        if time.time() - os.path.getmtime(source) < stale_seconds: continue
+      except OSError:
+        continue
+      job = _read_json(source)
+      if not job: continue
+      taken = self._take(job['id'], source)
+      if taken:
+        requeued += self._retry_taken(job['id'], taken)
+    return requeued
+
+  def _retry_taken(self, job_id, taken):
+    """Retries a stale job taken by this worker.
+
+    Returns:
+      1 if retried, 0 if the job file had gone
+    """
+    job = _read_json(taken)
+    if not job: return 0
+    job['stale'] = job.get('stale', 0) + 1
+    sys.stderr.write('Retrying stale job %s\n' % job_id)
+    self._retry(job_id, taken, job)
+    return 1
+# END: class WorkQueue
+
+
+def run_job(args):
+  """Runs lexicon.main with args in a child process.
+
+  Args:
+    args: list of flags for lexicon.py
+  Returns:
+    dict describing the outcome
+  """
+  start = time.time()
+  sys.stdout.flush()
+  pid = os.fork()
+  if pid == 0:
+    try:
+      lexicon.main(['lexicon.py'] + args)
+    except BaseException as err:
+      sys.stderr.write('%s\n' % err)
+      sys.stdout.flush()
+      os._exit(1)
+    sys.stdout.flush()
+    os._exit(0)
+  unused_pid, status, usage = os.wait4(pid, 0)
+  return {'status': 'error' if status else 'ok',
+          'exit_status': status,
+          'host': socket.gethostname(),
+          'start': start,
+          'end': time.time(),
+          'seconds': time.time() - start,
+          'cpu_seconds': usage.ru_utime + usage.ru_stime,
+          'max_rss_kb': usage.ru_maxrss}
+
+
+def work(queue):
+  """Claims and runs jobs until there are none left.
+
+  Args:
+    queue: a WorkQueue
+  Returns:
+    None
+  """
+  stale_seconds = flags.FLAGS_stale_seconds
+  while True:
+    job = queue.claim()
+    if not job:
+      if queue.requeue_stale(stale_seconds): continue
+      if flags.FLAGS_wait and queue.jobs('running'):
+        time.sleep(max(1, stale_seconds / 4))
+        continue
+      return
+    print 'Running job', job['id']
+    done = threading.Event()
+
+    def beat(job_id=job['id']):
+      while not done.wait(max(1, stale_seconds / 4)):
+        queue.heartbeat(job_id)
+
+    heart = threading.Thread(target=beat)
+    heart.daemon = True
+    heart.start()
+    try:
+      status = run_job(job['args'])
+    finally:
+      done.set()
+      heart.join()
+    print 'Job', job['id'], status['status']
+    queue.finish(job, status)
+
+
+def submit(queue, argv):
+  """Adds the jobs for a grid to the queue.
+
+  Args:
+    queue: a WorkQueue
+    argv: lexicon.py flags given on the command line, passed to every job
+  Returns:
+    None
+  """
+  own_flags = ['queue', 'grid', 'experiments', 'outdir', 'max_attempts',
+               'stale_seconds', 'wait']
+  common = [arg for arg in argv
+            if arg.split('=', 1)[0].lstrip('-') not in own_flags]
+  added = 0
+  settings = parse_grid(flags.FLAGS_grid)
+  for setting in settings:
+    path = '/'.join('%s_%s' % (option, value) for option, value in setting)
+    args = common + ['--%s=%s' % (option, value) for option, value in setting]
+    for expt in range(flags.FLAGS_experiments):
+      job_id = ('%s-%d' % (path, expt)).replace('/', '-').lstrip('-')
+      outdir = '/'.join(p for p in (flags.FLAGS_outdir, path, str(expt)) if p)
+      if queue.submit(job_id, args + ['--outdir=%s' % outdir]):
+        added += 1
+  print 'Added %d jobs' % added
+
+
+def status(queue):
+  """Prints the state of the queue.
+
+  Args:
+    queue: a WorkQueue
+  Returns:
+    None
+  """
+  for state in _STATES:
+    print '%-8s %d' % (state, len(queue.jobs(state)))
+  for job_id in queue.jobs('running'):
+    owner = _read_json(queue.path('running', job_id, '.owner')) or {}
+    age = queue.age(job_id)
+    stale = ' STALE' if age >= flags.FLAGS_stale_seconds else ''
+    print '  running %s on %s:%s, heard from %ds ago%s' % (
+      job_id, owner.get('host'), owner.get('pid'), age, stale)
+  seconds = []
+  for job_id in queue.jobs('done'):
+    job = _read_json(queue.path('done', job_id))
+    if job: seconds.append(job['seconds'])
+  if seconds:
+    print 'done: %.1fs total, %.1fs mean per job' % (
+      sum(seconds), sum(seconds) / len(seconds))
+  for job_id in queue.jobs('failed'):
+    job = _read_json(queue.path('failed', job_id)) or {}
+    print '  failed %s after %d attempts' % (job_id, job.get('attempts', 0))
+
+
+def main(argv):
+  commands = {'submit': submit, 'work': work, 'status': status}
+  if len(argv) < 2 or argv[1] not in commands:
+    sys.stderr.write(__doc__)
+    sys.exit(1)
+  lexicon.define_flags()
+  flags.define_flag('queue',
+                    '',
+                    'Directory of the queue, on a filesystem shared by workers')
+  flags.define_flag('grid',
+                    '',
+                    'Settings to submit, e.g. "base_morph=A,B;ablaut=0,1"')
+  flags.define_flag('experiments',
+                    '1',
+                    'Number of experiments per setting')
+  flags.define_flag('max_attempts',
+                    '3',
+                    'Number of times a job is tried before it fails')
+  flags.define_flag('stale_seconds',
+                    '600',
+                    'Time after which a quiet running job is requeued')
+  flags.define_flag('wait',
+                    '1',
+                    'Whether workers wait for running jobs that may be requeued')
+  flags.parse_flags(argv[2:])
+  if not flags.FLAGS_queue:
+    sys.stderr.write('No --queue given\n')
+    sys.exit(1)
+  queue = WorkQueue(flags.FLAGS_queue, flags.FLAGS_max_attempts)
+  if argv[1] == 'submit':
+    submit(queue, argv[2:])
+  else:
+    commands[argv[1]](queue)
+
+
+if __name__ == '__main__':
+  main(sys.argv)